@@ -1,2 +1,81 @@
+import os
+
+
 DEFAULT_COMISSION = 0.1
-DEFAULT_MULTIPLIER = 1
\ No newline at end of file
+DEFAULT_MULTIPLIER = 1
+KLINE_INTERVAL = 24 * 60 * 60  # seconds between two klines of the CSV data
+KLINE_STORE_PATH = os.path.join(os.getcwd(), 'kline_store')
+KLINE_DATA_PATH = os.path.join(os.getcwd(), 'app', 'data', 'data')  # <currency>.csv files loaded on startup
+KLINE_TIMEFRAMES = {'1h': 60 * 60, '4h': 4 * 60 * 60, '1d': 24 * 60 * 60, '1w': 7 * 24 * 60 * 60}
+KLINE_TIMEFRAME_ORIGINS = {'1w': 4 * 24 * 60 * 60}  # weeks start on Monday, 1970-01-05
+INGEST_CHUNK_SIZE = 50000  # CSV rows parsed per vectorized chunk
+INGEST_BATCH_SIZE = 5000  # rows per executemany batch
+INGEST_WORKERS = min(os.cpu_count() or 1, 8)
+MAX_BATCH_ORDERS = 1000
+MARKET_ORDER_SLIPPAGE = 0.1  # margin over the last close reserved for a market buy filled at the next open
+KLINES_PAGE_SIZE = 500
+KLINES_MAX_PAGE_SIZE = 5000
+KLINES_STREAM_CHUNK_SIZE = 65536  # bars encoded per chunk of a streamed download
+ORDERS_PAGE_SIZE = 500
+ORDERS_MAX_PAGE_SIZE = 10000
+ORDERS_STREAM_CHUNK_SIZE = 1000  # rows fetched from the cursor and encoded per chunk of an order listing
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///playground.db')
+ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL', DATABASE_URL.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+                                                                      .replace('postgresql://', 'postgresql+asyncpg://', 1))
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_STATEMENT_CACHE_SIZE = 500
+# All order types in base_orders with nullable type-specific columns, instead of a table per type.
+# Switching an existing database over is migrated, switching back is not.
+ORDERS_SINGLE_TABLE = os.environ.get('ORDERS_SINGLE_TABLE', '').lower() in ('1', 'true')
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # KiB
+    'temp_store': 'MEMORY',
+}
+
+AUTH_CACHE_SIZE = 100000
+AUTH_CACHE_TTL = 300  # seconds, bounds how long other workers may accept a revoked key
+
+SCHEDULER_SLOT = 0.001  # exchanges due within the same slot are ticked in one wakeup
+MIN_TICK_INTERVAL = 0.001  # faster exchanges advance several klines per wakeup
+MAX_BARS_PER_WAKEUP = 1000
+
+JOURNAL_PATH = os.path.join(os.getcwd(), 'journal', 'events.log')
+JOURNAL_GROUP_INTERVAL = 0.002  # seconds events wait for others to share their fsync
+JOURNAL_GROUP_SIZE = 1000  # events that trigger a group commit without waiting
+JOURNAL_FILE_SIZE = 64 * 1024 * 1024  # bytes after which the journal continues in a new file
+PROJECTION_INTERVAL = 0.5  # seconds between applying journal events to the tables
+
+SNAPSHOT_DIRECTORY = os.path.join(os.getcwd(), 'snapshots')
+EXCHANGE_IDLE_TIMEOUT = 60  # seconds without requests or subscribers before an exchange is hibernated
+EXCHANGE_EVICTION_INTERVAL = 10  # seconds between checks for idle exchanges
+
+SHARDING_ENABLED = os.environ.get('SHARDING_ENABLED', '').lower() in ('1', 'true')  # one shard per uvicorn worker
+SHARD_DIRECTORY = os.path.join(os.getcwd(), 'shards')
+MAX_SHARDS = 64  # also the stride of the order ids every shard allocates
+SHARD_VIRTUAL_NODES = 128  # points per shard on the hash ring
+SHARD_REFRESH_INTERVAL = 1  # seconds between membership checks
+SHARD_HANDOFF_TIMEOUT = 10  # seconds a shard waits for the previous owner of a user to hibernate their exchange
+SHARD_HANDOFF_POLL_INTERVAL = 0.05
+
+STARTUP_IN_BACKGROUND = os.environ.get('STARTUP_IN_BACKGROUND', '').lower() in ('1', 'true')  # serve while klines load
+STARTUP_TARGET_SECONDS = 2.0  # startup taking longer is logged as a warning
+
+SUBSCRIPTION_QUEUE_SIZE = 1000  # messages buffered per WebSocket before it is dropped as too slow
+
+LOG_FILE = 'app.log'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Per-subsystem levels, e.g. LOG_LEVELS="tick=DEBUG,journal=WARNING"
+LOG_LEVELS = dict(item.split('=', 1) for item in os.environ.get('LOG_LEVELS', '').split(',') if '=' in item)
+LOG_SAMPLE_RATES = {'tick': 100}  # one in N per-exchange records below WARNING is kept
+
+# Upper bounds in seconds of the latency histogram buckets served on /metrics
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+LOOP_LAG_INTERVAL = 0.1
+
+BACKTEST_JOBS_SIZE = 1000
+BACKTEST_JOBS_TTL = 60 * 60  # seconds a finished backtest result is kept
@@ -13,6 +13,11 @@ LIMIT = 'limit'
 STOP_LIMIT = 'stop_limit'
 OCO = 'oco'
 
+# Order lifecycle, a triggered stop-limit order stays open as a limit order
+OPEN = 'open'
+FILLED = 'filled'
+CANCELLED = 'cancelled'
+
 
 order_classes = {
     MARKET: MarketOrder,
@@ -46,4 +51,10 @@ class OrderType(BaseType):
     MARKET: str = MARKET
     LIMIT: str = LIMIT
     STOP_LIMIT: str = STOP_LIMIT
-    OCO: str = OCO
\ No newline at end of file
+    OCO: str = OCO
+
+@dataclass
+class OrderStatus(BaseType):
+    OPEN: str = OPEN
+    FILLED: str = FILLED
+    CANCELLED: str = CANCELLED
@@ -1,82 +1,166 @@
-import csv
-from datetime import datetime
 import os
-from sqlalchemy import create_engine, inspect
-from sqlalchemy.orm import sessionmaker
-from app.data.models import Balance, Base, BaseOrder, ExchangeInstance, Kline, LimitOrder, MarketOrder, OcoOrder, StopLimitOrder, User
+from functools import lru_cache
+from typing import AsyncIterator, Dict
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.consts import (ASYNC_DATABASE_URL, DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_STATEMENT_CACHE_SIZE, KLINE_DATA_PATH,
+                        SQLITE_PRAGMAS)
+from app.data.ingest import ingest_folder, insert_klines, parse_kline_file
+from app.data.migrations import run_migrations
+from app.data.models import Base
 from app.utils.logger import logger
-
-
-
-def get_engine():
-   return create_engine('sqlite:///playground.db')
+from app.utils.metrics import instrument_engine
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """
+    Create the process-wide engine on first use.
+
+    SQLite connections get the WAL journal, relaxed fsync and memory-mapped IO pragmas
+    and a per-connection statement cache.
+    """
+    if DATABASE_URL.startswith('sqlite'):
+        engine = create_engine(DATABASE_URL,
+                               pool_size=DB_POOL_SIZE,
+                               max_overflow=DB_MAX_OVERFLOW,
+                               query_cache_size=DB_STATEMENT_CACHE_SIZE,
+                               connect_args={'check_same_thread': False, 'cached_statements': DB_STATEMENT_CACHE_SIZE})
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    else:
+        engine = create_engine(DATABASE_URL,
+                               pool_size=DB_POOL_SIZE,
+                               max_overflow=DB_MAX_OVERFLOW,
+                               pool_pre_ping=True,
+                               query_cache_size=DB_STATEMENT_CACHE_SIZE)
+    instrument_engine(engine)
+
+    logger.info("Database engine created for %s", engine.url)
+    return engine
+
+
+@lru_cache(maxsize=None)
+def get_async_engine() -> AsyncEngine:
+    """
+    Create the process-wide async engine used by the routers and the exchanges.
+
+    It runs on an async driver (aiosqlite for SQLite, asyncpg for PostgreSQL) with the same
+    pool, statement cache and SQLite pragmas as the sync engine used for setup and ingestion.
+    """
+    if ASYNC_DATABASE_URL.startswith('sqlite'):
+        engine = create_async_engine(ASYNC_DATABASE_URL,
+                                     poolclass=AsyncAdaptedQueuePool,
+                                     pool_size=DB_POOL_SIZE,
+                                     max_overflow=DB_MAX_OVERFLOW,
+                                     query_cache_size=DB_STATEMENT_CACHE_SIZE,
+                                     connect_args={'check_same_thread': False})
+        event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+    else:
+        engine = create_async_engine(ASYNC_DATABASE_URL,
+                                     pool_size=DB_POOL_SIZE,
+                                     max_overflow=DB_MAX_OVERFLOW,
+                                     pool_pre_ping=True,
+                                     query_cache_size=DB_STATEMENT_CACHE_SIZE)
+    instrument_engine(engine.sync_engine)
+
+    logger.info("Async database engine created for %s", engine.url)
+    return engine
+
+
+@lru_cache(maxsize=None)
+def get_session_factory() -> sessionmaker:
+    return sessionmaker(bind=get_engine(), expire_on_commit=False)
+
+
+@lru_cache(maxsize=None)
+def get_async_session_factory() -> async_sessionmaker:
+    return async_sessionmaker(bind=get_async_engine(), expire_on_commit=False)
 
 
 def initialize_database():
+    """
+    Create the missing tables and apply the pending migrations.
+
+    Called once by the app lifespan, importing this module does not touch the database.
+    """
     try:
         engine = get_engine()
-        Base.metadata.create_all(engine)
         create_tables(engine)
+        run_migrations(engine)
         return engine
     except Exception as e:
-        logger.exception(f"Failed to initialize database: {str(e)}")
+        logger.exception("Failed to initialize database: %s", e)
         raise
 
 def create_tables(engine):
-    inspector = inspect(engine)
-    existing_tables = inspector.get_table_names()
-
-    tables_to_create = [User, BaseOrder, LimitOrder, MarketOrder, OcoOrder, StopLimitOrder, Kline, ExchangeInstance, Balance]
-    for table in tables_to_create:
-        if table.__tablename__ not in existing_tables:
-            table.metadata.create_all(engine)
-            logger.info(f"Table {table.__tablename__} created.")
-        else:
-            logger.info(f"Table {table.__tablename__} already exists.")
-
-def get_session():
-    engine = get_engine()
+    existing_tables = set(inspect(engine).get_table_names())
+    missing_tables = [table for table in Base.metadata.sorted_tables if table.name not in existing_tables]
+
+    if missing_tables:
+        Base.metadata.create_all(engine, tables=missing_tables, checkfirst=False)
+        logger.info("Tables created: %s", ', '.join(table.name for table in missing_tables))
+
+def get_session() -> Session:
     try:
-        Session = sessionmaker(bind=engine)
-        return Session()
+        return get_session_factory()()
     except Exception as e:
-        logger.exception(f"Failed to create session: {str(e)}")
+        logger.exception("Failed to create session: %s", e)
         raise
 
 
+def get_async_session() -> AsyncSession:
+    try:
+        return get_async_session_factory()()
+    except Exception as e:
+        logger.exception("Failed to create async session: %s", e)
+        raise
+
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """
+    FastAPI dependency providing an async session that is closed once the request is handled.
+    """
+    async with get_async_session() as session:
+        yield session
+
 
 def create_kline(session, currency, file_path):
-    print(file_path)
-    with open(file_path, 'r') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            kline = Kline(
-                currency_name=currency,
-                timestamp=datetime.strptime(row['Date'], '%Y-%m-%d'),
-                open_price=float(row['Open']),
-                high_price=float(row['High']),
-                low_price=float(row['Low']),
-                close_price=float(row['Close']),
-                volume=float(row['Volume'])
-            )
-            session.add(kline)
-        session.commit()
-
-
-def initialize_data():
-    session = get_session()
-    
-    # Check if Kline table is empty
-    if not session.query(Kline).first():
-        folder_path = os.path.join(os.getcwd(), 'app', 'data', 'data' )  # Update this with your folder path
-        for filename in os.listdir(folder_path):
-            if filename.endswith('.csv'):
-                currency = filename[:-4]  # Extract currency name from the filename
-                file_path = os.path.join(folder_path, filename)
-                create_kline(session, currency, file_path)
-
-    session.close()
-
-initialize_database()
-
-initialize_data()
+    """
+    Load a single kline CSV file through the bulk ingestion path of the session connection.
+    """
+    columns = parse_kline_file(file_path)
+    inserted = insert_klines(session.connection(), currency, columns)
+    session.commit()
+    return inserted
+
+
+def initialize_data(folder_path: str = KLINE_DATA_PATH) -> Dict[str, int]:
+    """
+    Load the kline CSVs that are not in the database yet and extend the kline store with them.
+
+    Returns:
+        dict: Number of inserted rows per currency.
+    """
+    if not os.path.isdir(folder_path):
+        logger.warning("Kline data folder %s does not exist", folder_path)
+        return {}
+
+    inserted = ingest_folder(get_engine(), folder_path)
+
+    if inserted:
+        from app.data.kline_store import kline_store
+        for currency in inserted:
+            kline_store.extend(currency)
+    return inserted
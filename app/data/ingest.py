@@ -0,0 +1,184 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from sqlalchemy import func, insert, select
+from sqlalchemy.engine import Connection, Engine
+
+from app.consts import INGEST_BATCH_SIZE, INGEST_CHUNK_SIZE, INGEST_WORKERS
+from app.data.models import Kline
+from app.utils.logger import logger
+
+
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+
+def read_last_date(file_path: str) -> Optional[np.datetime64]:
+    """
+    Read the date of the last row of a kline CSV without parsing the whole file.
+    """
+    with open(file_path, 'rb') as csv_file:
+        csv_file.seek(0, os.SEEK_END)
+        position = csv_file.tell()
+        tail = b''
+        while position > 0 and tail.strip().count(b'\n') < 1:
+            step = min(4096, position)
+            position -= step
+            csv_file.seek(position)
+            tail = csv_file.read(step) + tail
+
+    last_line = tail.strip().rsplit(b'\n', 1)[-1].decode()
+    if last_line.startswith('Date'):
+        return None
+    return np.datetime64(last_line.split(',', 1)[0], 'D')
+
+
+def parse_kline_chunks(file_path: str, chunk_size: int = INGEST_CHUNK_SIZE) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Parse a kline CSV file in chunks of rows.
+
+    Dates and prices of a chunk are converted in one vectorized call per column.
+
+    Yields:
+        dict: Column arrays of the chunk, dates as ``datetime64[D]`` and prices as float64.
+    """
+    with open(file_path, 'r', newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader)
+        date_index = header.index('Date')
+        price_indexes = [header.index(column) for column in PRICE_COLUMNS]
+
+        while True:
+            rows = list(islice(csv_reader, chunk_size))
+            if not rows:
+                break
+
+            columns = list(zip(*rows))
+            chunk = {'Date': np.array(columns[date_index], dtype='datetime64[D]')}
+            for column, index in zip(PRICE_COLUMNS, price_indexes):
+                chunk[column] = np.array(columns[index]).astype(np.float64)
+            yield chunk
+
+
+def parse_kline_file(file_path: str, since: Optional[np.datetime64] = None) -> Dict[str, np.ndarray]:
+    """
+    Parse a kline CSV file keeping only the rows dated after ``since``.
+    """
+    chunks = []
+    for chunk in parse_kline_chunks(file_path):
+        if since is not None:
+            mask = chunk['Date'] > since
+            chunk = {column: values[mask] for column, values in chunk.items()}
+        if len(chunk['Date']):
+            chunks.append(chunk)
+
+    if not chunks:
+        return {column: np.array([]) for column in ['Date'] + PRICE_COLUMNS}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in chunks[0]}
+
+
+def insert_klines(connection: Connection, currency: str, columns: Dict[str, np.ndarray],
+                  batch_size: int = INGEST_BATCH_SIZE) -> int:
+    """
+    Write parsed kline columns with ``executemany`` inserts in bounded batches.
+
+    Returns:
+        int: Number of inserted rows.
+    """
+    statement = insert(Kline.__table__)
+    total = len(columns['Date'])
+
+    for start in range(0, total, batch_size):
+        stop = start + batch_size
+        timestamps = columns['Date'][start:stop].astype('datetime64[us]').tolist()
+        connection.execute(statement, [
+            {
+                'currency_name': currency,
+                'timestamp': timestamp,
+                'open_price': open_price,
+                'high_price': high_price,
+                'low_price': low_price,
+                'close_price': close_price,
+                'volume': volume,
+            }
+            for timestamp, open_price, high_price, low_price, close_price, volume in zip(
+                timestamps,
+                columns['Open'][start:stop].tolist(),
+                columns['High'][start:stop].tolist(),
+                columns['Low'][start:stop].tolist(),
+                columns['Close'][start:stop].tolist(),
+                columns['Volume'][start:stop].tolist(),
+            )
+        ])
+
+    return total
+
+
+def get_loaded_dates(connection: Connection) -> Dict[str, np.datetime64]:
+    """
+    Retrieve the date of the latest stored kline of every currency.
+    """
+    rows = connection.execute(select(Kline.currency_name, func.max(Kline.timestamp)).group_by(Kline.currency_name))
+    return {currency: np.datetime64(timestamp, 'D') for currency, timestamp in rows if timestamp}
+
+
+def ingest_folder(engine: Engine, folder_path: str, workers: int = INGEST_WORKERS) -> Dict[str, int]:
+    """
+    Load every kline CSV of a folder into the database.
+
+    Files whose last row is already stored are skipped, partly loaded files only get their
+    newer rows appended. Files are parsed in parallel by a process pool while the parent
+    process writes the parsed columns in batches.
+
+    Parameters:
+        engine (Engine): Engine of the database the klines are written to.
+        folder_path (str): Folder with ``<currency>.csv`` files.
+        workers (int): Number of parser processes, 0 parses in the current process.
+
+    Returns:
+        dict: Number of inserted rows per currency.
+    """
+    with engine.connect() as connection:
+        loaded_dates = get_loaded_dates(connection)
+
+    pending: List[tuple] = []
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith('.csv'):
+            continue
+
+        currency = filename[:-4]
+        file_path = os.path.join(folder_path, filename)
+        since = loaded_dates.get(currency)
+        last_date = read_last_date(file_path)
+
+        if last_date is None or (since is not None and last_date <= since):
+            logger.info("Klines of %s are up to date", currency)
+            continue
+        pending.append((currency, file_path, since))
+
+    if not pending:
+        return {}
+
+    inserted = {}
+    currencies, file_paths, since_dates = zip(*pending)
+
+    if workers:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(pending)))
+        parsed_files = executor.map(parse_kline_file, file_paths, since_dates)
+    else:
+        executor = None
+        parsed_files = map(parse_kline_file, file_paths, since_dates)
+
+    try:
+        for currency, columns in zip(currencies, parsed_files):
+            with engine.begin() as connection:
+                inserted[currency] = insert_klines(connection, currency, columns)
+            logger.info("Ingested %d klines for %s", inserted[currency], currency)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    return inserted
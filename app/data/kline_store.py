@@ -0,0 +1,270 @@
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.consts import KLINE_INTERVAL, KLINE_STORE_PATH, KLINE_TIMEFRAME_ORIGINS, KLINE_TIMEFRAMES
+from app.data.db import get_session
+from app.data.models import Kline
+from app.data.rollups import extend_rollup, rollup
+from app.utils.logger import logger
+
+
+COLUMNS = {
+    'timestamps': np.int64,
+    'open': np.float64,
+    'high': np.float64,
+    'low': np.float64,
+    'close': np.float64,
+    'volume': np.float64,
+}
+
+# Names the column files of the current version of a series and their length, written last
+MANIFEST = 'manifest.json'
+
+
+class KlineSeries:
+    """
+    OHLCV series of a single currency stored as contiguous columns.
+
+    ``timestamps`` holds epoch seconds sorted in ascending order, the price and volume columns
+    are float64 arrays of the same length. Arrays loaded from disk are read-only memory maps.
+    """
+
+    def __init__(self, currency: str, timestamps: np.ndarray, open: np.ndarray, high: np.ndarray,
+                 low: np.ndarray, close: np.ndarray, volume: np.ndarray):
+        self.currency = currency
+        self.timestamps = timestamps
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def index_of(self, timestamp: int) -> int:
+        """
+        Returns the index of the first bar at or after the given timestamp.
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side='left'))
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in COLUMNS}
+
+
+def rollup_timeframes() -> List[str]:
+    """
+    Timeframes that are aggregated from the base klines, coarser ones than ``KLINE_INTERVAL``.
+    """
+    return [timeframe for timeframe, seconds in KLINE_TIMEFRAMES.items()
+            if seconds > KLINE_INTERVAL and seconds % KLINE_INTERVAL == 0]
+
+
+class KlineStore:
+    """
+    Loads kline series from the database once and keeps them as memory-mapped NumPy files.
+
+    Every currency is saved as one ``.npy`` file per column under ``path/<currency>/``,
+    so several worker processes mapping the same files share one page-cache copy. Every save
+    writes a new version of the files and then swaps the manifest naming the current version,
+    so a reader never maps columns of two different saves.
+    Rollups of the higher timeframes are kept next to it under ``path/<currency>/<timeframe>/``
+    and read at the same cost as the base series.
+    """
+
+    def __init__(self, path: str = KLINE_STORE_PATH):
+        self.path = path
+        self.series: Dict[Tuple[str, Optional[str]], KlineSeries] = {}
+
+    def get(self, currency: str, timeframe: Optional[str] = None) -> Optional[KlineSeries]:
+        """
+        Retrieve the series of a currency, building its files from the database on first use.
+
+        Parameters:
+            currency (str): Currency of the series.
+            timeframe (str): One of ``KLINE_TIMEFRAMES``, the base klines if omitted.
+
+        Returns:
+            KlineSeries: The series or None if there are no klines for the currency or the
+            timeframe is finer than the base klines.
+        """
+        if timeframe is not None and KLINE_TIMEFRAMES[timeframe] == KLINE_INTERVAL:
+            timeframe = None
+
+        key = (currency, timeframe)
+        if key in self.series:
+            return self.series[key]
+
+        if timeframe is not None and timeframe not in rollup_timeframes():
+            logger.warning("Timeframe %s is finer than the stored klines of %s", timeframe, currency)
+            return None
+
+        series = self.__load(currency, timeframe)
+        if series is None:
+            self.build(currency)
+            series = self.__load(currency, timeframe)
+
+        if series is not None:
+            self.series[key] = series
+        return series
+
+    def build(self, currency: str) -> Optional[KlineSeries]:
+        """
+        Read the currency klines from the database and write them and their rollups to the store.
+        """
+        columns = self.__read(currency)
+        if columns is None:
+            logger.warning("No klines found for %s", currency)
+            return None
+
+        self.save(currency, columns)
+        for timeframe in rollup_timeframes():
+            self.save(currency, rollup(columns, KLINE_TIMEFRAMES[timeframe], KLINE_TIMEFRAME_ORIGINS.get(timeframe, 0)), timeframe)
+        self.__forget(currency)
+        logger.info("Kline store built for %s: %d bars", currency, len(columns['timestamps']))
+
+        return self.__load(currency)
+
+    def extend(self, currency: str) -> Optional[KlineSeries]:
+        """
+        Append the klines stored in the database after the last stored bar of a currency.
+
+        Only the new bars are aggregated into the rollups, the last bucket of a rollup is merged
+        with them if it was still open. A currency without files is built from scratch.
+        """
+        series = self.__load(currency)
+        if series is None:
+            return self.build(currency)
+
+        added = self.__read(currency, since=int(series.timestamps[-1]))
+        if added is None:
+            return series
+
+        for timeframe in rollup_timeframes():
+            rolled = self.__load(currency, timeframe)
+            seconds, origin = KLINE_TIMEFRAMES[timeframe], KLINE_TIMEFRAME_ORIGINS.get(timeframe, 0)
+            if rolled is None:
+                columns = {name: np.concatenate((values, added[name])) for name, values in series.columns().items()}
+                self.save(currency, rollup(columns, seconds, origin), timeframe)
+            else:
+                self.save(currency, extend_rollup(rolled.columns(), added, seconds, origin), timeframe)
+
+        self.save(currency, {name: np.concatenate((values, added[name])) for name, values in series.columns().items()})
+        self.__forget(currency)
+        logger.info("Kline store extended for %s: %d bars", currency, len(added['timestamps']))
+
+        return self.__load(currency)
+
+    def save(self, currency: str, columns: Dict[str, np.ndarray], timeframe: Optional[str] = None):
+        """
+        Atomically write the column files of a currency or of one of its rollups.
+
+        The columns are written as a new version and the manifest is replaced last, files of older
+        versions are removed afterwards. Readers that already mapped them keep their mappings.
+        """
+        directory = self.__directory(currency, timeframe)
+        os.makedirs(directory, exist_ok=True)
+
+        version = f'{time.time_ns()}-{os.getpid()}'
+        length = len(columns['timestamps'])
+        for name, dtype in COLUMNS.items():
+            with open(os.path.join(directory, f'{name}.{version}.npy'), 'wb') as file:
+                np.save(file, np.ascontiguousarray(columns[name], dtype=dtype))
+
+        manifest_path = os.path.join(directory, MANIFEST)
+        tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': version, 'length': length}, file)
+        os.replace(tmp_path, manifest_path)
+
+        self.__remove_columns(directory, keep=version)
+
+    def invalidate(self, currency: str):
+        """
+        Drop the cached series of a currency, it is rebuilt from the database on next access.
+        """
+        self.__forget(currency)
+        for timeframe in [None, *KLINE_TIMEFRAMES]:
+            directory = self.__directory(currency, timeframe)
+            manifest_path = os.path.join(directory, MANIFEST)
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            self.__remove_columns(directory)
+
+    def __read(self, currency: str, since: Optional[int] = None) -> Optional[Dict[str, np.ndarray]]:
+        query = (
+            select(Kline.timestamp, Kline.open_price, Kline.high_price, Kline.low_price, Kline.close_price, Kline.volume)
+            .where(Kline.currency_name == currency)
+            .order_by(Kline.timestamp)
+        )
+        if since is not None:
+            query = query.where(Kline.timestamp > datetime.utcfromtimestamp(since))
+
+        with get_session() as session:
+            rows = session.execute(query).all()
+
+        if not rows:
+            return None
+
+        timestamps, *values = zip(*rows)
+        columns = {'timestamps': np.array(timestamps, dtype='datetime64[s]').astype(np.int64)}
+        for name, column in zip(list(COLUMNS)[1:], values):
+            columns[name] = np.array(column, dtype=np.float64)
+        return columns
+
+    def __forget(self, currency: str):
+        for key in [key for key in self.series if key[0] == currency]:
+            del self.series[key]
+
+    def __directory(self, currency: str, timeframe: Optional[str] = None) -> str:
+        if timeframe is None:
+            return os.path.join(self.path, currency)
+        return os.path.join(self.path, currency, timeframe)
+
+    def __remove_columns(self, directory: str, keep: Optional[str] = None):
+        """
+        Remove the column files of every version but ``keep`` from a directory.
+        """
+        if not os.path.isdir(directory):
+            return
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.npy') and (keep is None or not file_name.endswith(f'.{keep}.npy')):
+                try:
+                    os.remove(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+    def __load(self, currency: str, timeframe: Optional[str] = None) -> Optional[KlineSeries]:
+        """
+        Map the columns of the version the manifest names, None if there is none or its files are incomplete.
+        """
+        directory = self.__directory(currency, timeframe)
+        manifest_path = os.path.join(directory, MANIFEST)
+
+        # A concurrent save may remove the version between reading the manifest and mapping it
+        for _ in range(2):
+            try:
+                with open(manifest_path) as file:
+                    manifest = json.load(file)
+                columns = {name: np.load(os.path.join(directory, f"{name}.{manifest['version']}.npy"), mmap_mode='r')
+                           for name in COLUMNS}
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                return None
+
+            if any(len(column) != manifest['length'] for column in columns.values()):
+                logger.warning("Kline store files of %s are incomplete", directory)
+                return None
+            return KlineSeries(currency, **columns)
+
+        return None
+
+
+kline_store = KlineStore()
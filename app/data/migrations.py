@@ -0,0 +1,98 @@
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from app.consts import ORDERS_SINGLE_TABLE
+from app.utils.logger import logger
+
+
+def add_klines_currency_timestamp_index(connection: Connection):
+    """
+    Drop duplicated klines and add the unique (currency_name, timestamp) index.
+    """
+    connection.execute(text(
+        "DELETE FROM klines WHERE id NOT IN "
+        "(SELECT MIN(id) FROM klines GROUP BY currency_name, timestamp)"
+    ))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_klines_currency_name_timestamp ON klines (currency_name, timestamp)"
+    ))
+
+
+def add_users_api_key_index(connection: Connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_users_api_key ON users (api_key)"))
+
+
+def add_orders_status(connection: Connection):
+    """
+    Add the order status column and the (user_id, status) index of open orders.
+
+    Cancelled orders used to be deleted and orders were never resolved, so every order from before
+    the column is still open and is backfilled as such.
+    """
+    if 'status' not in {column['name'] for column in inspect(connection).get_columns('base_orders')}:
+        connection.execute(text("ALTER TABLE base_orders ADD COLUMN status VARCHAR"))
+    connection.execute(text("UPDATE base_orders SET status = 'open' WHERE status IS NULL"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_base_orders_user_id_status ON base_orders (user_id, status) WHERE status = 'open'"
+    ))
+
+
+def merge_order_tables(connection: Connection):
+    """
+    Move the columns of the per-type order tables into base_orders and drop those tables.
+    """
+    if 'bounded_order_id' not in {column['name'] for column in inspect(connection).get_columns('base_orders')}:
+        connection.execute(text("ALTER TABLE base_orders ADD COLUMN bounded_order_id INTEGER"))
+
+    tables = set(inspect(connection).get_table_names())
+    if 'oco_orders' in tables:
+        connection.execute(text(
+            "UPDATE base_orders SET bounded_order_id = "
+            "(SELECT oco_orders.bounded_order_id FROM oco_orders WHERE oco_orders.id = base_orders.id) "
+            "WHERE id IN (SELECT id FROM oco_orders)"
+        ))
+    for table in ('market_orders', 'limit_orders', 'oco_orders', 'stop_limit_orders'):
+        if table in tables:
+            connection.execute(text(f"DROP TABLE {table}"))
+
+
+def add_orders_user_id_creation_date_index(connection: Connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_base_orders_user_id_creation_date_id ON base_orders (user_id, creation_date, id)"
+    ))
+
+
+def add_journal_checkpoints_journal(connection: Connection):
+    if 'journal' not in {column['name'] for column in inspect(connection).get_columns('journal_checkpoints')}:
+        connection.execute(text("ALTER TABLE journal_checkpoints ADD COLUMN journal VARCHAR"))
+
+
+# Applied in order, every migration runs once per database and is recorded in schema_migrations.
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ('0001_klines_currency_timestamp_index', add_klines_currency_timestamp_index),
+    ('0002_users_api_key_index', add_users_api_key_index),
+    ('0003_orders_status', add_orders_status),
+] + ([('0004_single_table_orders', merge_order_tables)] if ORDERS_SINGLE_TABLE else []) + [
+    ('0005_orders_user_id_creation_date_index', add_orders_user_id_creation_date_index),
+    ('0006_journal_checkpoints_journal', add_journal_checkpoints_journal),
+]
+
+
+def run_migrations(engine: Engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations (name VARCHAR PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        applied = {name for name, in connection.execute(text("SELECT name FROM schema_migrations"))}
+
+        for name, migration in MIGRATIONS:
+            if name in applied:
+                continue
+
+            migration(connection)
+            connection.execute(text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :applied_at)"),
+                               {'name': name, 'applied_at': datetime.now()})
+            logger.info("Migration %s applied.", name)
@@ -1,6 +1,8 @@
-from sqlalchemy import Column, DateTime, String, Integer, Float, ForeignKey
+from sqlalchemy import Column, DateTime, String, Integer, Float, ForeignKey, Index, text
 from sqlalchemy.orm import declarative_base, relationship
 
+from app.consts import ORDERS_SINGLE_TABLE
+
 Base = declarative_base()
 
 
@@ -9,7 +11,7 @@ class User(Base):
 
     id = Column(Integer, primary_key=True,  autoincrement=True)
     creation_date = Column(DateTime)
-    api_key = Column(String)
+    api_key = Column(String, index=True)
 
     orders = relationship("BaseOrder", back_populates="user")
     balances = relationship("Balance", back_populates="user")
@@ -30,40 +32,49 @@ class BaseOrder(Base):
     stop_price = Column(Float)
     signal_price = Column(Float)
     blocked_amount = Column(Float)
+    status = Column(String, default='open')  # open, filled or cancelled, see choices.OrderStatus
 
     user_id = Column(Integer, ForeignKey('users.id'))  # Foreign key referencing the User table
     user = relationship("User", back_populates="orders")  # Relationship definition in the Order class
 
+    __table_args__ = (
+        # Only open orders are indexed, listing them is one range scan however long the history grows
+        Index('ix_base_orders_user_id_status', 'user_id', 'status',
+              sqlite_where=text("status = 'open'"), postgresql_where=text("status = 'open'")),
+        # Order listings are paged on (creation_date, id)
+        Index('ix_base_orders_user_id_creation_date_id', 'user_id', 'creation_date', 'id'),
+    )
+    # The columns of every order type are loaded by the query of the base class, not one query per order afterwards
+    __mapper_args__ = {"polymorphic_on": order_type, "with_polymorphic": "*"}
+
 
 class MarketOrder(BaseOrder):
-    __tablename__ = 'market_orders'
-    id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
+    if not ORDERS_SINGLE_TABLE:
+        __tablename__ = 'market_orders'
+        id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
     __mapper_args__ = {"polymorphic_identity": "market"}
 
 
 class LimitOrder(BaseOrder):
-    __tablename__ = 'limit_orders'
-    id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
+    if not ORDERS_SINGLE_TABLE:
+        __tablename__ = 'limit_orders'
+        id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
     __mapper_args__ = {"polymorphic_identity": "limit"}
 
 class OcoOrder(BaseOrder):
-    __tablename__ = 'oco_orders'
-    id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
+    if not ORDERS_SINGLE_TABLE:
+        __tablename__ = 'oco_orders'
+        id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
     bounded_order_id = Column(Integer)  # Specific to OCO orders
     __mapper_args__ = {"polymorphic_identity": "oco"}
 
 class StopLimitOrder(BaseOrder):
-    __tablename__ = 'stop_limit_orders'
-    id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
+    if not ORDERS_SINGLE_TABLE:
+        __tablename__ = 'stop_limit_orders'
+        id = Column(Integer, ForeignKey('base_orders.id'), primary_key=True)
     __mapper_args__ = {"polymorphic_identity": "stop_limit"}
 
 
-
-
-    discriminator = Column(String)
-    __mapper_args__ = {"polymorphic_on": discriminator}
-
-
 class Balance(Base):
     __tablename__ = 'balances'
 
@@ -78,6 +89,9 @@ class Balance(Base):
 
 class Kline(Base):
     __tablename__ = 'klines'
+    __table_args__ = (
+        Index('ix_klines_currency_name_timestamp', 'currency_name', 'timestamp', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     currency_name = Column(String)
@@ -88,6 +102,15 @@ class Kline(Base):
     high_price = Column(Float)
     volume = Column(Float)
 
+class JournalCheckpoint(Base):
+    __tablename__ = 'journal_checkpoints'
+
+    name = Column(String, primary_key=True)
+    journal = Column(String)  # file the offset points into, the first file of the journal if unset
+    seq = Column(Integer)  # last event applied to the tables
+    offset = Column(Integer)  # journal file position right after that event
+    last_order_id = Column(Integer)
+
 class ExchangeInstance(Base):
     __tablename__ = 'exchange_instances'
 
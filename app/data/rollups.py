@@ -0,0 +1,110 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+
+def bucket_of(timestamps, seconds: int, origin: int = 0):
+    """
+    Start timestamp of the bucket every timestamp falls into.
+    """
+    return (timestamps - origin) // seconds * seconds + origin
+
+
+def rollup(columns: Dict[str, np.ndarray], seconds: int, origin: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Aggregate base klines into buckets of ``seconds``.
+
+    Parameters:
+        columns (dict): Base columns as stored by the KlineStore, timestamps sorted ascending.
+        seconds (int): Length of a bucket.
+        origin (int): Epoch seconds the buckets are aligned to.
+
+    Returns:
+        dict: One OHLCV row per non-empty bucket, timestamped with the bucket start.
+    """
+    timestamps = np.asarray(columns['timestamps'])
+    if not len(timestamps):
+        return {name: np.asarray(values)[:0] for name, values in columns.items()}
+
+    buckets = bucket_of(timestamps, seconds, origin)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.concatenate((starts[1:], [len(buckets)])) - 1
+
+    return {
+        'timestamps': buckets[starts],
+        'open': np.asarray(columns['open'])[starts],
+        'high': np.maximum.reduceat(columns['high'], starts),
+        'low': np.minimum.reduceat(columns['low'], starts),
+        'close': np.asarray(columns['close'])[ends],
+        'volume': np.add.reduceat(columns['volume'], starts),
+    }
+
+
+def extend_rollup(rolled: Dict[str, np.ndarray], columns: Dict[str, np.ndarray], seconds: int,
+                  origin: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Extend an existing rollup with base klines newer than the ones it was built from.
+
+    Only the new klines are aggregated. When they continue the last, still open bucket of the
+    rollup that bucket is merged with their first one instead of being recomputed.
+
+    Returns:
+        dict: The extended rollup columns.
+    """
+    added = rollup(columns, seconds, origin)
+    if not len(added['timestamps']):
+        return rolled
+    if not len(rolled['timestamps']):
+        return added
+
+    if rolled['timestamps'][-1] == added['timestamps'][0]:
+        merged = {
+            'timestamps': rolled['timestamps'][-1:],
+            'open': rolled['open'][-1:],
+            'high': np.maximum(rolled['high'][-1:], added['high'][:1]),
+            'low': np.minimum(rolled['low'][-1:], added['low'][:1]),
+            'close': added['close'][:1],
+            'volume': rolled['volume'][-1:] + added['volume'][:1],
+        }
+        return {name: np.concatenate((rolled[name][:-1], merged[name], added[name][1:])) for name in rolled}
+
+    return {name: np.concatenate((rolled[name], added[name])) for name in rolled}
+
+
+class PartialBar:
+    """
+    Bar of a higher timeframe whose bucket is still open.
+
+    Every base kline is folded in with ``update`` in constant time, a kline of the next bucket
+    starts the bar over.
+    """
+
+    __slots__ = ('seconds', 'origin', 'timestamp', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, seconds: int, origin: int = 0):
+        self.seconds = seconds
+        self.origin = origin
+        self.timestamp: Optional[int] = None
+        self.open = self.high = self.low = self.close = self.volume = 0.0
+
+    def update(self, timestamp: int, open: float, high: float, low: float, close: float, volume: float):
+        bucket = bucket_of(timestamp, self.seconds, self.origin)
+        if bucket != self.timestamp:
+            self.timestamp = bucket
+            self.open, self.high, self.low, self.close, self.volume = open, high, low, close, volume
+            return
+
+        self.high = max(self.high, high)
+        self.low = min(self.low, low)
+        self.close = close
+        self.volume += volume
+
+    def to_dict(self) -> dict:
+        return {
+            'timestamp': self.timestamp,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume,
+        }
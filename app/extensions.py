@@ -1,5 +1,6 @@
+from app.playground.backtest import BacktestJobs
 from app.playground.exchanges_manager import ExchangesManager
-from app.data.db import initialize_database
 
 exchanges_manager = ExchangesManager()
+backtest_jobs = BacktestJobs()
 
@@ -1,10 +1,106 @@
-from fastapi import FastAPI
-from app.routers import auth, exchange_management, trade_management
+import asyncio
+import time
+from contextlib import asynccontextmanager
 
-# if __name__ == 'app.__main__':
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from app.consts import SHARDING_ENABLED, STARTUP_IN_BACKGROUND, STARTUP_TARGET_SECONDS
+from app.data.db import get_async_engine, initialize_data, initialize_database
+from app.extensions import exchanges_manager
+from app.playground.sharding import FORWARDED_HEADER
+from app.routers import auth, backtesting, exchange_management, market_data, trade_management
+from app.routers.mics import resolve_api_key
+from app.utils.logger import configure_logging, logger
+from app.utils.metrics import CONTENT_TYPE, metrics, monitor_loop_lag
 
-app = FastAPI()
+
+async def load_market_data(app: FastAPI, started: float):
+    """
+    Ingest the kline CSVs missing from the database off the event loop and mark the app ready.
+    """
+    try:
+        await asyncio.to_thread(initialize_data)
+    except Exception as e:
+        logger.exception("Loading market data failed: %s", e)
+        app.state.startup_error = repr(e)
+        return
+
+    app.state.startup_seconds = time.perf_counter() - started
+    app.state.ready = True
+    if app.state.startup_seconds > STARTUP_TARGET_SECONDS:
+        logger.warning("Startup took %.2fs, the target is %ss", app.state.startup_seconds, STARTUP_TARGET_SECONDS)
+    else:
+        logger.info("Startup took %.2fs", app.state.startup_seconds)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Prepare the database and market data on startup and release every resource on shutdown.
+
+    The schema is always set up before the first request is served. With ``STARTUP_IN_BACKGROUND``
+    the kline CSVs are loaded while requests are already served, ``/ready`` reports when they are.
+    """
+    started = time.perf_counter()
+    configure_logging()
+    app.state.ready = False
+    app.state.startup_seconds = None
+    app.state.startup_error = None
+
+    await asyncio.to_thread(initialize_database)
+    loop = asyncio.get_running_loop()
+    if STARTUP_IN_BACKGROUND:
+        app.state.market_data_task = loop.create_task(load_market_data(app, started))
+    else:
+        await load_market_data(app, started)
+    app.state.loop_lag_monitor = loop.create_task(monitor_loop_lag())
+    if SHARDING_ENABLED:
+        await exchanges_manager.join_shards(app)
+
+    yield
+
+    app.state.loop_lag_monitor.cancel()
+    await exchanges_manager.shutdown()
+    await get_async_engine().dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(auth.router, prefix="/auth")
 app.include_router(exchange_management.router, prefix="/playground/exchange")
 app.include_router(trade_management.router, prefix="/playground/exchange/trade")
+app.include_router(market_data.router, prefix="/playground/market")
+app.include_router(backtesting.router, prefix="/playground/backtest")
+
+# Routes served by the shard owning the user's exchange
+SHARDED_PATHS = ("/playground/exchange", "/playground/market/current_kline")
+
+
+@app.middleware("http")
+async def route_to_shard(request: Request, call_next):
+    shards = exchanges_manager.shards
+    if shards is None or FORWARDED_HEADER in request.headers or not request.url.path.startswith(SHARDED_PATHS):
+        return await call_next(request)
+
+    user = await resolve_api_key(request.query_params.get("api_key", ""))
+    slot = shards.owner(user.id) if user else None
+    if slot is None:
+        return await call_next(request)
+    return await shards.forward(slot, request)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Metrics of this process in the Prometheus text format, every shard worker serves its own.
+    """
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/ready")
+async def get_readiness():
+    """
+    Whether the market data is loaded, answered with 503 until it is.
+    """
+    body = {'ready': app.state.ready, 'startup_seconds': app.state.startup_seconds, 'error': app.state.startup_error}
+    return JSONResponse(body, status_code=200 if app.state.ready else 503)
@@ -0,0 +1,156 @@
+import asyncio
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.consts import BACKTEST_JOBS_SIZE, BACKTEST_JOBS_TTL, DEFAULT_COMISSION
+from app.data.kline_store import kline_store
+from app.playground.exchange import fill_deltas
+from app.playground.journal import EventJournal
+from app.playground.ledger import LedgerStore, reserved_asset
+from app.playground.matching import MatchingEngine
+from app.playground.orders import OrderRecord
+from app.utils.cache import MISSING, TTLCache
+from app.utils.logger import logger
+
+
+@dataclass
+class BacktestResult:
+    fills: List[dict] = field(default_factory=list)
+    cancelled: List[int] = field(default_factory=list)
+    balances: Dict[str, float] = field(default_factory=dict)
+    equity_curve: List[Tuple[int, float]] = field(default_factory=list)
+    bars: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def bars_per_second(self) -> float:
+        return self.bars / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), 'bars_per_second': self.bars_per_second}
+
+
+def run_backtest(orders: Iterable[OrderRecord], balances: Dict[str, float], start: int, end: int,
+                 commission: float = DEFAULT_COMISSION) -> BacktestResult:
+    """
+    Replay historical klines over a set of orders without waiting between bars.
+
+    Orders are matched by the MatchingEngine of a running DemoExchange and settled in a
+    BalanceLedger the same way, so funds blocked by the orders stay reserved until they fill or
+    are cancelled. The equity curve values every asset that has klines at its last close, an
+    asset whose first bar in the window is still ahead at the close before the window or else at
+    the open of that first bar. All other assets count at face value.
+
+    Parameters:
+        orders (Iterable[OrderRecord]): Open orders to rest before the first bar, with their blocked amounts.
+        balances (dict): Initial amount of every asset, including the funds the orders block.
+        start (int): Epoch seconds of the first kline to replay.
+        end (int): Epoch seconds of the last kline to replay.
+        commission (float): Commission applied to every fill.
+
+    Returns:
+        BacktestResult: Fills, final balances, the equity curve and the replay throughput.
+    """
+    started = time.perf_counter()
+    orders = sorted(orders, key=lambda order: order.id)
+    owners = list({order.user_id for order in orders})
+    # Nothing is journaled, the ledger of a backtest only lives in memory
+    ledger = LedgerStore(EventJournal(path=None)).restore(owners[0] if owners else 0, balances, orders)
+    result = BacktestResult(balances=ledger.balances())
+
+    matching_engines: Dict[str, MatchingEngine] = {}
+    for order in orders:
+        if order.target_asset not in matching_engines:
+            matching_engines[order.target_asset] = MatchingEngine(order.target_asset)
+        matching_engines[order.target_asset].add(order)
+
+    windows = {}
+    for asset in matching_engines:
+        series = kline_store.get(asset)
+        if series is None:
+            continue
+        first, last = series.index_of(start), int(np.searchsorted(series.timestamps, end, side='right'))
+        if first < last:
+            windows[asset] = (series, first, last)
+
+    if not windows:
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    timeline = np.unique(np.concatenate([series.timestamps[first:last] for series, first, last in windows.values()]))
+    cursors = {asset: first for asset, (_, first, _) in windows.items()}
+    closes = {asset: float(series.close[first - 1] if first else series.open[first])
+              for asset, (series, first, _) in windows.items()}
+
+    for timestamp in timeline.tolist():
+        for asset, (series, _, last) in windows.items():
+            index = cursors[asset]
+            if index >= last or series.timestamps[index] != timestamp:
+                continue
+            cursors[asset] = index + 1
+            closes[asset] = float(series.close[index])
+
+            matched = matching_engines[asset].match(float(series.open[index]), float(series.low[index]),
+                                                    float(series.high[index]), owners)
+            for fills, cancelled, _ in matched.values():
+                for order, price in fills:
+                    deltas = fill_deltas(order, price, commission)
+                    if not ledger.covers(order, deltas):
+                        cancelled.append(order)
+                        continue
+                    ledger.settle(order, deltas)
+                    result.fills.append({'order_id': order.id, 'timestamp': timestamp, 'asset': asset,
+                                         'direction': order.direction, 'quantity': order.quantity, 'price': price})
+                for order in cancelled:
+                    if order.blocked_amount:
+                        ledger.release(reserved_asset(order), order.blocked_amount)
+                    result.cancelled.append(order.id)
+
+        equity = sum(entry.amount * closes.get(asset_name, 1.0)
+                     for asset_name, entry in ledger.entries.items())
+        result.equity_curve.append((timestamp, equity))
+
+    result.balances = ledger.balances()
+    result.bars = len(timeline)
+    result.elapsed = time.perf_counter() - started
+    logger.info("Backtest replayed %d bars in %.3fs (%.0f bars/s)", result.bars, result.elapsed, result.bars_per_second)
+    return result
+
+
+class BacktestJobs:
+    """
+    Runs backtests off the event loop and keeps their results for a while by job id.
+    """
+
+    def __init__(self, maxsize: int = BACKTEST_JOBS_SIZE, ttl: float = BACKTEST_JOBS_TTL):
+        self.jobs = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.tasks = set()
+
+    def submit(self, user_id: int, orders: List[OrderRecord], balances: Dict[str, float], start: int, end: int,
+               commission: float = DEFAULT_COMISSION) -> str:
+        job_id = uuid.uuid4().hex
+        job = {'user_id': user_id, 'status': 'running', 'result': None, 'error': None}
+        self.jobs.set(job_id, job)
+
+        task = asyncio.get_running_loop().create_task(self.__run(job_id, job, orders, balances, start, end, commission))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job_id
+
+    def get(self, user_id: int, job_id: str) -> Optional[dict]:
+        job = self.jobs.get(job_id)
+        if job is MISSING or job['user_id'] != user_id:
+            return None
+        return job
+
+    async def __run(self, job_id: str, job: dict, orders, balances, start, end, commission):
+        try:
+            result = await asyncio.to_thread(run_backtest, orders, balances, start, end, commission)
+            job.update(status='finished', result=result.to_dict())
+        except Exception as e:
+            logger.exception("Backtest %s failed: %s", job_id, e)
+            job.update(status='failed', error=str(e))
@@ -0,0 +1,90 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, Optional, Set, Union
+
+from app.consts import SUBSCRIPTION_QUEUE_SIZE
+from app.utils.logger import logger
+
+
+class Subscription:
+    """
+    Bounded queue of serialized messages waiting to be sent to one WebSocket connection.
+
+    Once the queue is full the subscription is marked as overflowed instead of blocking the
+    publisher, its consumer is expected to close the connection and let the client resync.
+    """
+
+    def __init__(self, user_id: int, maxsize: int = SUBSCRIPTION_QUEUE_SIZE):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def put(self, message: str):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            logger.warning("Subscription of user %s overflowed, dropping it", self.user_id)
+
+    async def get(self) -> Optional[str]:
+        """
+        Wait for the next message.
+
+        Returns:
+            str: The message or None once the subscription overflowed.
+        """
+        if self.overflowed:
+            return None
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """
+    Fans exchange updates out to the WebSocket subscriptions of their user.
+
+    Payloads are serialized once per publish however many connections receive them, and a
+    serialized string can be published to several users as is. Publishing never waits for a
+    consumer, so slow connections cannot stall the tick loop.
+    """
+
+    def __init__(self):
+        self.subscriptions: Dict[int, Set[Subscription]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id)
+        self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self.subscriptions[subscription.user_id]
+
+    def has_subscribers(self, user_id: int) -> bool:
+        return user_id in self.subscriptions
+
+    def publish(self, user_id: int, message: Union[str, dict]):
+        """
+        Queue a message for every subscription of a user.
+
+        Parameters:
+            user_id (int): Receiver of the message.
+            message (str | dict): Payload, dicts are serialized to JSON once.
+        """
+        subscriptions = self.subscriptions.get(user_id)
+        if not subscriptions:
+            return
+
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        for subscription in subscriptions:
+            subscription.put(message)
@@ -1,16 +1,50 @@
 import asyncio
+import os
 from datetime import datetime
-from typing import List, Tuple, Union
-
-from app.data.choices import BUY, SELL
-from app.data.db import get_session
-from app.data.models import Balance, BaseOrder, Kline, User
-from app.utils.logger import logger
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from sqlalchemy import select
+
+from app.consts import KLINE_INTERVAL, KLINE_TIMEFRAME_ORIGINS, KLINE_TIMEFRAMES, MARKET_ORDER_SLIPPAGE
+from app.data.choices import BUY, CANCELLED, FILLED, MARKET, OPEN, SELL
+from app.data.db import get_async_session
+from app.data.kline_store import kline_store
+from app.data.models import Balance, BaseOrder, User
+from app.data.rollups import PartialBar, bucket_of
+from app.playground.broadcaster import Broadcaster
+from app.playground.journal import (BALANCE_DELTA, ORDER_CANCELLED, ORDER_FILLED, ORDER_PLACED, ORDER_TRIGGERED,
+                                   EventJournal)
+from app.playground.ledger import BalanceLedger, LedgerStore, reserved_asset
+from app.playground.matching import MatchingEngine, match_exchanges, tick_exchanges
+from app.playground.orders import OrderRecord
+from app.playground.snapshot import ExchangeSnapshot
+from app.utils.logger import get_logger
 from app.data.choices import AssetType, TransactionType
 
 
+logger = get_logger('exchange')
+
+
+def fill_deltas(order: OrderRecord, price: float, commission: float) -> Dict[str, float]:
+    """
+    Balance changes caused by filling an order at the given price.
+
+    Returns:
+        dict: Amount added to each asset balance, negative amounts are withdrawn.
+    """
+    if order.direction == BUY:
+        return {order.base_asset: -order.quantity * price * (1 + commission), order.target_asset: order.quantity}
+    if order.direction == SELL:
+        return {order.target_asset: -order.quantity, order.base_asset: order.quantity * price * (1 - commission)}
+    return {}
+
+
 class DemoExchange:
-    def __init__(self, user_id: int, multiplier: float = 1, commission: float = 0.1, last_used_timestamp: int = None):
+    def __init__(self, user_id: int, multiplier: float = 1, commission: float = 0.1, last_used_timestamp: int = None,
+                 matching_engines: Dict[str, MatchingEngine] = None, broadcaster: Broadcaster = None,
+                 ledgers: LedgerStore = None):
         self.user_id = user_id
         self.is_running = False
         self.last_activity = datetime.now()
@@ -18,7 +52,16 @@ class DemoExchange:
         self.commission = commission
         self.current_time = last_used_timestamp
         self.lock = asyncio.Lock() 
-        self.update_data_event = asyncio.Event()
+        # Shared with every other exchange of the manager, so users on the same bar are matched together
+        self.matching_engines = matching_engines if matching_engines is not None else {}
+        self.assets: Set[str] = set()
+        self.broadcaster = broadcaster
+        self.ledgers = ledgers if ledgers is not None else LedgerStore(EventJournal(path=None))
+        self.journal = self.ledgers.journal
+        self.ledger: Optional[BalanceLedger] = None
+        self.cursors: Dict[str, int] = {}
+        self.current_bars: Dict[str, int] = {}
+        self.partial_bars: Dict[Tuple[str, str], PartialBar] = {}
 
 
     @property
@@ -28,7 +71,7 @@ class DemoExchange:
     @commission.setter
     def commission(self, value: float):
         self._commission = value
-        logger.info(f"Commission set to {value}")
+        logger.debug("Commission set to %s", value)
 
     @property
     def multiplier(self) -> float:
@@ -38,162 +81,467 @@ class DemoExchange:
     def multiplier(self, value: float):
         self._multiplier = value
 
-    def place_order(self, user: User,  order: BaseOrder) -> dict:
+    async def place_order(self, user: User,  order: OrderRecord) -> dict:
         """
         Place an order in the session and commit it to the database.
 
         Parameters:
-            order (BaseOrder): The order to be placed.
+            order (OrderRecord): The order to be placed.
 
         Returns:
             dict: A message confirming the order placement.
         """
+        [(_, message)] = await self.place_orders(user, [order], all_or_nothing=True)
+        return message
+
+    async def place_orders(self, user: User, orders: List[OrderRecord], all_or_nothing: bool = False) -> List[Tuple[bool, dict]]:
+        """
+        Place several orders with one balance read and one journal sync.
+
+        The funds every order needs are reserved in its ``blocked_amount`` against a running
+        balance per asset, so the orders of a batch cannot spend the same funds twice.
 
-        order_is_placed, message = self.__place_order(user, order)
+        Parameters:
+            orders (List[OrderRecord]): The orders to be placed, in priority order.
+            all_or_nothing (bool): Reject the whole batch if any order cannot be placed,
+                otherwise place every order that can be funded.
 
+        Returns:
+            list: Whether each order was placed and a message about it, in the order of ``orders``.
+        """
+        order_is_placed, results = await self.__place_orders(user, orders, all_or_nothing)
         if not order_is_placed:
-            return message
+            return results
 
-        return {"message": f"Order placed: {order.id}"}
+        for order in orders:
+            if order.id is not None:
+                await self.__rest(order)
 
+        return results
 
-    def get_order_by_id(self, user_id, order_id: int=None) -> Tuple[Union[List[BaseOrder], BaseOrder, None], dict]:
-        session = get_session()
+    async def replay(self, events: List[dict]) -> Dict[str, float]:
+        """
+        Apply journaled events of the user to the matching engines.
 
-        if not order_id:
-            orders = session.query(BaseOrder).filter_by(user_id=user_id)
-            return orders, {'message': f"Retrieved all orders"}
+        Placed orders are put into the engines, filled and cancelled ones taken out and
+        triggered stop-limit orders rest as limit orders afterwards.
 
-        order = session.query(BaseOrder).filter_by(user_id=user_id, id=order_id).first()
-        if not order:
-            logger.warning(f"No order found with ID: {order_id}")
-            return None, {'message': f"No order found with ID: {order_id}"}
-        logger.info(f"Retrieved order by ID: {order.__dict__}")
-        return order, {}
+        Returns:
+            dict: The sum of the balance deltas of the events per asset.
+        """
+        deltas = defaultdict(float)
+        for event in events:
+            if event['type'] == ORDER_PLACED:
+                order = OrderRecord.from_fields(event['order'])
+                if not any(order.id in engine for engine in self.matching_engines.values()):
+                    await self.__rest(order)
+            elif event['type'] in (ORDER_FILLED, ORDER_CANCELLED, ORDER_TRIGGERED):
+                order = self.__unrest(event['order_id'])
+                if order is not None and event['type'] == ORDER_TRIGGERED:
+                    await self.__rest(order, triggered=True)
+            elif event['type'] == BALANCE_DELTA:
+                for asset, delta in event['deltas'].items():
+                    deltas[asset] += delta
+        return deltas
+
+    async def restore_orders(self, orders: List[OrderRecord]):
+        """
+        Put orders read from the tables back into the matching engines, for a user without a snapshot.
 
+        The tables do not record triggers, a triggered stop-limit order rests untriggered unless the
+        journal still holds its trigger event.
+        """
+        for order in sorted(orders, key=lambda order: order.id):
+            if not any(order.id in engine for engine in self.matching_engines.values()):
+                await self.__rest(order)
 
-    def cancel_order_by_id(self, order_id: int) -> Tuple[bool, dict]:
-        session = get_session()
-        order = session.query(BaseOrder).filter_by(id=order_id).first()
-        if not order:
-            session.delete(order)
-            session.commit()
-            logger.warning(f"No order found with ID: {order_id}")
+    def snapshot(self, orders: List[Tuple[OrderRecord, bool]] = None) -> ExchangeSnapshot:
+        """
+        State of the exchange together with the position in the journal it covers.
 
-            logger.info(f"Order canceled with ID: {order_id}")
-            return False, {'message': f"No order found with ID: {order_id}"}
-        return True, {'message': f"Cancelled order with ID: {order_id}"}
+        Parameters:
+            orders (list): Orders with their trigger state, the ones resting in the matching engines by default.
+        """
+        if orders is None:
+            orders = [resting for engine in self.matching_engines.values() for resting in engine.resting_orders(self.user_id)]
+        balances = None
+        if self.ledger is not None:
+            balances = {asset: (entry.free, entry.reserved) for asset, entry in self.ledger.entries.items()}
+        journal = os.path.basename(self.journal.path) if self.journal.path else None
+        return ExchangeSnapshot(self.user_id, self.current_time, self.multiplier, self.commission,
+                                dict(self.cursors), orders, balances, journal, self.journal.offset, self.journal.seq)
+
+    def hibernate(self) -> ExchangeSnapshot:
+        """
+        Stop the exchange and take its orders out of the matching engines.
+
+        Returns:
+            ExchangeSnapshot: Everything needed to resume the exchange where it stopped.
+        """
+        self.stop()
+        return self.snapshot([popped for engine in self.matching_engines.values() for popped in engine.pop_orders(self.user_id)])
+
+    @classmethod
+    async def resume(cls, snapshot: ExchangeSnapshot, events: List[dict] = (), matching_engines: Dict[str, MatchingEngine] = None,
+                     broadcaster: Broadcaster = None, ledgers: LedgerStore = None) -> 'DemoExchange':
+        """
+        Rebuild an exchange from its snapshot and the events the user journaled after it, without querying the database.
+        """
+        exchange = cls(user_id=snapshot.user_id, multiplier=snapshot.multiplier, commission=snapshot.commission,
+                       last_used_timestamp=snapshot.current_time, matching_engines=matching_engines,
+                       broadcaster=broadcaster, ledgers=ledgers)
+        exchange.cursors = dict(snapshot.cursors)
+        for asset in snapshot.cursors:
+            await asyncio.to_thread(kline_store.get, asset)
+            exchange.assets.add(asset)
+
+        for order, triggered in sorted(snapshot.orders, key=lambda item: item[0].id):
+            await exchange.__rest(order, triggered)
+        deltas = await exchange.replay(events)
+
+        if snapshot.balances is not None:
+            amounts = defaultdict(float, {asset: free + reserved for asset, (free, reserved) in snapshot.balances.items()})
+            for asset, delta in deltas.items():
+                amounts[asset] += delta
+            exchange.ledger = exchange.ledgers.restore(snapshot.user_id, amounts, exchange.__resting_orders())
+        return exchange
+
+    async def load_ledger(self) -> BalanceLedger:
+        """
+        Load the balance ledger of the user once, reserving the funds of their orders still resting in the matching engines.
+        """
+        if self.ledger is None:
+            self.ledger = await self.ledgers.load(self.user_id, self.__resting_orders())
+        return self.ledger
+
+    async def get_order_by_id(self, user_id, order_id: int=None,
+                              status: Optional[str] = None) -> Tuple[Union[List[OrderRecord], OrderRecord, None], dict]:
+        if not order_id:
+            return await self.get_orders_by_user_id(user_id, status), {'message': f"Retrieved all orders"}
 
-    def get_orders_by_user_id(self, user_id: int) -> List[BaseOrder]:
-        session = get_session()
+        async with get_async_session() as session:
+            order = await session.scalar(select(BaseOrder).filter_by(user_id=user_id, id=order_id))
 
-        user_orders = session.query(BaseOrder).filter_by(id=user_id).all()
-        logger.info(f"Retrieved orders by user ID: {user_id}")
-        return user_orders
+        if not order:
+            logger.warning("No order found with ID: %s", order_id)
+            return None, {'message': f"No order found with ID: {order_id}"}
+        logger.info("Retrieved order by ID: %s", order_id)
+        return OrderRecord.from_model(order), {}
+
+
+    async def cancel_order_by_id(self, order_id: int) -> Tuple[bool, dict]:
+        order_id = int(order_id)
+        engine = self.__engine_of(order_id)
+        if engine is None:
+            logger.warning("No open order found with ID: %s", order_id)
+            return False, {'message': f"No open order found with ID: {order_id}"}
+
+        order = engine.remove(order_id)
+        order.status = CANCELLED
+        if order.blocked_amount:
+            ledger = await self.load_ledger()
+            ledger.release(reserved_asset(order), order.blocked_amount)
+        await self.journal.sync(self.journal.append(ORDER_CANCELLED, self.user_id, order_id=order_id,
+                                                    order_type=order.order_type))
+
+        logger.info("Order canceled with ID: %s", order_id)
+        return True, {'message': f"Cancelled order with ID: {order_id}"}
 
-    def get_balance(self, user_id: int, asset_name: Union[str, None] = None) -> Tuple[Union[float, dict, None], dict]:
-        session = get_session()
+    async def get_orders_by_user_id(self, user_id: int, status: Optional[str] = None) -> List[OrderRecord]:
+        """
+        Orders of the user as projected to the tables, only the ones with the given status if set.
 
-        if not asset_name:
-            balance_entries = session.query(Balance).filter_by(user_id=user_id).all()
-            balances = {entry.asset_name: entry.amount for entry in balance_entries}
-            logger.info(f"Retrieved all balances for user ID {user_id}")
-            return balances, {}
+        Open orders are read with one range scan of the (user_id, status) index.
+        """
+        query = select(BaseOrder).filter_by(user_id=user_id)
+        if status is not None:
+            query = query.filter_by(status=status)
+        async with get_async_session() as session:
+            user_orders = (await session.scalars(query)).all()
+        logger.info("Retrieved orders by user ID: %s", user_id)
+        return [OrderRecord.from_model(order) for order in user_orders]
+
+    async def get_balance(self, user_id: int, asset_name: Union[str, None] = None) -> Tuple[Union[float, dict, None], dict]:
+        if self.ledger is not None and user_id == self.user_id:
+            if not asset_name:
+                return self.ledger.balances(), {}
+            if asset_name in self.ledger.entries:
+                return self.ledger.entries[asset_name].amount, {}
+            logger.warning("No balance found for user ID %s and asset %s", user_id, asset_name)
+            return None, {'message': f'No balance found for user ID {user_id} and asset {asset_name}'}
 
-        balance_entry = session.query(Balance).filter_by(id=user_id, asset_name=asset_name).first()
+        async with get_async_session() as session:
+            if not asset_name:
+                balance_entries = await session.scalars(select(Balance).filter_by(user_id=user_id))
+                balances = {entry.asset_name: entry.amount for entry in balance_entries}
+                logger.info("Retrieved all balances for user ID %s", user_id)
+                return balances, {}
+
+            balance_entry = await session.scalar(select(Balance).filter_by(user_id=user_id, asset_name=asset_name))
 
         if not balance_entry:
-            logger.warning(f"No balance found for user ID {user_id} and asset {asset_name}")
+            logger.warning("No balance found for user ID %s and asset %s", user_id, asset_name)
             return None, {'message': f'No balance found for user ID {user_id} and asset {asset_name}'}
         
         return balance_entry.amount, {}
 
-    async def data_updater(self):
+    def current_kline(self, asset: str, timeframe: str) -> Optional[dict]:
         """
-        Updates data at specified intervals.
+        The bar of the given timeframe the exchange clock is currently in.
+
+        A bar whose bucket is still open only covers the klines up to the current time. It is
+        assembled from the klines of its bucket on first request and afterwards kept up to date
+        by every tick.
+
+        Returns:
+            dict: The bar or None if the exchange has not reached a kline of the asset yet or
+            the timeframe is finer than the klines.
         """
-        while self.is_running:
-            await asyncio.sleep(1 / self.multiplier)
-            async with self.lock:
-                session = get_session()
-                self.current_time = datetime.now()
-                self.current_time += 1
-                self.last_activity = datetime.now()
-                self.update_data_event.set()
-            logger.info(f"Fetched data for user {self.user_id}, current time: {self.current_time}")
+        series = kline_store.get(asset)
+        cursor = self.cursors.get(asset)
+        if series is None or not cursor or KLINE_TIMEFRAMES[timeframe] < KLINE_INTERVAL:
+            return None
+
+        key = (asset, timeframe)
+        if key not in self.partial_bars:
+            bar = PartialBar(KLINE_TIMEFRAMES[timeframe], KLINE_TIMEFRAME_ORIGINS.get(timeframe, 0))
+            start = series.index_of(bucket_of(int(series.timestamps[cursor - 1]), bar.seconds, bar.origin))
+            for index in range(start, cursor):
+                bar.update(int(series.timestamps[index]), float(series.open[index]), float(series.high[index]),
+                           float(series.low[index]), float(series.close[index]), float(series.volume[index]))
+            self.partial_bars[key] = bar
+
+        return self.partial_bars[key].to_dict()
 
-    async def order_resolver(self):
+    @property
+    def tick_interval(self) -> float:
+        """Wall-clock seconds between two klines."""
+        return 1 / self.multiplier
+
+    async def tick(self, bars: int = 1):
         """
-        Resolves orders based on updated data.
+        Advances the exchange by the given number of klines and resolves orders after each of them.
+
+        Running exchanges are ticked in batches by the scheduler of the ExchangesManager instead.
         """
-        while self.is_running:
-            await self.update_data_event.wait()
-            async with self.lock:
-                self.update_data_event.clear()
-                self.resolve_orders()
-                self.last_activity = datetime.now()
-                logger.info(f"Resolved orders for user {self.user_id}, current time: {self.current_time}")
+        await tick_exchanges([(self, bars)], self.matching_engines, self.broadcaster)
 
-    def resolve_orders(self):
+    async def resolve_orders(self):
         """
-        Resolves orders based on updated data for the stored user ID.
+        Resolves the orders of the stored user ID against the klines of the current time.
         """
-        # Logic to manage orders after data update
-        pass
+        fills, cancelled, triggered = match_exchanges([self], self.matching_engines).get(self, ([], [], []))
+        if fills or cancelled or triggered:
+            await self.apply_fills(fills, cancelled, triggered)
+
+    async def apply_fills(self, fills: List[Tuple[OrderRecord, float]], cancelled: List[OrderRecord],
+                          triggered: List[OrderRecord] = ()):
+        """
+        Applies matched orders to the balance ledger of the user and records them in the journal.
+
+        Nothing is written to the tables here, the orders and balances tables are projected from
+        the journal events in the background.
+
+        Args:
+        - fills (list): Filled orders with the price they were filled at.
+        - cancelled (list): Orders cancelled by the fill of their OCO sibling. Fills the reserved and
+          free funds cannot pay for are cancelled the same way instead.
+        - triggered (list): Stop-limit orders whose stop was reached, they now rest as limit orders.
+        """
+        ledger = await self.load_ledger()
+        touched = set()
+        settled, cancelled = [], list(cancelled)
+
+        for order, price in fills:
+            deltas = fill_deltas(order, price, self.commission)
+            if not ledger.covers(order, deltas):
+                # A market buy reserved at an estimated price and the bar opened further away
+                logger.warning("Fill of order %s at %s refused for user %s, its funds do not cover it", order.id, price, self.user_id)
+                cancelled.append(order)
+                continue
+            settled.append((order, price))
+            order.status = FILLED
+            self.journal.append(ORDER_FILLED, self.user_id, order_id=order.id, price=price, timestamp=self.current_time)
+            ledger.settle(order, deltas)
+            touched.update(deltas)
+            logger.info("Order %s executed at %s for user %s", order.id, price, self.user_id)
+
+        for order in cancelled:
+            order.status = CANCELLED
+            if order.blocked_amount:
+                ledger.release(reserved_asset(order), order.blocked_amount)
+                touched.add(reserved_asset(order))
+            self.journal.append(ORDER_CANCELLED, self.user_id, order_id=order.id, order_type=order.order_type)
+
+        for order in triggered:
+            self.journal.append(ORDER_TRIGGERED, self.user_id, order_id=order.id, timestamp=self.current_time)
+
+        if self.broadcaster is not None and self.broadcaster.has_subscribers(self.user_id):
+            for order, price in settled:
+                self.broadcaster.publish(self.user_id, {'type': 'fill', 'order_id': order.id, 'asset': order.target_asset,
+                                                        'direction': order.direction, 'quantity': order.quantity,
+                                                        'price': price, 'timestamp': self.current_time})
+            for order in cancelled:
+                self.broadcaster.publish(self.user_id, {'type': 'cancel', 'order_id': order.id, 'timestamp': self.current_time})
+            if touched:
+                self.broadcaster.publish(self.user_id, {'type': 'balance', 'timestamp': self.current_time,
+                                                        'balances': {asset: ledger.entries[asset].to_dict() for asset in touched}})
 
     def start(self):
         """
         Starts the exchange for a specific user.
 
+        The exchange is ticked by the scheduler it is added to.
         """
 
         if not self.is_running:
             self.is_running = True
-            asyncio.create_task(self.data_updater())
-            asyncio.create_task(self.order_resolver())
-            logger.info(f"Exchange started for user {self.user_id}")
+            logger.info("Exchange started for user %s", self.user_id)
 
     def stop(self):
         """Stops the exchange."""
         self.is_running = False
-        logger.info("Exchange stopped")
+        logger.info("Exchange stopped for user %s", self.user_id)
 
 
-    def __place_order(self, user: User, order: BaseOrder) -> bool:
+    async def __place_orders(self, user: User, orders: List[OrderRecord], all_or_nothing: bool) -> Tuple[bool, List[Tuple[bool, dict]]]:
         """
-        Checks whether the transaction can be executed based on the provided balance.
-
-        Args:
-        - balance (float): Current balance.
-        - direction (str): Type of transaction ('BUY' or 'SELL').
-        - quantity (int): Quantity of assets involved in the transaction.
-        - price (float): Price of the asset.
+        Reserves the funds of the orders in the ledger and journals the funded ones with one sync.
 
         Returns:
-        bool: True if the balance after the transaction is positive, False otherwise.
+            tuple: Whether any order was written and the result of every order.
         """
-        target_asset = order.target_asset
-        base_asset = order.base_asset
-
-        user_balance = user.balances[base_asset]
-
-        if order.direction == BUY:
-            balance = user.balances[base_asset] - order.quantity * order.execution_price * (1 + self.commission)
-        elif order.direction == SELL:
-            balance = user.balances[target_asset] - order.quantity
-        
-        if balance < 0:
-            return False, {'message': 'Not enough funds'}
-
-        session = get_session()
-        session.add(order)
-        session.add(user)
-        session.commit()
-
-        logger.info(f"Order placed: {order.id} for user: {user.id}")
+        ledger = await self.load_ledger()
+        accepted, results = [], []
+
+        for order in orders:
+            if order.bounded_order_id is not None and self.__engine_of(order.bounded_order_id) is None:
+                results.append((False, {'message': f"No open order found with ID: {order.bounded_order_id}"}))
+                continue
+
+            if order.direction == BUY and order.order_type == MARKET:
+                # Filled at the next open, not at the client's price, so reserve with a margin over the market
+                price = await self.market_price(order.target_asset)
+                amount = order.quantity * (price or order.execution_price) * (1 + MARKET_ORDER_SLIPPAGE) * (1 + self.commission)
+            elif order.direction == BUY:
+                amount = order.quantity * order.execution_price * (1 + self.commission)
+            else:
+                amount = order.quantity
+
+            if not ledger.reserve(reserved_asset(order), amount):
+                results.append((False, {'message': 'Not enough funds'}))
+                continue
+
+            order.blocked_amount = amount
+            order.user_id = user.id
+            accepted.append(order)
+            results.append((True, None))
+
+        if not accepted or (all_or_nothing and len(accepted) < len(orders)):
+            self.__release(accepted)
+            results = [(False, message or {'message': 'Batch rejected, another order could not be placed'})
+                       for _, message in results]
+            return False, results
+
+        for order in accepted:
+            order.id = self.journal.allocate_order_id()
+            order.status = OPEN
+            self.journal.append(ORDER_PLACED, user.id, order=order.to_fields())
+        await self.journal.sync()
+
+        logger.info("%d of %d orders placed for user: %s", len(accepted), len(orders), user.id)
+
+        placed = iter(accepted)
+        return True, [(True, {'message': f"Order placed: {next(placed).id}"}) if is_placed else (False, message)
+                      for is_placed, message in results]
+
+    async def market_price(self, asset: str) -> Optional[float]:
+        """
+        Close of the last bar of an asset the exchange clock reached, its first open before that.
+        """
+        # Building or mapping the series of a new asset is kept off the event loop
+        series = kline_store.get(asset) if asset in self.assets else await asyncio.to_thread(kline_store.get, asset)
+        if series is None or not len(series):
+            return None
+        if self.current_time is None:
+            return float(series.open[0])
+        index = int(np.searchsorted(series.timestamps, self.current_time, side='right')) - 1
+        return float(series.close[index]) if index >= 0 else float(series.open[0])
+
+    def __engine_of(self, order_id: int) -> Optional[MatchingEngine]:
+        """
+        Matching engine an open order of this user rests in, None for orders of other users.
+        """
+        return next((engine for engine in self.matching_engines.values()
+                     if order_id in engine and engine.orders[order_id].user_id == self.user_id), None)
 
+    async def __rest(self, order: OrderRecord, triggered: bool = False):
+        """
+        Put an order into the matching engine of its asset, creating the engine on first use.
+        """
+        if order.target_asset not in self.assets:
+            # Build or map the kline series off the event loop before the first tick needs it
+            await asyncio.to_thread(kline_store.get, order.target_asset)
+            self.assets.add(order.target_asset)
+        if order.target_asset not in self.matching_engines:
+            self.matching_engines[order.target_asset] = MatchingEngine(order.target_asset)
+        self.matching_engines[order.target_asset].add(order, triggered=triggered)
+
+    def __unrest(self, order_id: int) -> Optional[OrderRecord]:
+        for engine in self.matching_engines.values():
+            order = engine.remove(order_id)
+            if order is not None:
+                return order
+        return None
+
+    def __resting_orders(self) -> List[OrderRecord]:
+        return [order for engine in self.matching_engines.values() for order in engine.orders_of(self.user_id)]
+
+    def __release(self, orders: List[OrderRecord]):
+        for order in orders:
+            self.ledger.release(reserved_asset(order), order.blocked_amount)
+            order.blocked_amount = None
+
+    def advance_clock(self):
+        """
+        Moves the exchange clock one kline forward and points the cursors of the traded assets at its klines.
 
-        return True, {'message': 'order was placed sussessfully'}
+        The clock starts at the first kline of the traded assets. A cursor is resumed with a binary
+        search over the series timestamps and afterwards only moves forward one bar per tick.
+        """
+        self.current_bars = {}
+
+        if self.current_time is None:
+            first_timestamps = [int(series.timestamps[0]) for series in map(kline_store.get, self.assets) if series]
+            if not first_timestamps:
+                return
+            self.current_time = min(first_timestamps)
+        else:
+            self.current_time += KLINE_INTERVAL
+
+        for asset in self.assets:
+            series = kline_store.get(asset)
+            if series is None:
+                continue
+
+            cursor = self.cursors.get(asset)
+            if cursor is None:
+                cursor = series.index_of(self.current_time)
+            while cursor < len(series) and series.timestamps[cursor] < self.current_time:
+                cursor += 1
+
+            if cursor < len(series) and series.timestamps[cursor] == self.current_time:
+                self.current_bars[asset] = cursor
+                cursor += 1
+            self.cursors[asset] = cursor
+
+        for (asset, _), bar in self.partial_bars.items():
+            index = self.current_bars.get(asset)
+            if index is None:
+                continue
+            series = kline_store.get(asset)
+            bar.update(self.current_time, float(series.open[index]), float(series.high[index]),
+                       float(series.low[index]), float(series.close[index]), float(series.volume[index]))
 
 
 
@@ -1,65 +1,235 @@
 import asyncio
+import math
+import os
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional, Tuple
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
 
-from app.consts import DEFAULT_COMISSION, DEFAULT_MULTIPLIER
-from app.data.db import get_session
+from sqlalchemy import select
+
+from app.consts import (DEFAULT_COMISSION, DEFAULT_MULTIPLIER, EXCHANGE_EVICTION_INTERVAL, EXCHANGE_IDLE_TIMEOUT,
+                        JOURNAL_FILE_SIZE, JOURNAL_PATH, MAX_SHARDS, SNAPSHOT_DIRECTORY)
+from app.data.choices import OPEN
+from app.data.db import get_async_session
 from app.data.models import ExchangeInstance, User
+from app.playground.broadcaster import Broadcaster
 from app.playground.exchange import DemoExchange
-from app.utils.logger import logger
+from app.playground.journal import CHECKPOINT_NAME, EventJournal
+from app.playground.ledger import LedgerStore
+from app.playground.matching import MatchingEngine, tick_exchanges
+from app.playground.scheduler import STATS_DOCUMENTATION, TickScheduler
+from app.playground.sharding import HashRing, ShardRegistry
+from app.playground.snapshot import read_snapshot, write_snapshot
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+
+logger = get_logger('exchange')
 
 
 class ExchangesManager:
     def __init__(self):
-        self.exchange_instances: Dict[str, DemoExchange] = {0: DemoExchange(user_id=1)}
+        self.matching_engines: Dict[str, MatchingEngine] = {}
+        self.broadcaster = Broadcaster()
+        self.journal = EventJournal()
+        self.ledgers = LedgerStore(self.journal)
+        self.shards: Optional[ShardRegistry] = None
+        self.snapshot_directory = SNAPSHOT_DIRECTORY
+        self.loading: Dict[int, asyncio.Task] = {}
+        self.hibernations: Dict[int, asyncio.Task] = {}
+        self.eviction_task: Optional[asyncio.Task] = None
+        self.exchange_instances: Dict[int, DemoExchange] = {}
+        self.scheduler = TickScheduler(partial(tick_exchanges, matching_engines=self.matching_engines,
+                                               broadcaster=self.broadcaster))
+
+        metrics.gauge('playground_active_exchanges', 'Exchanges loaded in this process.',
+                      lambda: len(self.exchange_instances))
+        metrics.gauge('playground_resting_orders', 'Orders waiting in the matching engines by order type.',
+                      self.resting_order_counts)
+        for stat, documentation in STATS_DOCUMENTATION.items():
+            metrics.gauge(f'playground_scheduler_{stat}', documentation, partial(self.scheduler_stat, stat))
+
+    def scheduler_stat(self, stat: str) -> float:
+        return self.scheduler.stats()[stat]
+
+    def resting_order_counts(self) -> List[Tuple[Dict[str, str], int]]:
+        counts = Counter()
+        for engine in self.matching_engines.values():
+            counts.update(order.order_type for order in engine.orders.values())
+            for orders in engine.market_orders.values():
+                counts.update(order.order_type for order in orders)
+        return [({'order_type': order_type}, count) for order_type, count in sorted(counts.items())]
 
     async def check_inactive_exchanges(self):
+        """
+        Hibernate the exchanges whose user made no request and has no open WebSocket for ``EXCHANGE_IDLE_TIMEOUT``
+        and move the journal to a new file once it outgrows ``JOURNAL_FILE_SIZE``.
+        """
         while True:
-            await asyncio.sleep(60)  # Check every minute
+            await asyncio.sleep(EXCHANGE_EVICTION_INTERVAL)
+            if self.journal.offset >= JOURNAL_FILE_SIZE:
+                try:
+                    await self.compact_journal()
+                except Exception as e:
+                    logger.exception("Error compacting the journal: %s", e)
+
             current_time = datetime.now()
             for user_id, exchange in list(self.exchange_instances.items()):
-                if (current_time - exchange.last_activity) > timedelta(minutes=5):
-                    exchange.stop()
-                    del self.exchange_instances[user_id]
-                    logger.info(f"Exchange instance for user {user_id} deleted due to inactivity.")
-
-
-    def start_exchange(self, user: User) -> Tuple[DemoExchange, dict]:
+                if self.broadcaster.has_subscribers(exchange.user_id):
+                    continue
+                if (current_time - exchange.last_activity) > timedelta(seconds=EXCHANGE_IDLE_TIMEOUT):
+                    try:
+                        await self.hibernate(user_id)
+                    except Exception as e:
+                        logger.exception("Error hibernating exchange for user %s: %s", user_id, e)
+                        continue
+                    logger.info("Exchange instance for user %s hibernated due to inactivity.", user_id)
+
+    async def join_shards(self, app, registry: ShardRegistry = None):
         """
-        Start a new exchange instance for the user or retrieve an existing one from the database.
+        Become one shard of a multi-process deployment, owning the users the hash ring assigns to this process.
 
-        Parameters:
-            user (User): The user initiating the exchange.
+        The shard writes its own journal and allocates the order ids congruent to its slot, slot 0
+        keeps the journal of a single-process deployment. Call before the first exchange is loaded.
 
-        Returns:
-            dict: A message confirming the exchange start or an error message.
+        Parameters:
+            app: The ASGI app served to the other shards.
+            registry (ShardRegistry): Membership to join, the default one in ``SHARD_DIRECTORY`` if omitted.
         """
-        if user.id in self.exchange_instances:
-            logger.warning(f"Exchange already active for user {user.id}")
-            return self.exchange_instances[user.id], {}
+        self.shards = registry or ShardRegistry()
+        slot = await asyncio.to_thread(self.shards.claim)
 
-        session = get_session()
-        saved_exchange_data = session.query(ExchangeInstance).filter_by(user_id=user.id).first()
+        path = JOURNAL_PATH if slot == 0 else os.path.join(os.path.dirname(JOURNAL_PATH), f'events-{slot}.log')
+        self.journal = EventJournal(path, checkpoint_name=CHECKPOINT_NAME if slot == 0 else f'shard-{slot}',
+                                    id_stride=MAX_SHARDS, id_slot=slot)
+        self.ledgers = LedgerStore(self.journal)
+        await self.shards.start(app, self.rebalance)
 
-        commission = saved_exchange_data.commission if saved_exchange_data else DEFAULT_COMISSION
-        multiplier = saved_exchange_data.multiplier if saved_exchange_data else DEFAULT_MULTIPLIER
-        last_used_timestamp = saved_exchange_data.last_used_timestamp if saved_exchange_data else None
+    async def rebalance(self, ring: HashRing):
+        """
+        Hibernate the exchanges of the users another shard owns now, it resumes them from their snapshots.
+        """
+        for user_id in list(self.exchange_instances):
+            if ring.owner(user_id) == self.shards.slot:
+                continue
+            try:
+                await self.hibernate(user_id)
+            except Exception as e:
+                logger.exception("Error handing over exchange of user %s: %s", user_id, e)
+                continue
+            logger.info("Exchange of user %s handed over to shard %s", user_id, ring.owner(user_id))
+
+    async def shutdown(self):
+        """
+        Hibernate every exchange and close the journal, so the next process or another shard resumes them.
+        """
+        for user_id in list(self.exchange_instances):
+            try:
+                await self.hibernate(user_id)
+            except Exception as e:
+                logger.exception("Error hibernating exchange for user %s: %s", user_id, e)
+        await self.journal.close()
+        if self.shards is not None:
+            await self.shards.close()
+
+    async def hibernate(self, user_id: int):
+        """
+        Evict the exchange of a user from memory, writing its snapshot to be resumed by the next request.
 
+        Parameters:
+            user_id (int): The user whose exchange is evicted.
+        """
+        if user_id in self.hibernations:
+            # Another snapshot of the user is being written, this one has to land after it
+            await asyncio.wait([self.hibernations[user_id]])
+        exchange = self.exchange_instances.pop(user_id, None)
+        if exchange is None:
+            return
+
+        self.scheduler.remove(exchange)
+        snapshot = exchange.hibernate()
+        await self.ledgers.unload(user_id)
+
+        # Requests arriving while the snapshot is written wait for it in get_exchange
+        self.hibernations[user_id] = asyncio.get_running_loop().create_task(
+            asyncio.to_thread(write_snapshot, snapshot, self.snapshot_directory))
         try:
-            self.exchange_instances[user.id] = DemoExchange(commission=commission,
-                                                            multiplier=multiplier,
-                                                            last_used_timestamp=last_used_timestamp,
-                                                            user_id=user.id)
-        except Exception as e:
-            logger.exception(f"Error creating exchange for user: {str(e)}")
-            return None, {"message": f"Error occurred for user {user.id}"}
-
-        return self.exchange_instances[user.id], {}
-
+            # Should the write fail, the previous snapshot and the journal still cover every change
+            await self.hibernations[user_id]
+        finally:
+            del self.hibernations[user_id]
+            if self.shards is not None:
+                # Another shard may resume the exchange from the journal once the lock is released
+                await self.journal.sync()
+                self.shards.unlock_user(user_id)
+
+    async def compact_journal(self):
+        """
+        Continue the journal in a new file and delete the old one, which the tables already hold.
 
-    def get_exchange(self, user: User) -> DemoExchange:
+        Snapshots pointing into the old file are moved to the new one first: loaded exchanges write
+        their current state and hibernated ones are resumed off the shared matching engines with
+        their events from the old file. Users without a snapshot are restored from the tables.
         """
-        Retrieve an existing exchange instance for the user from the database.
+        name, user_ids = await self.journal.rotate()
+        moved = True
+        for user_id in user_ids:
+            # Loads and hibernations wait for the move, and the move for the ones already running
+            while user_id in self.loading or user_id in self.hibernations:
+                await asyncio.wait([self.loading.get(user_id) or self.hibernations[user_id]])
+            self.hibernations[user_id] = asyncio.get_running_loop().create_task(self.__move_snapshot(user_id, name))
+            try:
+                await self.hibernations[user_id]
+            except Exception as e:
+                logger.exception("Error moving the snapshot of user %s off journal file %s: %s", user_id, name, e)
+                moved = False
+            finally:
+                del self.hibernations[user_id]
+
+        if moved:
+            await self.journal.discard(name)
+        else:
+            logger.warning("Journal file %s is kept for the snapshots still pointing into it", name)
+
+    async def __move_snapshot(self, user_id: int, name: str):
+        exchange = self.exchange_instances.get(user_id)
+        if exchange is not None:
+            await asyncio.to_thread(write_snapshot, exchange.snapshot(), self.snapshot_directory)
+            return
+
+        if self.shards is None:
+            return await self.__move_hibernated_snapshot(user_id, name)
+        # Moved to another shard, which may be resuming the exchange from the old file right now
+        locked = await asyncio.to_thread(self.shards.lock_user, user_id)
+        try:
+            snapshot = await asyncio.to_thread(read_snapshot, user_id, self.snapshot_directory)
+            if not locked and snapshot is not None and snapshot.journal == name:
+                raise RuntimeError(f"User {user_id} is being resumed by another shard")
+            if locked:
+                await self.__move_hibernated_snapshot(user_id, name)
+        finally:
+            if locked:
+                self.shards.unlock_user(user_id)
+
+    async def __move_hibernated_snapshot(self, user_id: int, name: str):
+        snapshot = await asyncio.to_thread(read_snapshot, user_id, self.snapshot_directory)
+        if snapshot is None or snapshot.journal != name:
+            return
+        events = await self.journal.events_of(user_id, name, snapshot.offset, snapshot.seq)
+        if not events:
+            # Reading a deleted file finds no events either
+            return
+
+        # Resumed on engines of its own, the exchange is not loaded
+        exchange = await DemoExchange.resume(snapshot, events, matching_engines={})
+        moved = exchange.snapshot()
+        moved.journal, moved.offset, moved.seq = os.path.basename(self.journal.path), 0, events[-1]['seq']
+        await asyncio.to_thread(write_snapshot, moved, self.snapshot_directory)
+
+    async def get_exchange(self, user: User) -> Tuple[Optional[DemoExchange], dict]:
+        """
+        Retrieve an existing exchange instance for the user or load it, concurrent requests share one load.
 
         Parameters:
             user (User): The user initiating the exchange.
@@ -67,102 +237,98 @@ class ExchangesManager:
         Returns:
             DemoExchange: The existing exchange instance if found, else None.
         """
-        if user.id in self.exchange_instances:
-            logger.warning(f"Exchange already active for user {user.id}")
-            return self.exchange_instances[user.id]
-
-        session = get_session()
-        saved_exchange_data = session.query(ExchangeInstance).filter_by(user_id=user.id).first()
-
-        commission = saved_exchange_data.commission if saved_exchange_data else DEFAULT_COMISSION
-        multiplier = saved_exchange_data.multiplier if saved_exchange_data else DEFAULT_MULTIPLIER
-        last_used_timestamp = saved_exchange_data.last_used_timestamp if saved_exchange_data else None
-        try:
-            self.exchange_instances[user.id] = DemoExchange(commission=commission,
-                                                            multiplier=multiplier,
-                                                            last_used_timestamp=last_used_timestamp,
-                                                            user_id=user.id)
-        except Exception as e:
-            logger.exception(f"Error creating exchange for user: {str(e)}")
-            return None, {'message': f"Error creating exchange for user: {str(e)}"}
-        return self.exchange_instances[user.id], {}
-
-
-    def start_exchange(self, user: User) -> dict:
+        if user.id in self.hibernations:
+            await asyncio.wait([self.hibernations[user.id]])
+
+        exchange = self.exchange_instances.get(user.id)
+        if exchange is None:
+            if user.id not in self.loading:
+                self.loading[user.id] = asyncio.get_running_loop().create_task(self.__load_exchange(user.id))
+            try:
+                exchange = await asyncio.shield(self.loading[user.id])
+            except Exception as e:
+                logger.exception("Error creating exchange for user: %s", e)
+                return None, {'message': f"Error creating exchange for user: {str(e)}"}
+            finally:
+                self.loading.pop(user.id, None)
+
+        exchange.last_activity = datetime.now()
+        return exchange, {}
+
+    async def start_exchange(self, user: User) -> Tuple[Optional[DemoExchange], dict]:
         """
-        Start a new exchange instance for the user if not found in the database.
+        Start the exchange instance of the user, loading it if it is not in memory.
 
         Parameters:
             user (User): The user initiating the exchange.
 
         Returns:
-            dict: A message confirming the exchange start or an error message.
+            tuple: The running exchange or None and a message confirming the exchange start or an error message.
         """
-        exchange = self.exchange_instances[user.id]
-        
-        if exchange:
-            return None, f"Exchange already active for user {user.id}"
-
-        exchange = self.get_exchange(user)
+        exchange, message = await self.get_exchange(user)
 
         if not exchange:
-            exchange = DemoExchange(user_id=user.id)
+            return None, message
+
+        if exchange.is_running:
+            return exchange, {"message": f"Exchange already active for user {user.id}"}
 
-        self.exchange_instances[user.id] = exchange
+        if self.eviction_task is None or self.eviction_task.done():
+            self.eviction_task = asyncio.get_running_loop().create_task(self.check_inactive_exchanges())
 
         try:
+            await exchange.load_ledger()
             exchange.start()
+            self.scheduler.add(exchange)
         except Exception as e:
-            logger.exception(f"Error starting exchange for user: {str(e)}")
-            return None, f"Error occurred for user {user.id}"
+            logger.exception("Error starting exchange for user: %s", e)
+            return None, {"message": f"Error occurred for user {user.id}"}
 
-        return exchange, "Exchange started successfully"
+        return exchange, {"message": "Exchange started successfully"}
 
-    def stop_exchange(self, user: User) -> Dict[str, Any]:
+    async def stop_exchange(self, user: User) -> Dict[str, Any]:
         """
             Stop the exchange for the given user and save data in the database.
 
             Parameters:
                 user (User): The user for whom the exchange needs to be stopped.
-                db (Session): The SQLAlchemy database session.
 
             Returns:
                 dict: A message confirming the exchange stoppage or an error message.
         """
         if user.id not in self.exchange_instances:
-            logger.warning(f"No active exchange found for user {user.id}")
+            logger.warning("No active exchange found for user %s", user.id)
             return {"message": f"No active exchange found for user {user.id}"}
 
         exchange = self.exchange_instances[user.id]
         multiplier = exchange.multiplier
         commission = exchange.commission
-        last_activity = exchange.last_activity
-
-        db = get_session()
-        # Check if the user already has an existing exchange instance in the database
-        existing_exchange = db.query(ExchangeInstance).filter_by(user_id=user.id).first()
-
-        if existing_exchange:
-            # Update the existing exchange instance in the database
-            existing_exchange.last_used_timestamp = last_activity.timestamp()
-            existing_exchange.multiplier = multiplier
-            existing_exchange.commission = commission
-        else:
-            # Create a new exchange instance in the database
-            exchange_instance = ExchangeInstance(
-                user_id=user.id,
-                last_used_timestamp=last_activity.timestamp(),
-                multiplier=multiplier,
-                commission=commission
-            )
-            db.add(exchange_instance)
-
-        # Stop the exchange
-        exchange.stop()
-        del self.exchange_instances[user.id]
-        logger.info(f"Exchange stopped for user {user.id}")
-
-        db.commit()  # Commit changes to the database
+        last_used_timestamp = exchange.current_time
+
+        async with get_async_session() as db:
+            # Check if the user already has an existing exchange instance in the database
+            existing_exchange = await db.scalar(select(ExchangeInstance).filter_by(user_id=user.id))
+
+            if existing_exchange:
+                # Update the existing exchange instance in the database
+                existing_exchange.last_used_timestamp = last_used_timestamp
+                existing_exchange.multiplier = multiplier
+                existing_exchange.commission = commission
+            else:
+                # Create a new exchange instance in the database
+                exchange_instance = ExchangeInstance(
+                    user_id=user.id,
+                    last_used_timestamp=last_used_timestamp,
+                    multiplier=multiplier,
+                    commission=commission
+                )
+                db.add(exchange_instance)
+
+            await db.commit()  # Commit changes to the database
+
+        # Stop the exchange, keeping its orders and balances in the snapshot
+        await self.hibernate(user.id)
+        logger.info("Exchange stopped for user %s", user.id)
 
         return {"message": f"Exchange stopped for user {user.id}"}
 
@@ -178,48 +344,102 @@ class ExchangesManager:
         Returns:
             dict: A message confirming the multiplier change or an error message.
         """
+        # The tick interval is divided by the multiplier, zero, negative or infinite values would stall the scheduler
+        if not 0 < multiplier < math.inf:
+            logger.warning("Invalid multiplier %s for user %s", multiplier, user.id)
+            return {"message": f"Multiplier must be a positive number, got {multiplier}"}
+
         if user.id not in self.exchange_instances:
-            logger.warning(f"No active exchange found for user {user.id}")
+            logger.warning("No active exchange found for user %s", user.id)
             return {"message": f"No active exchange found for user {user.id}"}
 
         running_exchange = self.exchange_instances[user.id]
         running_exchange.multiplier = multiplier
+        if running_exchange.is_running:
+            self.scheduler.add(running_exchange)
 
-        session = get_session()
-        
-        # existing_exchange = session.query(ExchangeInstance).filter_by(user_id=user.id).first()
-        # existing_exchange.multiplier = multiplier
-
-        session.commit()
-
-        logger.info(f"Multiplier set to {multiplier} for user {user.id}")
+        logger.info("Multiplier set to %s for user %s", multiplier, user.id)
         return {"message": f"Multiplier set to {multiplier} for user {user.id}"}
 
 
-    def set_commission(self, user: str, commission: float) -> Dict[str, Any]:
+    async def set_commission(self, user: User, commission: float) -> Dict[str, Any]:
         """
         Set the commission for the user's exchange instance.
 
         Parameters:
-            user (str): The user ID whose exchange's commission needs to be set.
+            user (User): The user whose exchange's commission needs to be set.
             commission (float): The commission value to be set.
 
         Returns:
             dict: A message confirming the commission change or an error message.
         """
         if user.id not in self.exchange_instances:
-            logger.warning(f"No active exchange found for user {user.id}")
+            logger.warning("No active exchange found for user %s", user.id)
             return {"message": f"No active exchange found for user {user.id}"}
 
         running_exchange = self.exchange_instances[user.id]
-        running_exchange.multiplier = commission
+        running_exchange.commission = commission
 
-        session = get_session()
+        async with get_async_session() as session:
+            existing_exchange = await session.scalar(select(ExchangeInstance).filter_by(user_id=user.id))
+            if existing_exchange:
+                existing_exchange.commission = commission
+                await session.commit()
 
-        existing_exchange = session.query(ExchangeInstance).filter_by(user_id=user.id).first()
-        existing_exchange.comission = commission
-        session.commit()
-
-        logger.info(f"Commission set to {commission} for user {user.id}")
+        logger.info("Commission set to %s for user %s", commission, user.id)
         return {"message": f"Commission set to {commission} for user {user.id}"}
-    
+
+    async def __load_exchange(self, user_id: int) -> DemoExchange:
+        """
+        Resume the exchange of a user from their snapshot and the journal events after it.
+
+        A user without a snapshot is restored from the saved exchange settings, the open orders in
+        the tables and their events in the current journal file, and gets a snapshot right away.
+        After that a snapshot always exists and is rewritten whenever the exchange continues in the
+        journal of another shard. A shard holds the lock on the user from here until it hibernates
+        the exchange, waiting for the previous owner to hand it off.
+        """
+        await self.journal.start()
+        if self.shards is not None:
+            await self.shards.acquire_user(user_id)
+            try:
+                return await self.__resume_exchange(user_id)
+            except BaseException:
+                self.shards.unlock_user(user_id)
+                raise
+        return await self.__resume_exchange(user_id)
+
+    async def __resume_exchange(self, user_id: int) -> DemoExchange:
+        journal_name = os.path.basename(self.journal.path) if self.journal.path else None
+        snapshot = await asyncio.to_thread(read_snapshot, user_id, self.snapshot_directory)
+
+        if snapshot is not None:
+            events = []
+            if snapshot.journal:
+                events = await self.journal.events_of(user_id, snapshot.journal, snapshot.offset, snapshot.seq)
+            exchange = await DemoExchange.resume(snapshot, events, matching_engines=self.matching_engines,
+                                                 broadcaster=self.broadcaster, ledgers=self.ledgers)
+            logger.info("Exchange resumed from snapshot for user %s with %d later events", user_id, len(events))
+        else:
+            async with get_async_session() as session:
+                saved_exchange_data = await session.scalar(select(ExchangeInstance).filter_by(user_id=user_id))
+
+            commission = saved_exchange_data.commission if saved_exchange_data else DEFAULT_COMISSION
+            multiplier = saved_exchange_data.multiplier if saved_exchange_data else DEFAULT_MULTIPLIER
+            last_used_timestamp = saved_exchange_data.last_used_timestamp if saved_exchange_data else None
+            exchange = DemoExchange(commission=commission,
+                                    multiplier=multiplier,
+                                    last_used_timestamp=last_used_timestamp,
+                                    user_id=user_id,
+                                    matching_engines=self.matching_engines,
+                                    broadcaster=self.broadcaster,
+                                    ledgers=self.ledgers)
+            await exchange.restore_orders(await exchange.get_orders_by_user_id(user_id, OPEN))
+            await exchange.replay(await self.journal.events_of(user_id))
+
+        await exchange.load_ledger()
+        self.exchange_instances[user_id] = exchange
+
+        if snapshot is None or snapshot.journal != journal_name:
+            await asyncio.to_thread(write_snapshot, exchange.snapshot(), self.snapshot_directory)
+        return exchange
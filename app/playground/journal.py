@@ -0,0 +1,435 @@
+import asyncio
+import bisect
+import json
+import os
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, select, update
+
+from app.consts import JOURNAL_GROUP_INTERVAL, JOURNAL_GROUP_SIZE, JOURNAL_PATH, PROJECTION_INTERVAL
+from app.data.choices import CANCELLED, FILLED
+from app.data.db import get_async_session
+from app.data.models import Balance, BaseOrder, JournalCheckpoint
+from app.playground.orders import OrderRecord
+from app.utils.logger import get_logger
+
+
+logger = get_logger('journal')
+
+
+ORDER_PLACED = 'order_placed'
+ORDER_CANCELLED = 'order_cancelled'
+ORDER_TRIGGERED = 'order_triggered'
+ORDER_FILLED = 'order_filled'
+BALANCE_DELTA = 'balance_delta'
+
+# Status an order is left in by each event that takes it off the book
+CLOSING_STATUSES = {ORDER_FILLED: FILLED, ORDER_CANCELLED: CANCELLED}
+
+CHECKPOINT_NAME = 'tables'
+
+
+class EventJournal:
+    """
+    Append-only log of the order and balance events of every exchange in the process.
+
+    Events are JSON lines numbered by ``seq``. Appending only buffers an event, a writer task
+    writes everything buffered within ``group_interval`` (or ``group_size`` events) with a single
+    fsync, and ``sync`` waits until the events appended so far are durable. Durable events are
+    applied to the relational tables in batches by a projection task, which records the last
+    applied ``seq`` and file offset in ``journal_checkpoints`` within the same transaction.
+    The tables are therefore an eventually consistent projection of the journal, on start the
+    projection catches up with the events left behind by the previous process.
+
+    Every shard process writes its own journal with its own checkpoint, order ids are allocated
+    from the residue class ``id_slot`` modulo ``id_stride`` so shards never hand out the same id.
+
+    The journal is a series of files: ``rotate`` continues in a new file once everything in the
+    current one is projected, and the checkpoint names the file its offset points into. The file
+    offsets of every user's events are indexed per file, so reading the events of one user seeks
+    to their lines instead of scanning the file.
+    """
+
+    def __init__(self, path: Optional[str] = JOURNAL_PATH, group_interval: float = JOURNAL_GROUP_INTERVAL,
+                 group_size: int = JOURNAL_GROUP_SIZE, projection_interval: float = PROJECTION_INTERVAL,
+                 checkpoint_name: str = CHECKPOINT_NAME, id_stride: int = 1, id_slot: int = 0):
+        self.path = path
+        # Later files are named after this one and the seq they start after
+        self.base_path = path
+        self.checkpoint_name = checkpoint_name
+        # Journals of different processes allocate the order ids congruent to their slot
+        self.id_stride = id_stride
+        self.id_slot = id_slot
+        self.group_interval = group_interval
+        self.group_size = group_size
+        self.projection_interval = projection_interval
+
+        self.seq = 0
+        self.durable_seq = 0
+        self.offset = 0
+        self.next_order_id = 1
+        self.pending: List[dict] = []
+        # Durable batches not applied to the tables yet, with the file offset right after each of them
+        self.unprojected: List[Tuple[List[dict], int]] = []
+        # File offsets of the durable events of every user, per journal file still on disk
+        self.indexes: Dict[str, Dict[int, List[int]]] = {}
+
+        self.file = None
+        self.started = path is None
+        self.has_pending = asyncio.Event()
+        self.durable = asyncio.Condition()
+        self.projection_lock = asyncio.Lock()
+        # Held while a group is written, so the file cannot change under a rotation
+        self.write_lock = asyncio.Lock()
+        self.start_lock = asyncio.Lock()
+        self.tasks = []
+
+    async def start(self):
+        """
+        Open the journal, project the events the tables are missing and start the writer and projection tasks.
+        """
+        async with self.start_lock:
+            if self.started:
+                return
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            async with get_async_session() as session:
+                checkpoint = await session.get(JournalCheckpoint, self.checkpoint_name)
+                max_order_id = await session.scalar(select(func.max(BaseOrder.id)))
+
+            seq, offset = (checkpoint.seq, checkpoint.offset) if checkpoint else (0, 0)
+            last_order_id = max(checkpoint.last_order_id or 0 if checkpoint else 0, max_order_id or 0)
+            if checkpoint and checkpoint.journal:
+                self.path = os.path.join(os.path.dirname(self.base_path), checkpoint.journal)
+
+            events, end, index = await asyncio.to_thread(scan_journal, self.path, offset)
+            # Already projected should a crash have left the checkpoint ahead of its offset
+            events = [event for event in events if event['seq'] > seq]
+            if events:
+                await project(events, end, self.checkpoint_name)
+                seq = events[-1]['seq']
+                last_order_id = max([last_order_id] + [event['order']['id'] for event in events if event['type'] == ORDER_PLACED])
+                logger.info("Projected %d journal events left by the previous process", len(events))
+
+            self.seq = self.durable_seq = seq
+            self.offset = end
+            self.indexes[self.path] = index
+            self.next_order_id = last_order_id + 1 + (self.id_slot - last_order_id - 1) % self.id_stride
+            self.file = open(self.path, 'ab')
+            self.file.truncate(end)
+
+            loop = asyncio.get_running_loop()
+            self.tasks = [loop.create_task(self.__write_groups()), loop.create_task(self.__project_batches())]
+            self.started = True
+
+    async def close(self):
+        """
+        Write and project every appended event, then stop the journal tasks.
+        """
+        if self.path is None or not self.started:
+            return
+        await self.sync()
+        await self.project()
+        for task in self.tasks:
+            task.cancel()
+        self.file.close()
+        self.started = False
+
+    def allocate_order_id(self) -> int:
+        order_id = self.next_order_id
+        self.next_order_id += self.id_stride
+        return order_id
+
+    def append(self, event_type: str, user_id: int, **data) -> int:
+        """
+        Buffer an event for the next group commit.
+
+        Returns:
+            int: The ``seq`` of the event, pass it to ``sync`` to wait until it is durable.
+        """
+        self.seq += 1
+        if self.path is None:
+            return self.seq
+
+        self.pending.append({'seq': self.seq, 'type': event_type, 'user_id': user_id, **data})
+        self.has_pending.set()
+        return self.seq
+
+    async def sync(self, seq: Optional[int] = None):
+        """
+        Wait until the events up to ``seq``, all appended events by default, are fsynced.
+        """
+        if self.path is None:
+            return
+        target = self.seq if seq is None else seq
+        async with self.durable:
+            await self.durable.wait_for(lambda: self.durable_seq >= target)
+
+    def unprojected_events(self) -> Iterator[dict]:
+        """
+        Events appended but not applied to the tables yet, in ``seq`` order.
+        """
+        for events, _ in self.unprojected:
+            yield from events
+        yield from self.pending
+
+    async def events_of(self, user_id: int, name: Optional[str] = None, offset: int = 0, after_seq: int = 0) -> List[dict]:
+        """
+        Read the events of a user from this journal or from the journal of another shard.
+
+        The files of this journal are read through their index, other files are scanned from ``offset``.
+
+        Parameters:
+            user_id (int): Owner of the events.
+            name (str): File name of the journal, other files and the journals of other shards live in the same directory.
+            offset (int): File offset to start reading at.
+            after_seq (int): Events up to this ``seq`` of the read journal are skipped.
+
+        Returns:
+            list: The events in ``seq`` order.
+        """
+        if self.path is None:
+            return []
+
+        path = self.path if name is None else os.path.join(os.path.dirname(self.path), name)
+        if path == self.path and not self.write_lock.locked():
+            # A rotation holds the lock, every event written before it is indexed already
+            await self.sync()
+
+        index = self.indexes.get(path)
+        if index is None:
+            events, _ = await asyncio.to_thread(read_events, path, offset)
+            return [event for event in events if event['user_id'] == user_id and event['seq'] > after_seq]
+
+        offsets = index.get(user_id, [])
+        events = await asyncio.to_thread(read_lines, path, offsets[bisect.bisect_left(offsets, offset):])
+        return [event for event in events if event['seq'] > after_seq]
+
+    async def rotate(self) -> Tuple[str, List[int]]:
+        """
+        Continue in a new file once every event written to the current one is projected.
+
+        The old file stays readable until ``discard`` deletes it, the caller first moves the
+        snapshots that point into it to the new file.
+
+        Returns:
+            tuple: File name of the old file and the users with events in it.
+        """
+        async with self.write_lock:
+            root, extension = os.path.splitext(self.base_path)
+            path = f'{root}.{self.durable_seq}{extension}'
+            async with self.projection_lock:
+                await self.__project()
+                async with get_async_session() as session:
+                    checkpoint = await session.get(JournalCheckpoint, self.checkpoint_name)
+                    if checkpoint is None:
+                        checkpoint = JournalCheckpoint(name=self.checkpoint_name, last_order_id=0)
+                        session.add(checkpoint)
+                    checkpoint.journal = os.path.basename(path)
+                    checkpoint.seq = self.durable_seq
+                    checkpoint.offset = 0
+                    await session.commit()
+
+            old_path = self.path
+            self.file.close()
+            self.path, self.offset = path, 0
+            self.file = open(path, 'ab')
+            self.indexes[path] = {}
+
+        logger.info("Journal continues in %s after %d bytes", os.path.basename(path), os.path.getsize(old_path))
+        return os.path.basename(old_path), list(self.indexes[old_path])
+
+    async def discard(self, name: str):
+        """
+        Delete a journal file left behind by ``rotate``.
+        """
+        path = os.path.join(os.path.dirname(self.path), name)
+        if path == self.path:
+            raise ValueError(f"{name} is the current journal file")
+        await asyncio.to_thread(os.remove, path)
+        self.indexes.pop(path, None)
+
+    async def project(self):
+        """
+        Apply the durable events that are not in the tables yet in one transaction.
+        """
+        async with self.projection_lock:
+            await self.__project()
+
+    async def __project(self):
+        batches = list(self.unprojected)
+        if not batches:
+            return
+        await project([event for events, _ in batches for event in events], batches[-1][1], self.checkpoint_name)
+        del self.unprojected[:len(batches)]
+
+    async def __write_groups(self):
+        while True:
+            await self.has_pending.wait()
+            if len(self.pending) < self.group_size:
+                # Let the events of concurrent requests and ticks join this group
+                await asyncio.sleep(self.group_interval)
+
+            events, self.pending = self.pending, []
+            self.has_pending.clear()
+            lines = [json.dumps(event).encode() + b'\n' for event in events]
+
+            async with self.write_lock:
+                try:
+                    await asyncio.to_thread(self.__write, b''.join(lines))
+                except Exception as e:
+                    logger.exception("Journal write failed, retrying: %s", e)
+                    self.pending[:0] = events
+                    self.has_pending.set()
+                    await asyncio.sleep(self.group_interval)
+                    continue
+
+                index = self.indexes[self.path]
+                for event, line in zip(events, lines):
+                    index.setdefault(event['user_id'], []).append(self.offset)
+                    self.offset += len(line)
+                self.unprojected.append((events, self.offset))
+            async with self.durable:
+                self.durable_seq = events[-1]['seq']
+                self.durable.notify_all()
+
+    async def __project_batches(self):
+        while True:
+            await asyncio.sleep(self.projection_interval)
+            try:
+                await self.project()
+            except Exception as e:
+                logger.exception("Journal projection failed: %s", e)
+
+    def __write(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+def read_events(path: str, offset: int = 0, end: Optional[int] = None) -> Tuple[List[dict], int]:
+    """
+    Read the events a journal file stores between two offsets.
+
+    Returns:
+        tuple: The events and the offset after the last complete one, a line torn by a crash ends the read.
+    """
+    if not os.path.exists(path):
+        return [], 0
+
+    events = []
+    with open(path, 'rb') as journal:
+        journal.seek(offset)
+        for line in journal:
+            if end is not None and offset >= end:
+                break
+            if not line.endswith(b'\n'):
+                break
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                break
+            offset += len(line)
+    return events, offset
+
+
+def scan_journal(path: str, offset: int = 0) -> Tuple[List[dict], int, Dict[int, List[int]]]:
+    """
+    Index a journal file by user and read the events it stores from an offset on.
+
+    Returns:
+        tuple: The events at or after ``offset``, the offset after the last complete event and the
+        file offsets of the events of every user.
+    """
+    if not os.path.exists(path):
+        return [], 0, {}
+
+    events = []
+    index: Dict[int, List[int]] = {}
+    end = 0
+    with open(path, 'rb') as journal:
+        for line in journal:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                event = json.loads(line)
+            except ValueError:
+                break
+            index.setdefault(event['user_id'], []).append(end)
+            if end >= offset:
+                events.append(event)
+            end += len(line)
+    return events, end, index
+
+
+def read_lines(path: str, offsets: List[int]) -> List[dict]:
+    """
+    Read the events starting at the given offsets of a journal file.
+    """
+    events = []
+    with open(path, 'rb') as journal:
+        for offset in offsets:
+            journal.seek(offset)
+            events.append(json.loads(journal.readline()))
+    return events
+
+
+async def project(events: List[dict], offset: int, checkpoint_name: str = CHECKPOINT_NAME):
+    """
+    Apply journal events to the tables and move the checkpoint past them in the same transaction.
+
+    Placed orders are inserted with their journal ids and filled and cancelled ones get their status
+    updated, one statement per status. An order placed and closed within the batch is inserted with
+    its final status. Balance deltas are summed per user and asset.
+    """
+    placed: Dict[int, BaseOrder] = {}
+    closed: Dict[int, str] = {}
+    deltas = defaultdict(float)
+    last_order_id = 0
+
+    async with get_async_session() as session:
+        with session.no_autoflush:
+            for event in events:
+                if event['type'] == ORDER_PLACED:
+                    order = OrderRecord.from_fields(event['order']).to_model()
+                    placed[order.id] = order
+                    last_order_id = max(last_order_id, order.id)
+                    session.add(order)
+                elif event['type'] in CLOSING_STATUSES:
+                    order = placed.get(event['order_id'])
+                    if order is not None:
+                        order.status = CLOSING_STATUSES[event['type']]
+                    else:
+                        closed[event['order_id']] = CLOSING_STATUSES[event['type']]
+                elif event['type'] == BALANCE_DELTA:
+                    for asset, delta in event['deltas'].items():
+                        deltas[(event['user_id'], asset)] += delta
+
+        statuses = defaultdict(list)
+        for order_id, status in closed.items():
+            statuses[status].append(order_id)
+        for status, order_ids in statuses.items():
+            # On the table, the status is a column of base_orders in both order schema modes
+            orders = BaseOrder.__table__
+            await session.execute(update(orders).where(orders.c.id.in_(order_ids)).values(status=status))
+
+        if deltas:
+            balance_entries = await session.scalars(select(Balance).where(Balance.user_id.in_({user_id for user_id, _ in deltas})))
+            existing = {(entry.user_id, entry.asset_name): entry for entry in balance_entries}
+            for (user_id, asset), delta in deltas.items():
+                entry = existing.get((user_id, asset))
+                if entry is None:
+                    session.add(Balance(user_id=user_id, asset_name=asset, amount=delta))
+                else:
+                    entry.amount += delta
+
+        checkpoint = await session.get(JournalCheckpoint, checkpoint_name)
+        if checkpoint is None:
+            checkpoint = JournalCheckpoint(name=checkpoint_name, last_order_id=0)
+            session.add(checkpoint)
+        checkpoint.seq = events[-1]['seq']
+        checkpoint.offset = offset
+        checkpoint.last_order_id = max(checkpoint.last_order_id or 0, last_order_id)
+
+        await session.commit()
@@ -0,0 +1,162 @@
+from collections import defaultdict
+from typing import Dict, Iterable
+
+from sqlalchemy import select
+
+from app.data.choices import BUY
+from app.data.db import get_async_session
+from app.data.models import Balance
+from app.playground.journal import BALANCE_DELTA, EventJournal
+from app.playground.orders import OrderRecord
+
+
+def reserved_asset(order: OrderRecord) -> str:
+    """Asset whose funds an order blocks while it rests."""
+    return order.base_asset if order.direction == BUY else order.target_asset
+
+
+class LedgerEntry:
+    __slots__ = ('free', 'reserved')
+
+    def __init__(self, free: float = 0.0, reserved: float = 0.0):
+        self.free = free
+        self.reserved = reserved
+
+    @property
+    def amount(self) -> float:
+        return self.free + self.reserved
+
+    def to_dict(self) -> dict:
+        return {'free': self.free, 'reserved': self.reserved}
+
+
+class BalanceLedger:
+    """
+    Authoritative balances of one user while their exchange runs.
+
+    Every asset holds a ``free`` and a ``reserved`` amount, reserved funds are blocked by resting
+    orders. Reservations are derived from the open orders and never journaled, settling a fill
+    appends its balance deltas to the journal, from which the ``balances`` table is projected.
+    """
+
+    def __init__(self, user_id: int, journal: EventJournal, entries: Dict[str, LedgerEntry] = None):
+        self.user_id = user_id
+        self.journal = journal
+        self.entries: Dict[str, LedgerEntry] = entries or {}
+
+    def get(self, asset: str) -> LedgerEntry:
+        if asset not in self.entries:
+            self.entries[asset] = LedgerEntry()
+        return self.entries[asset]
+
+    def balances(self) -> Dict[str, float]:
+        return {asset: entry.amount for asset, entry in self.entries.items()}
+
+    def reserve(self, asset: str, amount: float) -> bool:
+        """
+        Move funds from free to reserved.
+
+        Returns:
+            bool: False without changing anything if the amount is not positive or the free amount does not cover it.
+        """
+        # A negative reservation would credit free funds, and NaN fails every comparison below
+        if not amount > 0:
+            return False
+        entry = self.get(asset)
+        if entry.free - amount < 0:
+            return False
+        entry.free -= amount
+        entry.reserved += amount
+        return True
+
+    def release(self, asset: str, amount: float):
+        """Move reserved funds back to free."""
+        entry = self.get(asset)
+        entry.free += amount
+        entry.reserved -= amount
+
+    def covers(self, order: OrderRecord, deltas: Dict[str, float]) -> bool:
+        """
+        Whether the funds the order reserved plus the free amounts pay for the withdrawals of a fill.
+        """
+        for asset, delta in deltas.items():
+            available = self.get(asset).free
+            if asset == reserved_asset(order):
+                available += order.blocked_amount or 0.0
+            if available + delta < 0:
+                return False
+        return True
+
+    def settle(self, order: OrderRecord, deltas: Dict[str, float]):
+        """
+        Apply a fill: the funds the order reserved are released and the fill deltas applied to free amounts.
+        """
+        if order.blocked_amount:
+            self.release(reserved_asset(order), order.blocked_amount)
+        for asset, delta in deltas.items():
+            self.get(asset).free += delta
+        self.journal.append(BALANCE_DELTA, self.user_id, order_id=order.id, deltas=deltas)
+
+
+class LedgerStore:
+    """
+    Ledgers of the running exchanges.
+
+    A ledger is built from the ``balances`` table plus the balance deltas of the journal that
+    are not projected into it yet, read under the projection lock so no delta is counted twice.
+    """
+
+    def __init__(self, journal: EventJournal):
+        self.journal = journal
+        self.ledgers: Dict[int, BalanceLedger] = {}
+
+    async def load(self, user_id: int, resting_orders: Iterable[OrderRecord] = ()) -> BalanceLedger:
+        """
+        Retrieve the ledger of a user, reading the balances table once when it is not loaded yet.
+
+        Parameters:
+            user_id (int): Owner of the ledger.
+            resting_orders (Iterable[OrderRecord]): Open orders of the user, their blocked amounts
+                are reserved again.
+        """
+        if user_id in self.ledgers:
+            return self.ledgers[user_id]
+
+        await self.journal.start()
+        async with self.journal.projection_lock:
+            async with get_async_session() as session:
+                balance_entries = await session.scalars(select(Balance).filter_by(user_id=user_id))
+                amounts = defaultdict(float, {entry.asset_name: entry.amount or 0.0 for entry in balance_entries})
+            for event in self.journal.unprojected_events():
+                if event['type'] == BALANCE_DELTA and event['user_id'] == user_id:
+                    for asset, delta in event['deltas'].items():
+                        amounts[asset] += delta
+
+        if user_id in self.ledgers:
+            # Loaded concurrently by another request while this one was reading
+            return self.ledgers[user_id]
+        return self.restore(user_id, amounts, resting_orders)
+
+    def restore(self, user_id: int, amounts: Dict[str, float], resting_orders: Iterable[OrderRecord] = ()) -> BalanceLedger:
+        """
+        Keep a ledger built from known total amounts, for example those of an exchange snapshot.
+
+        Parameters:
+            user_id (int): Owner of the ledger.
+            amounts (dict): Free and reserved amount of every asset.
+            resting_orders (Iterable[OrderRecord]): Open orders of the user, their blocked amounts are reserved.
+        """
+        ledger = BalanceLedger(user_id, self.journal, {asset: LedgerEntry(free=amount) for asset, amount in amounts.items()})
+        for order in resting_orders:
+            entry = ledger.get(reserved_asset(order))
+            entry.free -= order.blocked_amount or 0.0
+            entry.reserved += order.blocked_amount or 0.0
+
+        self.ledgers[user_id] = ledger
+        return ledger
+
+    async def unload(self, user_id: int):
+        """
+        Stop keeping the ledger of a user in memory.
+        """
+        self.ledgers.pop(user_id, None)
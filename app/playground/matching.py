@@ -0,0 +1,403 @@
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.data.choices import BUY, MARKET, OCO, STOP_LIMIT
+from app.data.kline_store import kline_store
+from app.playground.orders import OrderRecord
+from app.utils.logger import get_logger
+from app.utils.metrics import resolve_latency
+
+
+logger = get_logger('tick')
+
+
+# Trigger sides: FALLING entries fire once the bar's low reaches them (buy limits, sell stops),
+# RISING entries fire once the bar's high reaches them (sell limits, buy stops).
+FALLING = 0
+RISING = 1
+
+INITIAL_CAPACITY = 1024
+
+
+class MatchingEngine:
+    """
+    Resting orders of every user trading one asset, stored as flat NumPy arrays.
+
+    Each slot holds the trigger price, trigger side, quantity and owner of one order. Every side
+    keeps its slots sorted by trigger price, so a bar finds the orders its low/high crossed with
+    one binary search per side and the work per tick is proportional to the number of crossed
+    orders rather than to the number of resting ones. Slots added since the last bar are merged
+    into the sorted index when the next bar is matched. Slots of removed orders are reclaimed by
+    compacting the arrays once half of them are unused, which also rebuilds the index.
+    """
+
+    def __init__(self, asset: str, capacity: int = INITIAL_CAPACITY):
+        self.asset = asset
+        self.size = 0
+        self.free = 0
+        self.price = np.empty(capacity, dtype=np.float64)
+        self.limit_price = np.empty(capacity, dtype=np.float64)
+        self.side = np.empty(capacity, dtype=np.int8)
+        self.is_stop = np.zeros(capacity, dtype=bool)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.quantity = np.empty(capacity, dtype=np.float64)
+        self.owner = np.empty(capacity, dtype=np.int64)
+        self.order_id = np.empty(capacity, dtype=np.int64)
+
+        # Per side, the trigger prices in ascending order and their slots. Entries of removed slots
+        # and of stops that turned into limits on the other side stay until the next compaction.
+        self.index_price = [np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)]
+        self.index_slot = [np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)]
+        self.pending: List[List[int]] = [[], []]
+
+        self.slots: Dict[int, int] = {}
+        self.orders: Dict[int, OrderRecord] = {}
+        self.oco_links: Dict[int, int] = {}
+        self.market_orders: Dict[int, List[OrderRecord]] = defaultdict(list)
+
+    def __len__(self) -> int:
+        return len(self.slots) + sum(len(orders) for orders in self.market_orders.values())
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self.slots
+
+    def add(self, order: OrderRecord, triggered: bool = False):
+        """
+        Put an order into the engine.
+
+        Market orders are queued per owner and filled on the owner's next bar, every other
+        type gets a slot keyed by its trigger price. Stop-limit orders whose stop was already
+        ``triggered`` rest as limit orders. OCO orders are linked with their ``bounded_order_id``
+        in both directions while it is resting and has the same owner, so orders must be added
+        in id order.
+        """
+        if order.order_type == MARKET:
+            self.market_orders[order.user_id].append(order)
+            return
+
+        if self.size == len(self.price):
+            self.__grow()
+
+        slot = self.size
+        self.size += 1
+
+        if order.order_type == STOP_LIMIT and not triggered:
+            self.price[slot] = order.stop_price
+            self.side[slot] = RISING if order.direction == BUY else FALLING
+            self.is_stop[slot] = True
+        else:
+            self.price[slot] = order.execution_price
+            self.side[slot] = FALLING if order.direction == BUY else RISING
+            self.is_stop[slot] = False
+
+        self.limit_price[slot] = order.execution_price
+        self.quantity[slot] = order.quantity
+        self.owner[slot] = order.user_id
+        self.order_id[slot] = order.id
+        self.active[slot] = True
+        self.pending[self.side[slot]].append(slot)
+        self.slots[order.id] = slot
+        self.orders[order.id] = order
+
+        # Every user of the asset shares the engine, only orders of the same owner are linked
+        bounded = self.orders.get(order.bounded_order_id) if order.order_type == OCO else None
+        if bounded is not None and bounded.user_id == order.user_id:
+            self.oco_links[order.id] = order.bounded_order_id
+            self.oco_links[order.bounded_order_id] = order.id
+
+    def remove(self, order_id: int) -> Optional[OrderRecord]:
+        """
+        Remove an order from the engine by its id.
+
+        Returns:
+            OrderRecord: The removed order or None if it is not resting in the engine.
+        """
+        order = self.__discard(order_id)
+        if order is None:
+            for orders in self.market_orders.values():
+                order = next((order for order in orders if order.id == order_id), None)
+                if order is not None:
+                    orders.remove(order)
+                    return order
+        if order is not None and self.free > INITIAL_CAPACITY and self.free * 2 > self.size:
+            self.__compact()
+        return order
+
+    def orders_of(self, owner: int) -> List[OrderRecord]:
+        """
+        Orders of one owner that are still resting in the engine.
+        """
+        size = self.size
+        order_ids = self.order_id[:size][self.active[:size] & (self.owner[:size] == owner)]
+        return [self.orders[order_id] for order_id in order_ids.tolist()] + list(self.market_orders.get(owner, ()))
+
+    def resting_orders(self, owner: int) -> List[Tuple[OrderRecord, bool]]:
+        """
+        Orders of one owner with their trigger state.
+
+        Returns:
+            list: The orders, each with whether it is a stop-limit order whose stop already triggered.
+        """
+        size = self.size
+        slots = np.flatnonzero(self.active[:size] & (self.owner[:size] == owner))
+        orders = [(self.orders[order_id], self.orders[order_id].order_type == STOP_LIMIT and not is_stop)
+                  for order_id, is_stop in zip(self.order_id[slots].tolist(), self.is_stop[slots].tolist())]
+        return orders + [(order, False) for order in self.market_orders.get(owner, ())]
+
+    def pop_orders(self, owner: int) -> List[Tuple[OrderRecord, bool]]:
+        """
+        Remove every order of one owner from the engine.
+
+        Returns:
+            list: The removed orders with their trigger state, see ``resting_orders``.
+        """
+        orders = self.resting_orders(owner)
+        for order, _ in orders:
+            self.__discard(order.id)
+        self.market_orders.pop(owner, None)
+
+        if self.free > INITIAL_CAPACITY and self.free * 2 > self.size:
+            self.__compact()
+        return orders
+
+    def match(self, open_price: float, low_price: float, high_price: float,
+              owners: Iterable[int]) -> Dict[int, Tuple[List[Tuple[OrderRecord, float]], List[OrderRecord], List[OrderRecord]]]:
+        """
+        Match one bar for the orders of the given owners.
+
+        Triggered stop-limit orders are turned into resting limit orders in place and are
+        evaluated starting with the next bar. When one leg of an OCO pair fills its sibling
+        is cancelled.
+
+        Parameters:
+            open_price (float): Price market orders are filled at, limit orders the bar opens
+                through fill at it instead of their limit.
+            low_price (float): The lowest price of the bar.
+            high_price (float): The highest price of the bar.
+            owners (Iterable[int]): Users whose exchanges are at this bar.
+
+        Returns:
+            dict: Filled ``(order, price)`` pairs, cancelled OCO siblings and triggered stop-limit
+            orders per owner.
+        """
+        owners = list(owners)
+        results = defaultdict(lambda: ([], [], []))
+
+        for owner in owners:
+            market_orders = self.market_orders.pop(owner, None)
+            if market_orders:
+                results[owner][0].extend((order, open_price) for order in market_orders)
+
+        slots = self.__crossed(low_price, high_price)
+        slots = slots[self.active[slots]]
+        if len(owners) == 1:
+            slots = slots[self.owner[slots] == owners[0]]
+        else:
+            slots = slots[np.isin(self.owner[slots], owners)]
+
+        if not len(slots):
+            return results
+
+        stop_slots = slots[self.is_stop[slots]]
+        fill_slots = slots[~self.is_stop[slots]]
+
+        self.active[fill_slots] = False
+        self.free += len(fill_slots)
+
+        # A bar opening through the limit fills at the open, the limit is only the worst accepted price
+        limits = self.price[fill_slots]
+        fill_prices = np.where(self.side[fill_slots] == FALLING, np.minimum(limits, open_price), np.maximum(limits, open_price))
+
+        cancelled_ids = set()
+        for order_id, fill_price in zip(self.order_id[fill_slots].tolist(), fill_prices.tolist()):
+            # Both legs of an OCO pair may be crossed by the same bar, only the first one fills
+            if order_id in cancelled_ids:
+                continue
+
+            self.slots.pop(order_id)
+            order = self.orders.pop(order_id)
+            results[order.user_id][0].append((order, fill_price))
+
+            sibling_id = self.oco_links.pop(order_id, None)
+            if sibling_id is None:
+                continue
+            cancelled_ids.add(sibling_id)
+            sibling = self.__discard(sibling_id)
+            if sibling:
+                results[sibling.user_id][1].append(sibling)
+            logger.info("OCO order %s cancelled, sibling %s was filled", sibling_id, order_id)
+
+        stop_slots = stop_slots[self.active[stop_slots]]
+        self.price[stop_slots] = self.limit_price[stop_slots]
+        self.side[stop_slots] = 1 - self.side[stop_slots]
+        self.is_stop[stop_slots] = False
+        for slot, side in zip(stop_slots.tolist(), self.side[stop_slots].tolist()):
+            self.pending[side].append(slot)
+        for order_id in self.order_id[stop_slots].tolist():
+            order = self.orders[order_id]
+            results[order.user_id][2].append(order)
+
+        if self.free > INITIAL_CAPACITY and self.free * 2 > self.size:
+            self.__compact()
+
+        return results
+
+    def __crossed(self, low_price: float, high_price: float) -> np.ndarray:
+        """
+        Slots whose trigger price the bar reached, in slot order, including removed ones.
+        """
+        for side in (FALLING, RISING):
+            if self.pending[side]:
+                self.__merge(side)
+
+        falling = self.index_slot[FALLING][np.searchsorted(self.index_price[FALLING], low_price, side='left'):]
+        rising = self.index_slot[RISING][:np.searchsorted(self.index_price[RISING], high_price, side='right')]
+        # Triggered stops left an entry on the side they no longer rest on
+        slots = np.concatenate((falling[self.side[falling] == FALLING], rising[self.side[rising] == RISING]))
+        # Slots are handed out in arrival order, which keeps the time priority of the fills
+        slots.sort()
+        return slots
+
+    def __merge(self, side: int):
+        slots = np.array(self.pending[side], dtype=np.int64)
+        self.pending[side] = []
+        prices = self.price[slots]
+        order = np.argsort(prices, kind='stable')
+        slots, prices = slots[order], prices[order]
+
+        positions = np.searchsorted(self.index_price[side], prices, side='right')
+        self.index_price[side] = np.insert(self.index_price[side], positions, prices)
+        self.index_slot[side] = np.insert(self.index_slot[side], positions, slots)
+
+    def __discard(self, order_id: int) -> Optional[OrderRecord]:
+        slot = self.slots.pop(order_id, None)
+        if slot is None:
+            return None
+
+        if self.active[slot]:
+            self.active[slot] = False
+            self.free += 1
+
+        sibling_id = self.oco_links.pop(order_id, None)
+        if sibling_id is not None:
+            self.oco_links.pop(sibling_id, None)
+
+        return self.orders.pop(order_id)
+
+    def __grow(self):
+        capacity = len(self.price) * 2
+        for name in ('price', 'limit_price', 'side', 'is_stop', 'active', 'quantity', 'owner', 'order_id'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def __compact(self):
+        keep = np.flatnonzero(self.active[:self.size])
+        for name in ('price', 'limit_price', 'side', 'is_stop', 'active', 'quantity', 'owner', 'order_id'):
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self.active[len(keep):self.size] = False
+
+        self.size = len(keep)
+        self.free = 0
+        self.slots = dict(zip(self.order_id[:self.size].tolist(), range(self.size)))
+
+        for side in (FALLING, RISING):
+            slots = np.flatnonzero(self.side[:self.size] == side)
+            order = np.argsort(self.price[slots], kind='stable')
+            self.index_slot[side] = slots[order]
+            self.index_price[side] = self.price[self.index_slot[side]]
+            self.pending[side] = []
+
+
+def match_exchanges(exchanges: Iterable, matching_engines: Dict[str, MatchingEngine]) -> Dict[object, tuple]:
+    """
+    Match the current bars of several exchanges, grouping the exchanges that sit on the same bar
+    of the same asset into one vectorized match.
+
+    Returns:
+        dict: Filled ``(order, price)`` pairs, cancelled and triggered orders per exchange.
+    """
+    groups = defaultdict(list)
+    for exchange in exchanges:
+        for asset, index in exchange.current_bars.items():
+            groups[(asset, index)].append(exchange)
+
+    results = defaultdict(lambda: ([], [], []))
+    for (asset, index), group in groups.items():
+        engine = matching_engines.get(asset)
+        if not engine:
+            continue
+
+        series = kline_store.get(asset)
+        matched = engine.match(float(series.open[index]), float(series.low[index]), float(series.high[index]),
+                               owners=[exchange.user_id for exchange in group])
+
+        for exchange in group:
+            if exchange.user_id not in matched:
+                continue
+            for merged, orders in zip(results[exchange], matched[exchange.user_id]):
+                merged.extend(orders)
+
+    return results
+
+
+def bar_message(asset: str, index: int) -> str:
+    series = kline_store.get(asset)
+    return json.dumps({
+        'type': 'bar',
+        'asset': asset,
+        'timestamp': int(series.timestamps[index]),
+        'open': float(series.open[index]),
+        'high': float(series.high[index]),
+        'low': float(series.low[index]),
+        'close': float(series.close[index]),
+        'volume': float(series.volume[index]),
+    })
+
+
+async def tick_exchanges(batch: List[Tuple[object, int]], matching_engines: Dict[str, MatchingEngine], broadcaster=None):
+    """
+    Advance a batch of exchanges bar by bar, matching all of them together on every bar.
+
+    Parameters:
+        batch (list): ``(exchange, bars)`` pairs, each exchange advances by its number of bars.
+        matching_engines (dict): Matching engine of every traded asset.
+        broadcaster (Broadcaster): Receives the new bars of exchanges whose users are subscribed,
+            every bar is serialized once for all of them.
+    """
+    for step in range(max((bars for _, bars in batch), default=0)):
+        exchanges = [exchange for exchange, bars in batch if bars > step and exchange.is_running]
+        messages = {}
+        for exchange in exchanges:
+            exchange.advance_clock()
+            if broadcaster is None or not broadcaster.has_subscribers(exchange.user_id):
+                continue
+            for bar in exchange.current_bars.items():
+                if bar not in messages:
+                    messages[bar] = bar_message(*bar)
+                broadcaster.publish(exchange.user_id, messages[bar])
+
+        started = time.perf_counter()
+        results = match_exchanges(exchanges, matching_engines)
+        if results:
+            outcomes = await asyncio.gather(*(exchange.apply_fills(fills, cancelled, triggered)
+                                              for exchange, (fills, cancelled, triggered) in results.items()),
+                                            return_exceptions=True)
+        resolve_latency.observe(time.perf_counter() - started)
+        if results:
+            for exchange, outcome in zip(results, outcomes):
+                if isinstance(outcome, Exception):
+                    logger.error("Applying fills failed for user %s: %r", exchange.user_id, outcome)
+
+    # Sampled per subsystem, the loop is skipped unless debug records of the tick loop are kept
+    if logger.isEnabledFor(logging.DEBUG):
+        for exchange, bars in batch:
+            logger.debug("Advanced %d klines for user %s, current time: %s", bars, exchange.user_id, exchange.current_time)
@@ -1,35 +1,83 @@
-import inspect
 from datetime import datetime
-from typing import Tuple, Union
-from app.data.choices import order_classes
-from app.data.models import BaseOrder
+from typing import Callable, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+from app.data.choices import BUY, LIMIT, MARKET, OCO, SELL, STOP_LIMIT
+from app.playground.orders import MODEL_COLUMNS, OrderRecord
 from app.utils.logger import logger
 
 
-class OrderFactory:
-    @staticmethod
-    def create_order(order_data) -> Tuple[Union[BaseOrder, None], dict]:
-        order_type = order_data.__dict__.get('order_type', None)
+REQUIRED_FIELDS = ['order_type', 'quantity', 'base_asset', 'target_asset', 'direction', 'execution_price']
 
-        if not order_type:
-            return None, {'message': 'order_type must be provided'}
-        
-        order_class = order_classes.get(order_type, None)
+EXTRA_REQUIRED_FIELDS = {
+    MARKET: [],
+    LIMIT: [],
+    STOP_LIMIT: ['stop_price'],
+    OCO: [],
+}
 
-        if not order_class:
-            return None, {'message': f"Invalid order type: {order_type}"}
+# Prices reserve quantity * price, a negative one would credit the balance it reserves from
+PRICE_FIELDS = ('execution_price', 'stop_price', 'signal_price')
 
-        constructor_args = inspect.getfullargspec(order_class.__init__).args[1:]
+# Fields a client sets, the rest are assigned by the exchange
+SERVER_FIELDS = {'id', 'user_id', 'creation_date', 'status'}
 
-        if not all(arg in order_data for arg in constructor_args):
-            logger.error()
-            return None, {'message': 'Not all of the arguments were provided'}
+OrderBuilder = Callable[[dict], Tuple[Optional[OrderRecord], dict]]
 
-        order_data = {key: value for key, value in order_data.__dict__.items() if key in constructor_args}
 
-        order = order_class(
-            creation_date=datetime.now(),
-            **order_data
-        )
+def compile_builder(order_type: str) -> OrderBuilder:
+    """
+    Build the validator and constructor of one order type.
 
+    The required fields and the fields the type accepts are resolved here once, validating and
+    constructing an order then only reads the request fields.
+    """
+    required = tuple(REQUIRED_FIELDS + EXTRA_REQUIRED_FIELDS[order_type])
+    accepted = tuple(sorted(MODEL_COLUMNS[order_type] - SERVER_FIELDS - {'order_type'}))
+    prices = tuple(name for name in PRICE_FIELDS if name in accepted or name in required)
+
+    def build(order_data: dict) -> Tuple[Optional[OrderRecord], dict]:
+        missing = [name for name in required if order_data.get(name) is None]
+        if missing:
+            logger.error("Missing order fields: %s", missing)
+            return None, {'message': f'Not all of the arguments were provided: {missing}'}
+
+        if order_data['direction'] not in (BUY, SELL):
+            return None, {'message': f"Invalid direction: {order_data['direction']}"}
+
+        if order_data['quantity'] <= 0:
+            return None, {'message': 'quantity must be positive'}
+
+        for name in prices:
+            # Also rejects NaN, which compares false to everything
+            if order_data.get(name) is not None and not order_data[name] > 0:
+                return None, {'message': f'{name} must be positive'}
+
+        order = OrderRecord(order_type=order_type, creation_date=datetime.now())
+        for name in accepted:
+            setattr(order, name, order_data.get(name))
         return order, {}
+
+    return build
+
+
+ORDER_BUILDERS: Dict[str, OrderBuilder] = {order_type: compile_builder(order_type) for order_type in EXTRA_REQUIRED_FIELDS}
+
+
+class OrderFactory:
+    @staticmethod
+    def create_order(order_data) -> Tuple[Optional[OrderRecord], dict]:
+        # The fields of a request model are read in place, they are flat so no copy is needed
+        order_data = vars(order_data) if isinstance(order_data, BaseModel) else order_data
+        order_type = order_data.get('order_type', None)
+
+        if not order_type:
+            return None, {'message': 'order_type must be provided'}
+
+        build = ORDER_BUILDERS.get(order_type, None)
+
+        if not build:
+            return None, {'message': f"Invalid order type: {order_type}"}
+
+        return build(order_data)
@@ -0,0 +1,78 @@
+from datetime import datetime
+from typing import Dict, FrozenSet, Optional
+
+from app.data.choices import order_classes
+from app.data.models import BaseOrder
+
+
+ORDER_FIELDS = ('id', 'order_type', 'quantity', 'base_asset', 'target_asset', 'direction', 'execution_price',
+                'stop_price', 'signal_price', 'blocked_amount', 'user_id', 'bounded_order_id', 'creation_date', 'status')
+
+# Columns of the table row of every order type, looked up once instead of on every conversion
+MODEL_COLUMNS: Dict[str, FrozenSet[str]] = {
+    order_type: frozenset(attribute.key for attribute in order_class.__mapper__.column_attrs) & frozenset(ORDER_FIELDS)
+    for order_type, order_class in order_classes.items()
+}
+
+
+class OrderRecord:
+    """
+    In-memory order of an exchange, the matching engines and the journal.
+
+    A plain ``__slots__`` object holding the fields of every order type, it has no instance
+    dictionary and none of the identity map and change tracking state of the ORM models. The
+    models are only built when orders are written to or read from the tables.
+    """
+
+    __slots__ = ORDER_FIELDS
+
+    def __init__(self, id: Optional[int] = None, order_type: Optional[str] = None, quantity: Optional[float] = None,
+                 base_asset: Optional[str] = None, target_asset: Optional[str] = None, direction: Optional[str] = None,
+                 execution_price: Optional[float] = None, stop_price: Optional[float] = None,
+                 signal_price: Optional[float] = None, blocked_amount: Optional[float] = None,
+                 user_id: Optional[int] = None, bounded_order_id: Optional[int] = None,
+                 creation_date: Optional[datetime] = None, status: Optional[str] = None):
+        self.id = id
+        self.order_type = order_type
+        self.quantity = quantity
+        self.base_asset = base_asset
+        self.target_asset = target_asset
+        self.direction = direction
+        self.execution_price = execution_price
+        self.stop_price = stop_price
+        self.signal_price = signal_price
+        self.blocked_amount = blocked_amount
+        self.user_id = user_id
+        self.bounded_order_id = bounded_order_id
+        self.creation_date = creation_date
+        self.status = status
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in ORDER_FIELDS if getattr(self, name) is not None)
+        return f'OrderRecord({fields})'
+
+    def to_fields(self) -> dict:
+        """
+        JSON-compatible fields of the order, as stored in journal events and snapshots.
+        """
+        fields = {name: getattr(self, name) for name in ORDER_FIELDS}
+        fields['creation_date'] = self.creation_date.isoformat() if self.creation_date else None
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> 'OrderRecord':
+        values = {name: fields.get(name) for name in ORDER_FIELDS}
+        if values['creation_date']:
+            values['creation_date'] = datetime.fromisoformat(values['creation_date'])
+        return cls(**values)
+
+    @classmethod
+    def from_model(cls, model: BaseOrder) -> 'OrderRecord':
+        return cls(**{name: getattr(model, name, None) for name in ORDER_FIELDS})
+
+    def to_model(self) -> BaseOrder:
+        """
+        Table row of the order, only set fields its order type has a column for are passed.
+        """
+        values = {name: getattr(self, name) for name in MODEL_COLUMNS[self.order_type]}
+        return order_classes[self.order_type](**{name: value for name, value in values.items() if value is not None})
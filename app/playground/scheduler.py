@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import math
+import time
+from itertools import count
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from app.consts import MAX_BARS_PER_WAKEUP, MIN_TICK_INTERVAL, SCHEDULER_SLOT
+from app.utils.logger import get_logger
+from app.utils.metrics import tick_drift
+
+
+logger = get_logger('tick')
+
+
+# What every value of ``TickScheduler.stats`` measures, exported as gauges by the manager
+STATS_DOCUMENTATION = {
+    'scheduled_exchanges': 'Exchanges waiting in the tick scheduler.',
+    'wakeups': 'Wakeups of the tick scheduler since the process started.',
+    'ticks': 'Exchange ticks run by the scheduler since the process started.',
+    'bars': 'Klines advanced by the scheduler since the process started.',
+    'last_lag_seconds': 'How late the scheduler ran the last due exchanges.',
+    'max_lag_seconds': 'Largest delay of the scheduler behind the due exchanges.',
+    'last_tick_cost_seconds': 'Time the last batch of ticks took.',
+    'average_tick_cost_seconds': 'Average time of a tick.',
+}
+
+
+class TickScheduler:
+    """
+    Single clock driving the ticks of all running exchanges.
+
+    Exchanges sit in a heap keyed by their next due time. Every wakeup pops all exchanges due
+    within the same slot and ticks them together. Exchanges whose multiplier would need sleeps
+    shorter than ``MIN_TICK_INTERVAL`` advance several klines per wakeup instead, and so do
+    exchanges that fell behind, up to ``MAX_BARS_PER_WAKEUP``.
+
+    The due exchanges are handed to ``tick_batch`` as ``(exchange, bars)`` pairs in one call,
+    which lets exchanges sitting on the same bar be matched together.
+    """
+
+    def __init__(self, tick_batch: Callable[[List[Tuple[object, int]]], Awaitable[None]], slot: float = SCHEDULER_SLOT):
+        self.tick_batch = tick_batch
+        self.slot = slot
+        self.heap: List[Tuple[float, int, object]] = []
+        self.tokens: Dict[object, int] = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self._seq = count()
+
+        self.wakeups = 0
+        self.ticks = 0
+        self.bars = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.tick_time = 0.0
+        self.last_tick_cost = 0.0
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def add(self, exchange, delay: float = None):
+        """
+        Schedule an exchange, replacing its pending entry if it already has one.
+        """
+        if delay is None:
+            delay = exchange.tick_interval
+        self.__push(exchange, time.monotonic() + delay)
+
+        if not self.task or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        self.wakeup.set()
+
+    def remove(self, exchange):
+        """
+        Unschedule an exchange, its heap entry is dropped lazily when it comes due.
+        """
+        self.tokens.pop(exchange, None)
+
+    def stats(self) -> dict:
+        return {
+            'scheduled_exchanges': len(self.tokens),
+            'wakeups': self.wakeups,
+            'ticks': self.ticks,
+            'bars': self.bars,
+            'last_lag_seconds': self.last_lag,
+            'max_lag_seconds': self.max_lag,
+            'last_tick_cost_seconds': self.last_tick_cost,
+            'average_tick_cost_seconds': self.tick_time / self.ticks if self.ticks else 0.0,
+        }
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.__run_due()
+
+    async def __run_due(self):
+        now = time.monotonic()
+        horizon = now + self.slot
+        batch = []
+
+        while self.heap and self.heap[0][0] <= horizon:
+            due, token, exchange = heapq.heappop(self.heap)
+            if self.tokens.get(exchange) != token:
+                continue
+            if not exchange.is_running:
+                del self.tokens[exchange]
+                continue
+            batch.append((due, exchange))
+
+        if not batch:
+            return
+
+        self.wakeups += 1
+        self.last_lag = max(0.0, now - min(due for due, _ in batch))
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+        ticks = []
+        for due, exchange in batch:
+            tick_drift.observe(max(0.0, now - due))
+            interval = exchange.tick_interval
+            bars = max(1, math.ceil(MIN_TICK_INTERVAL / interval), int((now - due) / interval) + 1)
+            bars = min(bars, MAX_BARS_PER_WAKEUP)
+
+            next_due = due + bars * interval
+            if next_due < now:
+                # Too far behind to catch up, keep the pace from now on instead of spiralling
+                next_due = now + interval
+            self.__push(exchange, next_due)
+
+            ticks.append((exchange, bars))
+            self.bars += bars
+
+        started = time.perf_counter()
+        try:
+            await self.tick_batch(ticks)
+        except Exception as e:
+            logger.exception("Tick failed for %d exchanges: %r", len(ticks), e)
+        elapsed = time.perf_counter() - started
+
+        self.ticks += len(batch)
+        self.tick_time += elapsed
+        self.last_tick_cost = elapsed / len(batch)
+
+    def __push(self, exchange, due: float):
+        token = next(self._seq)
+        self.tokens[exchange] = token
+        heapq.heappush(self.heap, (due, token, exchange))
@@ -0,0 +1,266 @@
+import asyncio
+import bisect
+import fcntl
+import hashlib
+import os
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+from app.consts import (MAX_SHARDS, SHARD_DIRECTORY, SHARD_HANDOFF_POLL_INTERVAL, SHARD_HANDOFF_TIMEOUT,
+                        SHARD_REFRESH_INTERVAL, SHARD_VIRTUAL_NODES)
+from app.utils.logger import get_logger
+
+if TYPE_CHECKING:
+    # Only needed by a sharded deployment, imported on first use to keep the app import fast
+    import httpx
+    import uvicorn
+
+
+logger = get_logger('shards')
+
+
+# Marks a request proxied by another shard, it is served where it arrives
+FORWARDED_HEADER = 'x-forwarded-shard'
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'host'}
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring of shard slots.
+
+    Every slot is placed on the ring at ``virtual_nodes`` points and a user belongs to the slot of
+    the first point at or after the hash of their id. A slot joining or leaving only moves the
+    users of the points next to its own, about ``1 / len(slots)`` of all users.
+    """
+
+    def __init__(self, slots: Iterable[int], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        self.slots = frozenset(slots)
+        points = sorted((ring_hash(f'{slot}:{replica}'), slot) for slot in self.slots for replica in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [slot for _, slot in points]
+
+    def owner(self, user_id: int) -> Optional[int]:
+        if not self.hashes:
+            return None
+        index = bisect.bisect_left(self.hashes, ring_hash(str(user_id)))
+        return self.owners[index % len(self.owners)]
+
+
+class ShardRegistry:
+    """
+    Membership of the worker processes that split the exchanges between them.
+
+    A worker claims the lowest free slot by holding an exclusive lock on ``slot-N.lock`` for its
+    lifetime and serves the app on the Unix socket ``slot-N.sock``, where other workers proxy the
+    requests of the users it owns. A slot is live while its lock is held, so a crashed worker
+    drops out of the ring on the next refresh and its replacement takes the slot back.
+
+    Workers refresh the ring independently and disagree about the owner of some users for up to
+    ``refresh_interval`` after a change, so the ring only routes requests. A worker serves an
+    exchange only while it holds the exclusive lock on ``users/<user id>.lock``, taken before the
+    exchange is loaded and released once it is hibernated: the new owner of a user waits for the
+    old one to hand the exchange off, and no two workers ever journal events for the same user.
+    """
+
+    def __init__(self, directory: str = SHARD_DIRECTORY, max_shards: int = MAX_SHARDS,
+                 refresh_interval: float = SHARD_REFRESH_INTERVAL, handoff_timeout: float = SHARD_HANDOFF_TIMEOUT):
+        self.directory = directory
+        self.max_shards = max_shards
+        self.refresh_interval = refresh_interval
+        self.handoff_timeout = handoff_timeout
+        self.slot: Optional[int] = None
+        self.ring = HashRing(())
+        self.lock_file = None
+        self.user_locks: Dict[int, Any] = {}
+        self.server: Optional['uvicorn.Server'] = None
+        self.clients: Dict[int, 'httpx.AsyncClient'] = {}
+        self.tasks = []
+
+    def claim(self) -> int:
+        """
+        Take the lowest free slot.
+
+        Returns:
+            int: The slot of this process.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.max_shards):
+            lock_file = open(self.__path(slot, 'lock'), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+
+            self.slot, self.lock_file = slot, lock_file
+            if os.path.exists(self.socket_path(slot)):
+                # Left behind by a crashed worker
+                os.remove(self.socket_path(slot))
+            self.ring = HashRing(self.live_slots())
+            logger.info("Claimed shard slot %s", slot)
+            return slot
+
+        raise RuntimeError(f"All {self.max_shards} shard slots are taken")
+
+    def socket_path(self, slot: int) -> str:
+        return self.__path(slot, 'sock')
+
+    def live_slots(self) -> List[int]:
+        slots = []
+        for slot in range(self.max_shards):
+            if slot == self.slot:
+                slots.append(slot)
+                continue
+            if not os.path.exists(self.socket_path(slot)):
+                continue
+            with open(self.__path(slot, 'lock'), 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slots.append(slot)
+        return slots
+
+    def owner(self, user_id: int) -> Optional[int]:
+        """
+        Slot of the worker owning a user, None when it is this worker or sharding is off.
+        """
+        slot = self.ring.owner(user_id)
+        return None if slot == self.slot else slot
+
+    def lock_user(self, user_id: int) -> bool:
+        """
+        Take the lock on the exchange of a user without waiting, a lock this worker holds is taken already.
+
+        Returns:
+            bool: Whether this worker holds the lock now.
+        """
+        if user_id in self.user_locks:
+            return True
+
+        os.makedirs(os.path.join(self.directory, 'users'), exist_ok=True)
+        lock_file = open(os.path.join(self.directory, 'users', f'{user_id}.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.user_locks[user_id] = lock_file
+        return True
+
+    def unlock_user(self, user_id: int):
+        lock_file = self.user_locks.pop(user_id, None)
+        if lock_file is not None:
+            lock_file.close()
+
+    async def acquire_user(self, user_id: int):
+        """
+        Take the lock on the exchange of a user, waiting for the worker serving it to hibernate it.
+
+        Raises:
+            TimeoutError: Another worker still holds the lock after ``handoff_timeout``.
+        """
+        deadline = asyncio.get_running_loop().time() + self.handoff_timeout
+        while not await asyncio.to_thread(self.lock_user, user_id):
+            if asyncio.get_running_loop().time() >= deadline:
+                raise TimeoutError(f"The exchange of user {user_id} is still served by another shard")
+            await asyncio.sleep(SHARD_HANDOFF_POLL_INTERVAL)
+
+    async def start(self, app, on_change: Callable[[HashRing], Awaitable]):
+        """
+        Serve the app on the socket of the claimed slot and start following the membership.
+
+        Parameters:
+            app: ASGI app to serve to other workers.
+            on_change (Callable): Awaited with the new ring whenever slots join or leave.
+        """
+        import uvicorn
+
+        config = uvicorn.Config(app, uds=self.socket_path(self.slot), lifespan='off', log_level='warning')
+        self.server = uvicorn.Server(config)
+        # The process already handles signals through the main server
+        self.server.install_signal_handlers = lambda: None
+
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.server.serve()), loop.create_task(self.__follow(on_change))]
+
+    async def close(self):
+        for task in self.tasks[1:]:
+            task.cancel()
+        if self.server is not None:
+            self.server.should_exit = True
+            await asyncio.wait(self.tasks[:1])
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+        for user_id in list(self.user_locks):
+            self.unlock_user(user_id)
+
+        if self.lock_file is not None:
+            if os.path.exists(self.socket_path(self.slot)):
+                os.remove(self.socket_path(self.slot))
+            self.lock_file.close()
+            self.lock_file = None
+
+    async def forward(self, slot: int, request: Request) -> StreamingResponse:
+        """
+        Proxy a request to the worker of another slot, streaming its response back.
+        """
+        import httpx
+
+        headers = {name: value for name, value in request.headers.items() if name not in HOP_BY_HOP_HEADERS}
+        headers[FORWARDED_HEADER] = str(self.slot)
+        client = self.client(slot)
+        proxied = client.build_request(request.method, request.url.path, params=request.query_params.multi_items(),
+                                       headers=headers, content=await request.body())
+        try:
+            response = await client.send(proxied, stream=True)
+        except httpx.TransportError as e:
+            logger.warning("Shard %s is unavailable: %r", slot, e)
+            return JSONResponse({'detail': f'Shard {slot} is unavailable'}, status_code=503)
+
+        headers = {name: value for name, value in response.headers.items() if name not in HOP_BY_HOP_HEADERS}
+        return StreamingResponse(response.aiter_raw(), status_code=response.status_code, headers=headers,
+                                 background=BackgroundTask(response.aclose))
+
+    async def relay(self, slot: int, path: str, params: dict) -> AsyncIterator[str]:
+        """
+        Read a newline-delimited stream of messages from the worker of another slot.
+        """
+        async with self.client(slot).stream('GET', path, params=params, headers={FORWARDED_HEADER: str(self.slot)}) as response:
+            async for line in response.aiter_lines():
+                if line:
+                    yield line
+
+    def client(self, slot: int) -> 'httpx.AsyncClient':
+        import httpx
+
+        if slot not in self.clients:
+            self.clients[slot] = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=self.socket_path(slot)),
+                                                   base_url='http://shard', timeout=None)
+        return self.clients[slot]
+
+    async def __follow(self, on_change: Callable[[HashRing], Awaitable]):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                slots = await asyncio.to_thread(self.live_slots)
+                if frozenset(slots) == self.ring.slots:
+                    continue
+
+                logger.info("Shard slots changed from %s to %s", sorted(self.ring.slots), sorted(slots))
+                self.ring = HashRing(slots)
+                for slot in set(self.clients) - self.ring.slots:
+                    await self.clients.pop(slot).aclose()
+                await on_change(self.ring)
+            except Exception as e:
+                logger.exception("Shard membership refresh failed: %s", e)
+
+    def __path(self, slot: int, suffix: str) -> str:
+        return os.path.join(self.directory, f'slot-{slot}.{suffix}')
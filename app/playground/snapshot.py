@@ -0,0 +1,113 @@
+import json
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from app.consts import SNAPSHOT_DIRECTORY
+from app.playground.orders import OrderRecord
+
+
+SNAPSHOT_MAGIC = b'TPSN'
+SNAPSHOT_VERSION = 2
+# magic, version, user id, clock (-1 before the first tick), multiplier, commission, journal offset, journal seq
+SNAPSHOT_HEADER = struct.Struct('<4sHqqddqq')
+# Version 1 snapshots have no journal position
+SNAPSHOT_V1_HEADER = struct.Struct('<4sHqqdd')
+
+
+class ExchangeSnapshot:
+    """
+    Complete state of an exchange at one point in time.
+
+    The binary form is a fixed header with the clock and settings followed by a zlib compressed
+    JSON body holding the kline cursors, the open orders with their trigger state and the free
+    and reserved amount of every asset. Pending OCO links are the ``bounded_order_id`` of the
+    open orders, they are linked again when the orders are put back into the matching engines.
+
+    A snapshot also points at the journal the exchange kept writing to after it was taken: its
+    file name, a file offset to start reading at and the last ``seq`` already included. Resuming
+    applies the user's events after that point, so a snapshot only has to be rewritten when the
+    exchange moves to another journal.
+    """
+
+    def __init__(self, user_id: int, current_time: Optional[int], multiplier: float, commission: float,
+                 cursors: Dict[str, int], orders: List[Tuple[OrderRecord, bool]],
+                 balances: Optional[Dict[str, Tuple[float, float]]],
+                 journal: Optional[str] = None, offset: int = 0, seq: int = 0):
+        self.user_id = user_id
+        self.current_time = current_time
+        self.multiplier = multiplier
+        self.commission = commission
+        self.cursors = cursors
+        self.orders = orders
+        self.balances = balances
+        self.journal = journal
+        self.offset = offset
+        self.seq = seq
+
+    def to_bytes(self) -> bytes:
+        body = {
+            'cursors': self.cursors,
+            'orders': [dict(order.to_fields(), triggered=triggered) for order, triggered in self.orders],
+            'balances': self.balances,
+            'journal': self.journal,
+        }
+        current_time = -1 if self.current_time is None else self.current_time
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.user_id, current_time,
+                                      self.multiplier, self.commission, self.offset, self.seq)
+        return header + zlib.compress(json.dumps(body).encode())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ExchangeSnapshot':
+        magic, version = struct.unpack_from('<4sH', data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not an exchange snapshot')
+        if version == 1:
+            header = SNAPSHOT_V1_HEADER
+            _, _, user_id, current_time, multiplier, commission = header.unpack_from(data)
+            offset = seq = 0
+        elif version == SNAPSHOT_VERSION:
+            header = SNAPSHOT_HEADER
+            _, _, user_id, current_time, multiplier, commission, offset, seq = header.unpack_from(data)
+        else:
+            raise ValueError(f'Unsupported snapshot version: {version}')
+
+        body = json.loads(zlib.decompress(data[header.size:]))
+        orders = [(OrderRecord.from_fields(fields), fields['triggered']) for fields in body['orders']]
+        balances = {asset: tuple(amounts) for asset, amounts in body['balances'].items()} if body['balances'] is not None else None
+        return cls(user_id, None if current_time < 0 else current_time, multiplier, commission,
+                   body['cursors'], orders, balances, body.get('journal'), offset, seq)
+
+
+def snapshot_path(user_id: int, directory: str = SNAPSHOT_DIRECTORY) -> str:
+    return os.path.join(directory, f'{user_id}.snapshot')
+
+
+def write_snapshot(snapshot: ExchangeSnapshot, directory: str = SNAPSHOT_DIRECTORY):
+    """
+    Store a snapshot atomically, a crash while writing leaves the previous file in place.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(snapshot.user_id, directory)
+    with open(f'{path}.tmp', 'wb') as file:
+        file.write(snapshot.to_bytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+def read_snapshot(user_id: int, directory: str = SNAPSHOT_DIRECTORY) -> Optional[ExchangeSnapshot]:
+    """
+    Read the snapshot of a user with a single file read.
+
+    Returns:
+        ExchangeSnapshot: The snapshot or None if the user has no hibernated exchange.
+    """
+    try:
+        with open(snapshot_path(user_id, directory), 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    return ExchangeSnapshot.from_bytes(data)
+
@@ -1,21 +1,35 @@
 from datetime import datetime
 
-from app.data.db import get_session
+from app.data.db import get_db
 from app.data.models import User
-from fastapi import APIRouter
-from app.routers.mics import generate_api_key
+from fastapi import APIRouter, Depends
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.routers.mics import AuthenticatedUser, auth_cache, generate_api_key, get_current_user
 
 router = APIRouter()
 
 
 @router.post("/generate_api_key")
-async def generate_new_api_key():
+async def generate_new_api_key(session: AsyncSession = Depends(get_db)):
 
     new_api_key = generate_api_key()
  
-    session = get_session()
     new_user = User(creation_date = datetime.now(), api_key = new_api_key)
     session.add(new_user)
-    session.commit()
+    await session.commit()
+
+    auth_cache.set(new_api_key, AuthenticatedUser(id=new_user.id, api_key=new_api_key))
 
     return {"message": "New API key generated", "api_key": new_api_key}
+
+
+@router.post("/revoke_api_key")
+async def revoke_api_key(user: AuthenticatedUser = Depends(get_current_user), session: AsyncSession = Depends(get_db)):
+
+    await session.execute(update(User).where(User.id == user.id).values(api_key=None))
+    await session.commit()
+
+    auth_cache.invalidate(user.api_key)
+
+    return {"message": "API key revoked"}
@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.consts import DEFAULT_COMISSION
+from app.data.choices import OPEN
+from app.data.db import get_db
+from app.data.models import Balance, BaseOrder
+from app.extensions import backtest_jobs, exchanges_manager
+from app.playground.orders import OrderRecord
+from app.routers.mics import AuthenticatedUser, get_current_user
+
+router = APIRouter()
+
+
+@router.post("/run")
+async def run_backtest(start: datetime,
+                       end: datetime,
+                       commission: float = DEFAULT_COMISSION,
+                       user: AuthenticatedUser = Depends(get_current_user),
+                       session: AsyncSession = Depends(get_db)):
+    """
+    Replay the klines between ``start`` and ``end`` over the user's open orders and balances.
+
+    The backtest runs in the background, poll ``/playground/backtest/{job_id}`` for the result.
+    """
+    if end < start:
+        raise HTTPException(status_code=422, detail="end must not be before start")
+
+    # Orders placed or closed a moment ago may still wait in the journal for the tables
+    await exchanges_manager.journal.project()
+    # Filled and cancelled orders are already part of the balances, only open ones are replayed
+    open_orders = await session.scalars(select(BaseOrder).filter_by(user_id=user.id, status=OPEN))
+    orders = [OrderRecord.from_model(order) for order in open_orders]
+    balances = {entry.asset_name: entry.amount for entry in await session.scalars(select(Balance).filter_by(user_id=user.id))}
+
+    job_id = backtest_jobs.submit(user.id, orders, balances,
+                                  int(start.replace(tzinfo=start.tzinfo or timezone.utc).timestamp()),
+                                  int(end.replace(tzinfo=end.tzinfo or timezone.utc).timestamp()),
+                                  commission)
+
+    return {"message": f"Backtest started for {len(orders)} orders", "job_id": job_id}
+
+
+@router.get("/{job_id}")
+async def get_backtest(job_id: str, user: AuthenticatedUser = Depends(get_current_user)):
+
+    job = backtest_jobs.get(user.id, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"No backtest found with ID: {job_id}")
+
+    return {"message": f"Backtest {job['status']}", "job_id": job_id, "result": job['result'], "error": job['error']}
@@ -1,25 +1,20 @@
 
-from app.data.db import get_session
-from app.data.models import User
-from app.routers.mics import secured, verify_api_key
+import asyncio
+from typing import AsyncIterator
+
+from app.routers.mics import AuthenticatedUser, get_current_user, resolve_api_key, secured, verify_api_key
 
 from app.extensions import exchanges_manager
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
 
 
 router = APIRouter()
 
 @secured
 @router.post("/start_exchange")
-async def start_exchange(api_key: str):
-
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-
-    ecxchange = exchanges_manager.start_exchange(user)
+async def start_exchange(user: AuthenticatedUser = Depends(get_current_user)):
+    ecxchange = await exchanges_manager.start_exchange(user)
 
     if ecxchange: 
         return {"message": f'Exchange is up for user: {user.api_key}'}
@@ -27,26 +22,94 @@ async def start_exchange(api_key: str):
 
 @secured
 @router.post("/stop_exchange")
-async def stop_exchange(api_key: str):
-
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-
-    message = exchanges_manager.stop_exchange(user)
+async def stop_exchange(user: AuthenticatedUser = Depends(get_current_user)):
+    message = await exchanges_manager.stop_exchange(user)
     return {"message": message}
     
 @secured
 @router.post("/set_multiplier")
-async def set_multiplier(api_key: str, multiplier: float):
+async def set_multiplier(multiplier: float = Query(..., gt=0), user: AuthenticatedUser = Depends(get_current_user)):
+    message = exchanges_manager.set_multiplier(user, multiplier)
+    return {"message": message}
+
+
+async def local_updates(user_id: int) -> AsyncIterator[str]:
+    """
+    Messages published for a user by this process, ending once the subscription overflows.
+    """
+    subscription = exchanges_manager.broadcaster.subscribe(user_id)
+    try:
+        while True:
+            message = await subscription.get()
+            if message is None:
+                return
+            yield message
+    finally:
+        exchanges_manager.broadcaster.unsubscribe(subscription)
+
 
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
+def user_updates(user: AuthenticatedUser) -> AsyncIterator[str]:
+    """
+    Messages for a user, relayed from the shard owning their exchange when it is another process.
+    """
+    shards = exchanges_manager.shards
+    slot = shards.owner(user.id) if shards else None
+    if slot is None:
+        return local_updates(user.id)
+    return shards.relay(slot, "/playground/exchange/updates", {"api_key": user.api_key})
 
+
+@secured
+@router.get("/updates")
+async def stream_updates(user: AuthenticatedUser = Depends(get_current_user)):
+    """
+    The messages of the ``/ws`` endpoint as newline-delimited JSON, for clients without WebSocket support.
+    """
+    async def lines():
+        async for message in local_updates(user.id):
+            yield message + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.websocket("/ws")
+async def exchange_updates(websocket: WebSocket, api_key: str):
+    """
+    Push the updates of the user's exchange: every new bar, order fills, cancellations and balance changes.
+
+    Messages are JSON objects with a ``type`` of ``bar``, ``fill``, ``cancel`` or ``balance``.
+    A connection that falls more than ``SUBSCRIPTION_QUEUE_SIZE`` messages behind is closed
+    with code 1013, the client should resync its state over the REST endpoints and reconnect.
+    """
+    user = await resolve_api_key(api_key)
     if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    message = exchanges_manager.set_multiplier(user, multiplier)
-    return {"message": message}
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    updates = user_updates(user)
+
+    async def send_updates():
+        async for message in updates:
+            await websocket.send_text(message)
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Too slow, resync and reconnect")
+
+    async def wait_for_disconnect():
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            return
+
+    tasks = [asyncio.ensure_future(send_updates()), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await updates.aclose()
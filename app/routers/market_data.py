@@ -0,0 +1,203 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.consts import KLINE_INTERVAL, KLINE_TIMEFRAMES, KLINES_MAX_PAGE_SIZE, KLINES_PAGE_SIZE, KLINES_STREAM_CHUNK_SIZE
+from app.data.db import get_db
+from app.data.kline_store import kline_store
+from app.data.models import Kline
+from app.extensions import exchanges_manager
+from app.routers.mics import AuthenticatedUser, get_current_user, secured
+from app.utils.formats import JSON, available_formats, encode_klines, negotiate
+
+router = APIRouter()
+
+
+@secured
+@router.get("/klines")
+async def get_klines(currency: str,
+                     start: Optional[datetime] = None,
+                     end: Optional[datetime] = None,
+                     cursor: Optional[datetime] = None,
+                     limit: int = Query(KLINES_PAGE_SIZE, gt=0, le=KLINES_MAX_PAGE_SIZE),
+                     timeframe: Optional[str] = None,
+                     accept: Optional[str] = Header(None),
+                     user: AuthenticatedUser = Depends(get_current_user),
+                     session: AsyncSession = Depends(get_db)):
+    """
+    Page through the klines of a currency in time order.
+
+    Pages are keyed by timestamp: pass the ``next_cursor`` of a response as ``cursor`` to get
+    the following page, so every page is one range scan of the (currency_name, timestamp) index.
+    Higher timeframes are paged the same way over the rollups of the kline store.
+
+    Binary pages are sent for an Accept header naming one of the formats of ``app.utils.formats``,
+    their next cursor is returned in the ``X-Next-Cursor`` header.
+    """
+    media_type = negotiate_format(accept)
+    check_timeframe(timeframe)
+
+    if timeframe is not None and KLINE_TIMEFRAMES[timeframe] != KLINE_INTERVAL:
+        series = await get_series(currency, timeframe)
+        first, last = series_range(series, start, end, cursor)
+        stop = min(first + limit, last)
+        columns = {name: np.asarray(values[first:stop]) for name, values in series.columns().items()} if first < stop else None
+        next_cursor = datetime.utcfromtimestamp(int(series.timestamps[stop - 1])) if first < stop < last else None
+        message = f"Retrieved {stop - first if columns else 0} {timeframe} klines for {currency}"
+    else:
+        query = (
+            select(Kline.timestamp, Kline.open_price, Kline.high_price, Kline.low_price, Kline.close_price, Kline.volume)
+            .where(Kline.currency_name == currency)
+            .order_by(Kline.timestamp)
+            .limit(limit + 1)
+        )
+        if cursor:
+            query = query.where(Kline.timestamp > cursor)
+        if start:
+            query = query.where(Kline.timestamp >= start)
+        if end:
+            query = query.where(Kline.timestamp <= end)
+
+        rows = (await session.execute(query)).all()
+
+        next_cursor = rows[limit - 1].timestamp if len(rows) > limit else None
+        message = f"Retrieved {len(rows[:limit])} klines for {currency}"
+        if media_type == JSON:
+            klines = [
+                {
+                    "timestamp": row.timestamp,
+                    "open": row.open_price,
+                    "high": row.high_price,
+                    "low": row.low_price,
+                    "close": row.close_price,
+                    "volume": row.volume,
+                }
+                for row in rows[:limit]
+            ]
+            return {"message": message, "klines": klines, "next_cursor": next_cursor}
+
+        columns = rows_to_columns(rows[:limit]) if rows else None
+
+    if media_type == JSON:
+        return {"message": message, "klines": columns_to_klines(columns) if columns else [], "next_cursor": next_cursor}
+
+    headers = {"X-Next-Cursor": next_cursor.isoformat()} if next_cursor else {}
+    return Response(b"".join(encode_klines([columns] if columns else [], media_type)), media_type=media_type, headers=headers)
+
+
+@secured
+@router.get("/klines/stream")
+async def stream_klines(currency: str,
+                        start: Optional[datetime] = None,
+                        end: Optional[datetime] = None,
+                        timeframe: Optional[str] = None,
+                        accept: Optional[str] = Header(None),
+                        user: AuthenticatedUser = Depends(get_current_user)):
+    """
+    Download a whole range of klines in one chunked response.
+
+    The body is produced chunk by chunk from the memory-mapped kline store, so ranges of any
+    size are sent without being materialized in server memory.
+    """
+    media_type = negotiate_format(accept)
+    check_timeframe(timeframe)
+
+    series = await get_series(currency, timeframe)
+    first, last = series_range(series, start, end)
+
+    return StreamingResponse(encode_klines(iter_chunks(series, first, last), media_type), media_type=media_type)
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+    media_type = negotiate(accept)
+    if media_type is None:
+        raise HTTPException(status_code=406, detail=f"Supported formats: {available_formats()}")
+    return media_type
+
+
+def check_timeframe(timeframe: Optional[str]):
+    if timeframe is not None and timeframe not in KLINE_TIMEFRAMES:
+        raise HTTPException(status_code=400, detail=f"Unknown timeframe {timeframe}, expected one of {list(KLINE_TIMEFRAMES)}")
+
+
+def to_epoch(value: datetime) -> int:
+    """Epoch seconds of a datetime, naive datetimes are taken as UTC like the stored klines."""
+    return int(value.replace(tzinfo=value.tzinfo or timezone.utc).timestamp())
+
+
+async def get_series(currency: str, timeframe: Optional[str]):
+    series = await asyncio.to_thread(kline_store.get, currency, timeframe)
+    if series is None and timeframe is not None and KLINE_TIMEFRAMES[timeframe] < KLINE_INTERVAL:
+        raise HTTPException(status_code=400, detail=f"Timeframe {timeframe} is finer than the stored klines")
+    return series
+
+
+def series_range(series, start: Optional[datetime], end: Optional[datetime], cursor: Optional[datetime] = None) -> Tuple[int, int]:
+    """
+    Index range of the bars of a store series between ``start`` and ``end`` and after ``cursor``.
+    """
+    if series is None:
+        return 0, 0
+
+    first = series.index_of(to_epoch(start)) if start else 0
+    if cursor:
+        first = max(first, int(np.searchsorted(series.timestamps, to_epoch(cursor), side='right')))
+    last = int(np.searchsorted(series.timestamps, to_epoch(end), side='right')) if end else len(series)
+    return first, last
+
+
+def iter_chunks(series, first: int, last: int, chunk_size: int = KLINES_STREAM_CHUNK_SIZE) -> Iterator[Dict[str, np.ndarray]]:
+    for start in range(first, last, chunk_size):
+        stop = min(start + chunk_size, last)
+        yield {name: np.asarray(values[start:stop]) for name, values in series.columns().items()}
+
+
+def rows_to_columns(rows) -> Dict[str, np.ndarray]:
+    timestamps, *values = zip(*rows)
+    columns = {'timestamps': np.array(timestamps, dtype='datetime64[s]').astype(np.int64)}
+    for name, column in zip(('open', 'high', 'low', 'close', 'volume'), values):
+        columns[name] = np.array(column, dtype=np.float64)
+    return columns
+
+
+def columns_to_klines(columns: Dict[str, np.ndarray]) -> List[dict]:
+    return [
+        {
+            "timestamp": datetime.utcfromtimestamp(timestamp),
+            "open": open_price,
+            "high": high_price,
+            "low": low_price,
+            "close": close_price,
+            "volume": volume,
+        }
+        for timestamp, open_price, high_price, low_price, close_price, volume in zip(
+            *(columns[name].tolist() for name in ('timestamps', 'open', 'high', 'low', 'close', 'volume'))
+        )
+    ]
+
+
+@secured
+@router.get("/current_kline")
+async def get_current_kline(currency: str, timeframe: str, user: AuthenticatedUser = Depends(get_current_user)):
+    """
+    The bar of a timeframe the user's exchange clock is currently in, partial while its bucket is open.
+    """
+    if timeframe not in KLINE_TIMEFRAMES:
+        raise HTTPException(status_code=400, detail=f"Unknown timeframe {timeframe}, expected one of {list(KLINE_TIMEFRAMES)}")
+
+    exchange, message = await exchanges_manager.get_exchange(user)
+    if not exchange:
+        return message
+
+    kline = exchange.current_kline(currency, timeframe)
+    if kline is None:
+        return {"message": f"No {timeframe} kline of {currency} reached yet"}
+
+    kline["timestamp"] = datetime.utcfromtimestamp(kline["timestamp"])
+    return {"message": f"Current {timeframe} kline of {currency}", "kline": kline}
@@ -1,27 +1,70 @@
 # Function to generate an API key
+from dataclasses import dataclass
 from functools import wraps
 import secrets
+from typing import Optional
 
 from fastapi import HTTPException
+from sqlalchemy import select
 
-from app.data.db import get_session
+from app.consts import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+from app.data.db import get_async_session
 from app.data.models import User
+from app.utils.cache import MISSING, TTLCache
+
+
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    id: int
+    api_key: str
+
+
+# API key -> AuthenticatedUser. Unknown keys are not cached: a key created by another worker works
+# at once, and requests with random keys cannot evict the keys of real users.
+auth_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
 
 
 def generate_api_key():
     return secrets.token_urlsafe(32)
 
-def verify_api_key(api_key: str):
-    session = get_session()
-    api_in_db = bool(session.query(User).filter_by(api_key=api_key).first())
-    return api_in_db
+async def resolve_api_key(api_key: str) -> Optional[AuthenticatedUser]:
+    """
+    Resolve an API key to its user, hitting the database only when the key is not cached.
+
+    Returns:
+        AuthenticatedUser: The user or None if no user has the key.
+    """
+    user = auth_cache.get(api_key)
+    if user is not MISSING:
+        return user
+
+    async with get_async_session() as session:
+        user_id = await session.scalar(select(User.id).filter_by(api_key=api_key))
+    if not user_id:
+        return None
+
+    user = AuthenticatedUser(id=user_id, api_key=api_key)
+    auth_cache.set(api_key, user)
+    return user
+
+async def get_current_user(api_key: str) -> AuthenticatedUser:
+    """
+    FastAPI dependency resolving the ``api_key`` query parameter once per request.
+    """
+    user = await resolve_api_key(api_key)
+    if not user:
+        raise HTTPException(status_code=403, detail="Provide valid API key")
+    return user
+
+async def verify_api_key(api_key: str):
+    return bool(await resolve_api_key(api_key))
 
 def secured(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         api_key = kwargs.get("api_key")
-        if not verify_api_key(api_key):
+        if not await verify_api_key(api_key):
             raise HTTPException(status_code=403, detail="Invalid API key")
         return await func(*args, **kwargs)
 
-    return wrapper  
\ No newline at end of file
+    return wrapper  
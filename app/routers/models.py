@@ -11,6 +11,7 @@ class Order(BaseModel):
     stop_price: Optional[float] = None
     signal_price: Optional[float] = None
     blocked_amount: Optional[float] = None
+    bounded_order_id: Optional[int] = None
 
 
 
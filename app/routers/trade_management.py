@@ -1,69 +1,126 @@
-from app.data.db import get_session
-from app.data.models import User
+import json
+import time
+from dataclasses import fields as dataclass_fields
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Column, Select, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncResult, AsyncSession
+
+from app.consts import MAX_BATCH_ORDERS, ORDERS_MAX_PAGE_SIZE, ORDERS_PAGE_SIZE, ORDERS_STREAM_CHUNK_SIZE
+from app.data.choices import OrderStatus, order_classes
+from app.data.db import get_db
+from app.data.models import BaseOrder
 from app.extensions import exchanges_manager
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
 from app.playground.order_factory import OrderFactory
-from app.routers.mics import secured
+from app.playground.orders import ORDER_FIELDS
+from app.routers.mics import AuthenticatedUser, get_current_user, secured
 from app.routers.models import Order
+from app.utils.metrics import place_order_latency
 
 router = APIRouter()
 
 @secured
 @router.post("/place_order")
-async def place_order(order_data: Order, api_key: str):
-    
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
+async def place_order(order_data: Order, user: AuthenticatedUser = Depends(get_current_user)):
+    started = time.perf_counter()
+    try:
+        order, message = OrderFactory.create_order(order_data)
+        if not order:
+            return message
 
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    order, message = OrderFactory.create_order(order_data)
-    if not order:
-        return message 
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+        exchange, message = await exchanges_manager.start_exchange(user)
+        if not exchange:
+            return message
+
+        return await exchange.place_order(user, order)
+    finally:
+        place_order_latency.observe(time.perf_counter() - started)
+
+
+@secured
+@router.post("/place_orders")
+async def place_orders(orders_data: List[Order] = Body(..., max_items=MAX_BATCH_ORDERS),
+                       all_or_nothing: bool = True,
+                       user: AuthenticatedUser = Depends(get_current_user)):
+    """
+    Place a batch of orders in one transaction.
+
+    With ``all_or_nothing`` no order is placed unless all of them are valid and funded,
+    otherwise every valid and funded order is placed. Results are reported per order.
+    """
+    orders, results = [], []
+    for order_data in orders_data:
+        order, message = OrderFactory.create_order(order_data)
+        orders.append(order)
+        results.append(message)
+
+    if all_or_nothing and not all(orders):
+        results = [message or {'message': 'Batch rejected, another order is invalid'} for message in results]
+        return {"message": "No orders placed", "placed": 0, "results": results}
+
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
 
-    message = exchange.place_order(order)
+    valid_orders = [order for order in orders if order]
+    placed = iter(await exchange.place_orders(user, valid_orders, all_or_nothing=all_or_nothing) if valid_orders else [])
+    results = [next(placed)[1] if order else message for order, message in zip(orders, results)]
 
-    return message
+    placed_count = sum(1 for order in valid_orders if order.id is not None)
+    return {"message": f"{placed_count} of {len(orders)} orders placed", "placed": placed_count, "results": results}
 
 
 @secured
 @router.get("/orders")
-async def get_open_orders(api_key: str):
-    
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
+async def get_orders(status: Optional[str] = None,
+                     order_type: Optional[str] = None,
+                     asset: Optional[str] = None,
+                     start: Optional[datetime] = None,
+                     end: Optional[datetime] = None,
+                     cursor: Optional[str] = None,
+                     limit: int = Query(ORDERS_PAGE_SIZE, gt=0, le=ORDERS_MAX_PAGE_SIZE),
+                     fields: Optional[str] = None,
+                     user: AuthenticatedUser = Depends(get_current_user),
+                     session: AsyncSession = Depends(get_db)):
+    """
+    Page through the orders of the user in creation order, open and historical ones alike.
 
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+    Orders can be filtered by status, order type, traded asset and creation time. Pages are keyed
+    by (creation_date, id): pass the ``next_cursor`` of a response as ``cursor`` to get the
+    following page, so every page is one range scan of the (user_id, creation_date, id) index.
+    ``fields`` is a comma separated list of the order fields to return, only those columns are
+    loaded. The page is streamed from a database cursor as it is encoded.
+    """
+    columns = order_columns(fields.split(',') if fields else ORDER_FIELDS)
+    after = parse_cursor(cursor)
+    if status is not None and status not in ORDER_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Unknown status {status}, expected one of {ORDER_STATUSES}")
+    if order_type is not None and order_type not in order_classes:
+        raise HTTPException(status_code=400, detail=f"Unknown order type {order_type}, expected one of {list(order_classes)}")
+
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
-    
-    orders, message = exchange.get_order_by_id(user_id=user.id)
+    # Orders placed or closed a moment ago may still wait in the journal for the tables
+    await exchange.journal.project()
+
+    query = orders_query(user.id, columns, status, order_type, asset, start, end, after, limit)
+    rows = await session.stream(query.execution_options(yield_per=ORDERS_STREAM_CHUNK_SIZE))
+
+    return StreamingResponse(encode_orders(rows, list(columns), limit), media_type="application/json")
 
-    return {"message": f"Open orders retrieved: {orders}"}
 
 @secured
 @router.get("/orders/{order_id}")
-async def get_open_orders(order_id, api_key: str):
-    
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+async def get_open_orders(order_id, user: AuthenticatedUser = Depends(get_current_user)):
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
     
-    order, message = exchange.get_order_by_id(user_id=user.id, order_id=order_id)
+    order, message = await exchange.get_order_by_id(user_id=user.id, order_id=order_id)
 
     if not order:
         return message
@@ -73,69 +130,139 @@ async def get_open_orders(order_id, api_key: str):
 
 @secured
 @router.post("/cancel_order/{order_id}")
-async def cancel_order(api_key: str, order_id: str):
-    
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+async def cancel_order(order_id: int, user: AuthenticatedUser = Depends(get_current_user)):
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
 
-    return {"message": f"Order {order_id} canceled"}
+    cancelled, message = await exchange.cancel_order_by_id(order_id)
+    if not cancelled:
+        raise HTTPException(status_code=404, detail=message['message'])
+
+    return message
 
 @secured
 @router.get("/asset_balance")
-async def get_asset_balance(api_key: str):
-
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+async def get_asset_balance(user: AuthenticatedUser = Depends(get_current_user)):
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
     
-    balances, message = exchange.get_balance(user_id=user.id)
+    balances, message = await exchange.get_balance(user_id=user.id)
 
     return {"message": f"Asset balance retrieved {balances}"}
 
 
 @secured
 @router.get("/asset_balance/{asset_name}")
-async def get_asset_balance(api_key: str):
-
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+async def get_asset_balance(user: AuthenticatedUser = Depends(get_current_user)):
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
     
-    balance, message = exchange.get_balance(user_id=user.id)
+    balance, message = await exchange.get_balance(user_id=user.id)
 
     return {"message": f"Asset balance retrieved: {balance}"}
 
 @secured
 @router.get("/statistics")
-async def get_statistics(api_key: str):
-    
-    session = get_session()
-    user = session.query(User).filter_by(api_key=api_key).first()
-
-    if not user:
-        raise HTTPException(status_code=403, detail="Provide valid API key")
-    
-    exchange, message = exchanges_manager.start_exchange(user)
+async def get_statistics(user: AuthenticatedUser = Depends(get_current_user)):
+    exchange, message = await exchanges_manager.start_exchange(user)
     if not exchange:
         return message
 
     return {"message": "Statistics retrieved"}
+
+
+# Column of every order field, the type-specific ones are in their own tables unless ORDERS_SINGLE_TABLE
+ORDER_COLUMNS: Dict[str, Column] = {}
+for mapper in BaseOrder.__mapper__.self_and_descendants:
+    for column in mapper.local_table.columns:
+        if column.key in ORDER_FIELDS:
+            ORDER_COLUMNS.setdefault(column.key, column)
+
+ORDER_STATUSES = [field.default for field in dataclass_fields(OrderStatus)]
+
+
+def order_columns(names: List[str]) -> Dict[str, Column]:
+    unknown = [name for name in names if name not in ORDER_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown order fields {unknown}, expected some of {list(ORDER_COLUMNS)}")
+    return {name: ORDER_COLUMNS[name] for name in names}
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """
+    Creation date and id of the last order of the previous page, from a ``<ISO datetime>,<id>`` cursor.
+    """
+    if not cursor:
+        return None
+    try:
+        creation_date, order_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(creation_date), int(order_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor {cursor}")
+
+
+def orders_query(user_id: int, columns: Dict[str, Column], status: Optional[str], order_type: Optional[str],
+                 asset: Optional[str], start: Optional[datetime], end: Optional[datetime],
+                 cursor: Optional[Tuple[datetime, int]], limit: int) -> Select:
+    """
+    Select the requested columns of one page of orders plus one order telling whether another page follows.
+
+    The creation date and id always come first, the cursor of the next page is built from them.
+    """
+    orders = BaseOrder.__table__
+    selected = [orders.c.creation_date, orders.c.id, *columns.values()]
+    from_clause = orders
+    for table in dict.fromkeys(column.table for column in selected):
+        if table is not orders:
+            from_clause = from_clause.outerjoin(table, table.c.id == orders.c.id)
+
+    query = (
+        select(*selected)
+        .select_from(from_clause)
+        .where(orders.c.user_id == user_id)
+        .order_by(orders.c.creation_date, orders.c.id)
+        .limit(limit + 1)
+    )
+    if status:
+        query = query.where(orders.c.status == status)
+    if order_type:
+        query = query.where(orders.c.order_type == order_type)
+    if asset:
+        query = query.where(orders.c.target_asset == asset)
+    if start:
+        query = query.where(orders.c.creation_date >= start)
+    if end:
+        query = query.where(orders.c.creation_date <= end)
+    if cursor:
+        query = query.where(tuple_(orders.c.creation_date, orders.c.id) > tuple_(*cursor))
+    return query
+
+
+def encode_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+async def encode_orders(rows: AsyncResult, names: List[str], limit: int) -> AsyncIterator[bytes]:
+    """
+    Encode a page of order rows as one JSON document, chunk by chunk as they are fetched.
+
+    Numbers stay numbers, dates are ISO strings and missing values null. The order past the page
+    only tells that another page follows, it is not sent.
+    """
+    yield b'{"orders": ['
+    count, last, has_more = 0, None, False
+    async for partition in rows.partitions():
+        if count + len(partition) > limit:
+            has_more = True
+            partition = partition[:limit - count]
+        if partition:
+            orders = ','.join(json.dumps(dict(zip(names, row[2:])), default=encode_value) for row in partition)
+            yield (b',' if count else b'') + orders.encode()
+            count += len(partition)
+            last = partition[-1]
+
+    next_cursor = f"{last[0].isoformat()},{last[1]}" if has_more else None
+    yield f'], "message": "Retrieved {count} orders", "next_cursor": {json.dumps(next_cursor)}}}'.encode()
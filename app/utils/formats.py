@@ -0,0 +1,142 @@
+import json
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional
+
+import numpy as np
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+ARROW = 'application/vnd.apache.arrow.stream'
+MSGPACK = 'application/msgpack'
+NUMPY = 'application/octet-stream'
+
+ALIASES = {'application/x-msgpack': MSGPACK, 'application/vnd.msgpack': MSGPACK}
+
+# Rows of the raw NumPy format, clients read them back with ``np.frombuffer(body, dtype=KLINE_DTYPE)``
+KLINE_DTYPE = np.dtype([('timestamp', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+                        ('close', '<f8'), ('volume', '<f8')])
+
+ARROW_EOS = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+def available_formats() -> list:
+    formats = [JSON, NUMPY]
+    if pyarrow is not None:
+        formats.append(ARROW)
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    return formats
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """
+    Pick the response format for an Accept header.
+
+    Media types are tried by descending quality, wildcards resolve to JSON.
+
+    Returns:
+        str: The chosen media type or None if none of the accepted types can be produced.
+    """
+    if not accept:
+        return JSON
+
+    formats = available_formats()
+    candidates = []
+    for position, item in enumerate(accept.split(',')):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, ALIASES.get(media_type.lower(), media_type.lower())))
+
+    for _, _, media_type in sorted(candidates):
+        if media_type in ('*/*', 'application/*'):
+            return JSON
+        if media_type in formats:
+            return media_type
+    return None
+
+
+def encode_klines(chunks: Iterable[Dict[str, np.ndarray]], media_type: str) -> Iterator[bytes]:
+    """
+    Encode chunks of kline columns as a byte stream of the given media type.
+
+    Every chunk is encoded on its own, so only one chunk has to be held in memory:
+    - JSON is a single array of kline objects.
+    - Arrow is an IPC stream with one record batch per chunk.
+    - msgpack is a sequence of maps of column lists, one per chunk, read with ``msgpack.Unpacker``.
+    - NumPy is the concatenation of little-endian ``KLINE_DTYPE`` records.
+
+    Parameters:
+        chunks (Iterable[dict]): Column arrays named like the KlineStore columns, timestamps as epoch seconds.
+        media_type (str): One of the media types returned by ``negotiate``.
+
+    Yields:
+        bytes: Encoded parts of the response body.
+    """
+    if media_type == ARROW:
+        yield from encode_arrow(chunks)
+    elif media_type == MSGPACK:
+        for columns in chunks:
+            yield msgpack.packb({name: values.tolist() for name, values in columns.items()})
+    elif media_type == NUMPY:
+        for columns in chunks:
+            records = np.empty(len(columns['timestamps']), dtype=KLINE_DTYPE)
+            records['timestamp'] = columns['timestamps']
+            for name in KLINE_DTYPE.names[1:]:
+                records[name] = columns[name]
+            yield records.tobytes()
+    else:
+        yield from encode_json(chunks)
+
+
+def encode_arrow(chunks: Iterable[Dict[str, np.ndarray]]) -> Iterator[bytes]:
+    schema = pyarrow.schema([('timestamp', pyarrow.timestamp('s', tz='UTC'))] +
+                            [(name, pyarrow.float64()) for name in KLINE_DTYPE.names[1:]])
+    yield schema.serialize().to_pybytes()
+
+    for columns in chunks:
+        arrays = [pyarrow.array(np.asarray(columns['timestamps'], dtype=np.int64)).cast(schema.field('timestamp').type)]
+        arrays += [pyarrow.array(np.asarray(columns[name], dtype=np.float64)) for name in KLINE_DTYPE.names[1:]]
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema).serialize().to_pybytes()
+
+    yield ARROW_EOS
+
+
+def encode_json(chunks: Iterable[Dict[str, np.ndarray]]) -> Iterator[bytes]:
+    separator = b'['
+    for columns in chunks:
+        if not len(columns['timestamps']):
+            continue
+        rows = [
+            {
+                'timestamp': datetime.utcfromtimestamp(timestamp).isoformat(),
+                'open': open_price,
+                'high': high_price,
+                'low': low_price,
+                'close': close_price,
+                'volume': volume,
+            }
+            for timestamp, open_price, high_price, low_price, close_price, volume in zip(
+                *(columns[name].tolist() for name in ('timestamps', 'open', 'high', 'low', 'close', 'volume'))
+            )
+        ]
+        yield separator + json.dumps(rows)[1:-1].encode()
+        separator = b','
+
+    yield b']' if separator == b',' else b'[]'
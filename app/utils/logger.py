@@ -1,9 +1,119 @@
+import atexit
+import copy
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Union
 
-logging.basicConfig(format=u'%(asctime)s - %(levelname)s - %(module)s %(funcName)s - %(message)s',
-                    level=logging.INFO,
-                    # level=logging.DEBUG,
-                    filename='app.log',
-                    filemode='a')
+from app.consts import LOG_FILE, LOG_LEVEL, LOG_LEVELS, LOG_SAMPLE_RATES
 
-logger = logging.getLogger()
+
+LOG_FORMAT = u'%(asctime)s - %(levelname)s - %(name)s %(module)s %(funcName)s - %(message)s'
+# Renders tracebacks before records are queued
+exception_formatter = logging.Formatter()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts records on the queue with their message rendered but not formatted, the listener thread
+    applies ``LOG_FORMAT``.
+
+    As in ``QueueHandler.prepare``, the arguments are merged into the message and the traceback is
+    rendered to text on the logging thread, so the listener never sees arguments changed after the
+    call and the queue keeps no frames alive.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = exception_formatter.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets one in ``rate`` records below WARNING through, warnings and errors always pass.
+    """
+
+    def __init__(self, rate: int = 1):
+        super().__init__()
+        self.rate = rate
+        self.count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate <= 1:
+            return True
+        self.count += 1
+        return self.count % self.rate == 1
+
+
+def get_logger(subsystem: str = None) -> logging.Logger:
+    """
+    Logger of a subsystem such as ``tick``, ``exchange``, ``journal`` or ``shards``.
+    """
+    return logging.getLogger(f'app.{subsystem}' if subsystem else 'app')
+
+
+def set_log_level(subsystem: str, level: Union[int, str]):
+    """
+    Change the level of a subsystem at runtime, ``None`` or ``''`` addresses every subsystem.
+    """
+    get_logger(subsystem).setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def set_sample_rate(subsystem: str, rate: int):
+    """
+    Keep one in ``rate`` records below WARNING of a subsystem, 1 keeps all of them.
+    """
+    subsystem_logger = get_logger(subsystem)
+    sample_filter = next((item for item in subsystem_logger.filters if isinstance(item, SampleFilter)), None)
+    if sample_filter is None:
+        sample_filter = SampleFilter(rate)
+        subsystem_logger.addFilter(sample_filter)
+    sample_filter.rate = rate
+
+
+def configure_logging() -> QueueListener:
+    """
+    Route every record through a queue to a background thread that writes ``LOG_FILE``.
+
+    Logging then never blocks the event loop on file IO, the listener is stopped and the queue
+    drained at interpreter exit. Called by the app lifespan and entry points rather than on
+    import, calling it again returns the running listener.
+    """
+    global listener
+    if listener is not None:
+        return listener
+
+    records = queue.SimpleQueue()
+    file_handler = logging.FileHandler(LOG_FILE, mode='a')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(DeferredQueueHandler(records))
+
+    for subsystem, level in LOG_LEVELS.items():
+        set_log_level(subsystem, level)
+    for subsystem, rate in LOG_SAMPLE_RATES.items():
+        set_sample_rate(subsystem, rate)
+
+    listener.start()
+    atexit.register(stop_logging, listener)
+    return listener
+
+
+def stop_logging(listener: QueueListener):
+    """
+    Write the queued records and stop the listener thread, calling it again does nothing.
+    """
+    if listener._thread is not None:
+        listener.stop()
+
+
+listener: Optional[QueueListener] = None
+logger = get_logger()
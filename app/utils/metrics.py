@@ -0,0 +1,152 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.consts import LATENCY_BUCKETS, LOOP_LAG_INTERVAL
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Histogram:
+    """
+    Prometheus histogram with fixed buckets.
+
+    The counts are allocated once and ``observe`` only bumps one of them, the cumulative bucket
+    values of the text format are computed when the metrics are scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.bounds = tuple(sorted(buckets))
+        # One extra count for the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {total}')
+        lines.append(f'{self.name}_sum {format_value(self.sum)}')
+        lines.append(f'{self.name}_count {total}')
+        return lines
+
+
+class Gauge:
+    """
+    Prometheus gauge read from a callback at scrape time.
+
+    The callback returns the value, or a list of ``(labels, value)`` pairs for a labelled gauge,
+    so the instrumented code does not have to keep it up to date.
+    """
+
+    def __init__(self, name: str, documentation: str, collect: Callable):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        value = self.collect()
+        samples: List[Tuple[Dict[str, str], float]] = value if isinstance(value, list) else [({}, value)]
+        for labels, sample in samples:
+            lines.append(f'{self.name}{format_labels(labels)} {format_value(sample)}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def histogram(self, name: str, documentation: str, buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, documentation, buckets))
+
+    def gauge(self, name: str, documentation: str, collect: Callable) -> Gauge:
+        """
+        Register a gauge, registering a name again replaces the callback of the previous one.
+        """
+        return self.__register(Gauge(name, documentation, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def __register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+
+metrics = MetricsRegistry()
+
+tick_drift = metrics.histogram('playground_tick_drift_seconds',
+                               'Delay between the scheduled and the actual tick of every exchange.')
+resolve_latency = metrics.histogram('playground_order_resolve_seconds',
+                                    'Time to match a bar and apply the fills of the exchanges sitting on it.')
+place_order_latency = metrics.histogram('playground_place_order_seconds',
+                                        'End-to-end latency of the place_order endpoint.')
+db_query_latency = metrics.histogram('playground_db_query_seconds', 'Execution time of database statements.')
+db_commit_latency = metrics.histogram('playground_db_commit_seconds', 'Flush and commit time of database sessions.')
+loop_lag = metrics.histogram('playground_event_loop_lag_seconds',
+                             'How late the event loop ran a callback scheduled to run on time.')
+
+
+def instrument_engine(engine: Engine):
+    """
+    Time every statement executed on a sync engine, pass ``sync_engine`` for an async one.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(connection, cursor, statement, parameters, context, executemany):
+        connection.info['query_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info.pop('query_started', None)
+        if started is not None:
+            db_query_latency.observe(time.perf_counter() - started)
+
+
+@event.listens_for(Session, 'before_commit')
+def start_commit(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def end_commit(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        db_commit_latency.observe(time.perf_counter() - started)
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """
+    Sleep for ``interval`` over and over, observing by how much every wakeup overshot it.
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
+
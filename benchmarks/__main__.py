@@ -0,0 +1,61 @@
+"""
+Run the benchmark suite and record its results.
+
+    python -m benchmarks [--quick] [--no-history] [--history PATH]
+
+The suite runs in a scratch directory with its own SQLite database, journal and kline store
+built from a seeded synthetic dataset, so results only depend on the code and the machine.
+Every run is appended to the history file as a JSON line and compared with the previous run of
+the same size on the same machine, the exit status is 1 when a result regressed or missed its
+target.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_HISTORY = os.path.join(REPOSITORY, 'benchmarks', 'history.jsonl')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--quick', action='store_true', help='small sizes only, to check that the suite runs')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help='JSON lines file the results are appended to')
+    parser.add_argument('--no-history', action='store_true', help='do not read or write the history')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='playground-bench-')
+    # The app reads its paths and database URL when it is imported
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.pop('ASYNC_DATABASE_URL', None)
+    os.chdir(workdir)
+    sys.path.insert(0, REPOSITORY)
+
+    from benchmarks import history, suite
+
+    try:
+        results = suite.run(workdir, REPOSITORY, quick=args.quick)
+    finally:
+        os.chdir(REPOSITORY)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if not args.no_history:
+        previous = history.previous_run(history.read_history(args.history), args.quick)
+        history.append_history(args.history, results, history.git_revision(REPOSITORY), args.quick)
+
+    regressed = False
+    for name, result, change, is_regression in history.compare(results, previous):
+        change = '' if change is None else f'{change:+.1%}'
+        over_target = 'target' in result and result['value'] > result['target']
+        flags = ('  REGRESSION' if is_regression else '') + (f"  OVER TARGET {result['target']:g}" if over_target else '')
+        print(f"{name:<48} {result['value']:>14.6g} {result['unit']:<8} {change:>8}{flags}")
+        regressed |= is_regression or over_target
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
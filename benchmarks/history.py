@@ -0,0 +1,77 @@
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+# Fraction by which a result may get worse than the previous run before it is reported
+REGRESSION_THRESHOLD = 0.1
+
+
+def git_revision(directory: str) -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as history:
+        return [json.loads(line) for line in history if line.strip()]
+
+
+def append_history(path: str, results: Dict[str, dict], revision: Optional[str], quick: bool) -> dict:
+    """
+    Append the results of a run to the history file as one JSON line.
+
+    Returns:
+        dict: The stored run.
+    """
+    run = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'quick': quick,
+        'results': results,
+    }
+    with open(path, 'a') as history:
+        history.write(json.dumps(run) + '\n')
+    return run
+
+
+def previous_run(history: List[dict], quick: bool) -> Optional[dict]:
+    """
+    Latest run of the same size on the same machine, results of other machines are not comparable.
+    """
+    for run in reversed(history):
+        if run['quick'] == quick and run['machine'] == platform.node():
+            return run
+    return None
+
+
+def compare(results: Dict[str, dict], previous: Optional[dict],
+            threshold: float = REGRESSION_THRESHOLD) -> List[Tuple[str, dict, Optional[float], bool]]:
+    """
+    Relative change of every result against the previous run.
+
+    Returns:
+        list: ``(name, result, change, regressed)`` tuples, the change is positive when the result
+        improved and None when the previous run does not have it.
+    """
+    rows = []
+    for name, result in results.items():
+        before = (previous or {}).get('results', {}).get(name)
+        if not before or not before['value']:
+            rows.append((name, result, None, False))
+            continue
+        change = (result['value'] - before['value']) / before['value']
+        if not result['higher_is_better']:
+            change = -change
+        rows.append((name, result, change, change < -threshold))
+    return rows
@@ -0,0 +1,261 @@
+import asyncio
+import csv
+import math
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List
+
+import httpx
+import numpy as np
+from sqlalchemy import delete
+
+from app.consts import KLINE_INTERVAL, STARTUP_TARGET_SECONDS
+from app.data.db import create_kline, get_async_engine, get_session, initialize_database
+from app.data.kline_store import kline_store
+from app.data.models import Balance, Kline, User
+from app.playground.exchange import DemoExchange
+from app.playground.journal import EventJournal
+from app.playground.ledger import LedgerStore
+from app.playground.matching import tick_exchanges
+from app.playground.orders import OrderRecord
+from app.playground.scheduler import TickScheduler
+from app.utils.logger import configure_logging
+from app.utils.metrics import tick_drift
+
+
+BENCH_ASSET = 'benchcoin'
+BENCH_SEED = 1234
+# Far below every synthetic price, so resting buy orders are matched against every bar but never filled
+RESTING_PRICE = 0.01
+MAX_TARGET_BARS = 100000
+RESOLUTION_ROUNDS = 5
+
+
+# Imports the app, runs its lifespan and serves one request, printing the seconds that took
+COLD_START_SCRIPT = '''
+import time
+started = time.perf_counter()
+import asyncio
+import httpx
+from app.main import app
+
+async def main():
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+            (await client.get('/ready')).raise_for_status()
+        print(time.perf_counter() - started)
+
+asyncio.run(main())
+'''
+
+
+def result(value: float, unit: str, higher_is_better: bool = True, target: float = None) -> dict:
+    measured = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+    if target is not None:
+        measured['target'] = target
+    return measured
+
+
+def write_klines_csv(path: str, rows: int, seed: int = BENCH_SEED):
+    """
+    Write a daily kline CSV of a seeded random walk, the same file for the same arguments.
+    """
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, rows)))
+    open_ = np.concatenate(([100.0], close[:-1]))
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.02, rows))
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.02, rows))
+    volume = rng.uniform(1e6, 1e8, rows)
+    dates = np.datetime64('1970-01-01') + np.arange(rows)
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Date', 'Open', 'High', 'Low', 'Close', 'Volume'])
+        for row in zip(dates.astype(str), open_.round(6), high.round(6), low.round(6), close.round(6), volume.round(2)):
+            writer.writerow(row)
+
+
+def bench_ingestion(path: str, rows: int) -> Dict[str, dict]:
+    """
+    Rows per second ``create_kline`` loads from the synthetic CSV, the klines stay for the other benchmarks.
+    """
+    write_klines_csv(path, rows)
+    with get_session() as session:
+        session.execute(delete(Kline).filter_by(currency_name=BENCH_ASSET))
+        session.commit()
+
+        started = time.perf_counter()
+        inserted = create_kline(session, BENCH_ASSET, path)
+        elapsed = time.perf_counter() - started
+
+    kline_store.build(BENCH_ASSET)
+    return {'ingestion.create_kline': result(inserted / elapsed, 'rows/s')}
+
+
+def bench_cold_start(workdir: str, repository: str, runs: int) -> Dict[str, dict]:
+    """
+    Seconds from importing the app to its first served request, best of ``runs`` fresh processes.
+    """
+    environment = dict(os.environ, PYTHONPATH=repository)
+    seconds = []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], cwd=workdir, env=environment,
+                                   capture_output=True, text=True, check=True)
+        seconds.append(float(completed.stdout.strip().splitlines()[-1]))
+    return {'startup.cold_start': result(min(seconds), 's', higher_is_better=False, target=STARTUP_TARGET_SECONDS)}
+
+
+def bench_exchange(user_id: int, multiplier: float) -> DemoExchange:
+    exchange = DemoExchange(user_id, multiplier=multiplier, last_used_timestamp=int(kline_store.get(BENCH_ASSET).timestamps[0]),
+                            ledgers=LedgerStore(EventJournal(path=None)))
+    exchange.assets.add(BENCH_ASSET)
+    return exchange
+
+
+async def bench_ticks(counts: List[int], multipliers: List[float], duration: float) -> Dict[str, dict]:
+    """
+    Bars advanced per second and mean tick drift of ``count`` exchanges running on the scheduler.
+
+    Combinations asking for more than ``MAX_TARGET_BARS`` per second are skipped, an overloaded
+    scheduler ticks ``MAX_BARS_PER_WAKEUP`` bars of every exchange without yielding and would
+    not stop within any useful time.
+    """
+    results = {}
+    for count in counts:
+        for multiplier in multipliers:
+            if count * multiplier > MAX_TARGET_BARS:
+                continue
+            scheduler = TickScheduler(partial(tick_exchanges, matching_engines={}))
+            exchanges = [bench_exchange(user_id, multiplier) for user_id in range(count)]
+            first_time = exchanges[0].current_time
+            drift_sum, drift_count = tick_drift.sum, sum(tick_drift.counts)
+
+            started = time.perf_counter()
+            for exchange in exchanges:
+                exchange.start()
+                scheduler.add(exchange)
+            # Half an interval of slack, so the tick due at the end of the duration is counted
+            await asyncio.sleep(duration + 0.5 / multiplier)
+            for exchange in exchanges:
+                exchange.stop()
+                scheduler.remove(exchange)
+            elapsed = time.perf_counter() - started
+            scheduler.task.cancel()
+
+            bars = sum(exchange.current_time - first_time for exchange in exchanges) / KLINE_INTERVAL
+            observed = sum(tick_drift.counts) - drift_count
+            name = f'ticks.{count}x{multiplier:g}'
+            results[f'{name}.bars_per_second'] = result(bars / elapsed, 'bars/s')
+            results[f'{name}.target_ratio'] = result(bars / (count * math.floor(duration * multiplier)), 'ratio')
+            results[f'{name}.mean_drift'] = result((tick_drift.sum - drift_sum) / observed if observed else 0.0, 's',
+                                                   higher_is_better=False)
+    return results
+
+
+async def bench_resolution(order_counts: List[int], bars: int) -> Dict[str, dict]:
+    """
+    Cost of a tick of one exchange as the number of its resting orders grows.
+    """
+    results = {}
+    for order_count in order_counts:
+        exchange = bench_exchange(0, 1)
+        exchange.ledger = exchange.ledgers.restore(0, {'usd': 1e18})
+        orders = [OrderRecord(creation_date=datetime.now(), order_type='limit', quantity=1, base_asset='usd',
+                              target_asset=BENCH_ASSET, direction='buy', execution_price=RESTING_PRICE)
+                  for _ in range(order_count)]
+        await exchange.place_orders(User(id=0), orders)
+        exchange.start()
+
+        # Best of several rounds, a single round is easily skewed by the rest of the machine
+        costs = []
+        for _ in range(RESOLUTION_ROUNDS):
+            started = time.perf_counter()
+            await exchange.tick(bars)
+            costs.append((time.perf_counter() - started) / bars)
+        results[f'resolution.{order_count}_orders'] = result(min(costs), 's/bar', higher_is_better=False)
+    return results
+
+
+async def bench_place_order(requests: int, concurrency: int) -> Dict[str, dict]:
+    """
+    Throughput of ``place_order`` through the ASGI app, one request at a time and ``concurrency`` at a time.
+    """
+    from app.main import app
+
+    with get_session() as session:
+        user = User(creation_date=datetime.now(), api_key='benchmark')
+        session.add(user)
+        session.commit()
+        session.add(Balance(user_id=user.id, asset_name='usd', amount=1e18))
+        session.commit()
+
+    order = {'order_type': 'limit', 'quantity': 1, 'base_asset': 'usd', 'target_asset': BENCH_ASSET,
+             'direction': 'buy', 'execution_price': RESTING_PRICE}
+    url = '/playground/exchange/trade/place_order'
+    results = {}
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+            async def place():
+                response = await client.post(url, params={'api_key': 'benchmark'}, json=order)
+                response.raise_for_status()
+                if not response.json().get('message', '').startswith('Order placed'):
+                    raise RuntimeError(f'Order was not placed: {response.text}')
+
+            # The first request loads the exchange and starts the journal
+            await place()
+
+            started = time.perf_counter()
+            for _ in range(requests):
+                await place()
+            results['place_order.sequential'] = result(requests / (time.perf_counter() - started), 'orders/s')
+
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def limited():
+                async with semaphore:
+                    await place()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(limited() for _ in range(requests)))
+            results[f'place_order.concurrent_{concurrency}'] = result(requests / (time.perf_counter() - started), 'orders/s')
+    return results
+
+
+async def run_async(quick: bool) -> Dict[str, dict]:
+    results = {}
+    if quick:
+        results.update(await bench_ticks([1, 100], [10, 100], duration=0.5))
+        results.update(await bench_resolution([10, 1000], bars=10))
+        results.update(await bench_place_order(requests=50, concurrency=8))
+    else:
+        results.update(await bench_ticks([1, 100, 10000], [1, 10, 100], duration=3))
+        results.update(await bench_resolution([10, 100, 1000, 10000, 100000], bars=50))
+        results.update(await bench_place_order(requests=1000, concurrency=32))
+    await get_async_engine().dispose()
+    return results
+
+
+def run(workdir: str, repository: str, quick: bool = False, report: Callable[[str], None] = print) -> Dict[str, dict]:
+    """
+    Run the whole suite in ``workdir``, the process must already use the database and stores of that directory.
+
+    Parameters:
+        workdir (str): Scratch directory holding the database, journal, snapshots and synthetic data.
+        repository (str): Root of the code under test, for the benchmarks run in fresh processes.
+        quick (bool): Run small sizes only, to check the suite still works.
+        report (Callable): Receives a line per finished benchmark group.
+    """
+    configure_logging()
+    initialize_database()
+    results = bench_ingestion(os.path.join(workdir, f'{BENCH_ASSET}.csv'), rows=2000 if quick else 50000)
+    report('ingestion done')
+    results.update(asyncio.run(run_async(quick)))
+    report('exchange benchmarks done')
+    results.update(bench_cold_start(workdir, repository, runs=1 if quick else 5))
+    report('cold start done')
+    return results
@@ -0,0 +1,56 @@
+"""
+The app reads its paths and database URL when it is imported, so the tests run in a scratch
+directory with their own SQLite database, journal, snapshots and kline store.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+
+import pytest
+
+WORKDIR = tempfile.mkdtemp(prefix='playground-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ.pop('ASYNC_DATABASE_URL', None)
+os.chdir(WORKDIR)
+
+from app.data.db import create_kline, get_async_engine, get_engine, get_session, initialize_database  # noqa: E402
+from app.data.kline_store import kline_store  # noqa: E402
+
+
+ASSET = 'coin'
+# Daily klines opening at 100, 101, ... with a range of 5 below and above the open
+KLINES = [(100.0 + day, 105.0 + day, 95.0 + day, 101.0 + day) for day in range(30)]
+
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    initialize_database()
+
+    path = os.path.join(WORKDIR, f'{ASSET}.csv')
+    with open(path, 'w') as csv_file:
+        csv_file.write('Date,Open,High,Low,Close,Volume\n')
+        for day, (open_price, high, low, close) in enumerate(KLINES):
+            csv_file.write(f'1970-01-{day + 1:02d},{open_price},{high},{low},{close},1000\n')
+    with get_session() as session:
+        create_kline(session, ASSET, path)
+    kline_store.build(ASSET)
+
+    yield
+    get_engine().dispose()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def run():
+    """
+    Run a coroutine on a new event loop, the pooled async connections are closed before the loop is.
+    """
+    def run(coroutine):
+        async def main():
+            try:
+                return await coroutine
+            finally:
+                await get_async_engine().dispose()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import numpy as np
+
+from app.data.choices import BUY, LIMIT, SELL
+from app.data.kline_store import COLUMNS, kline_store
+from app.playground.backtest import run_backtest
+from app.playground.orders import OrderRecord
+
+DAY = 86400
+
+
+def order(order_id, target_asset, direction, price, blocked_amount):
+    return OrderRecord(id=order_id, order_type=LIMIT, quantity=1.0, base_asset='usd', target_asset=target_asset,
+                       direction=direction, execution_price=price, blocked_amount=blocked_amount, user_id=1,
+                       creation_date=datetime(2024, 1, 1))
+
+
+def test_assets_are_valued_before_their_first_bar():
+    # Listed on day 10 at 50 and never moving, the session series trades from day 0
+    kline_store.save('listed', {name: np.full(5, 50.0, dtype=dtype) for name, dtype in COLUMNS.items()}
+                     | {'timestamps': np.arange(10, 15, dtype=np.int64) * DAY})
+
+    result = run_backtest([order(1, 'coin', BUY, 10.0, 10.0), order(2, 'listed', SELL, 1000.0, 1.0)],
+                          {'usd': 1000.0, 'listed': 2.0}, start=0, end=14 * DAY)
+
+    assert result.fills == []
+    assert [equity for _, equity in result.equity_curve] == [1100.0] * 15
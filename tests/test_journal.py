@@ -0,0 +1,166 @@
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import select
+
+from app.data.choices import BUY, CANCELLED, FILLED, LIMIT, OPEN, STOP_LIMIT
+from app.data.db import get_async_session
+from app.data.models import Balance, BaseOrder, JournalCheckpoint
+from app.playground.exchange import DemoExchange
+from app.playground.journal import (BALANCE_DELTA, ORDER_CANCELLED, ORDER_FILLED, ORDER_PLACED, ORDER_TRIGGERED,
+                                    EventJournal, read_events)
+from app.playground.ledger import LedgerStore
+from app.playground.orders import OrderRecord
+
+
+def order(order_id, user_id, order_type=LIMIT, price=90.0, stop_price=None):
+    return OrderRecord(id=order_id, order_type=order_type, quantity=1.0, base_asset='usd', target_asset='coin',
+                       direction=BUY, execution_price=price, stop_price=stop_price, blocked_amount=price,
+                       user_id=user_id, creation_date=datetime(2024, 1, 1), status=OPEN)
+
+
+def journal_at(tmp_path, name):
+    # Projected on demand only, so the tests decide what the tables hold
+    return EventJournal(os.path.join(tmp_path, 'events.log'), checkpoint_name=name, projection_interval=3600)
+
+
+async def orders_of(user_id):
+    async with get_async_session() as session:
+        orders = (await session.scalars(select(BaseOrder).filter_by(user_id=user_id).order_by(BaseOrder.id))).all()
+    return [(order.id, order.status) for order in orders]
+
+
+async def balances_of(user_id):
+    async with get_async_session() as session:
+        balances = await session.scalars(select(Balance).filter_by(user_id=user_id))
+    return {balance.asset_name: balance.amount for balance in balances}
+
+
+def test_projection_applies_orders_statuses_and_balance_deltas(run, tmp_path):
+    user_id = 201
+
+    async def scenario():
+        journal = journal_at(tmp_path, 'projection')
+        await journal.start()
+        first, second, third = (journal.allocate_order_id() for _ in range(3))
+        journal.append(ORDER_PLACED, user_id, order=order(first, user_id).to_fields())
+        journal.append(ORDER_PLACED, user_id, order=order(second, user_id).to_fields())
+        await journal.sync()
+        await journal.project()
+
+        journal.append(ORDER_PLACED, user_id, order=order(third, user_id).to_fields())
+        journal.append(ORDER_FILLED, user_id, order_id=first, price=90.0)
+        journal.append(ORDER_CANCELLED, user_id, order_id=third, order_type=LIMIT)
+        journal.append(BALANCE_DELTA, user_id, order_id=first, deltas={'usd': -99.0, 'coin': 1.0})
+        await journal.close()
+
+        async with get_async_session() as session:
+            checkpoint = await session.get(JournalCheckpoint, 'projection')
+        return await orders_of(user_id), await balances_of(user_id), checkpoint.seq, checkpoint.offset, journal.offset
+
+    orders, balances, seq, offset, end = run(scenario())
+    assert [status for _, status in orders] == [FILLED, OPEN, CANCELLED]
+    assert balances == {'usd': -99.0, 'coin': 1.0}
+    assert seq == 6 and offset == end
+
+
+def test_start_projects_the_events_left_by_a_crashed_process(run, tmp_path):
+    user_id = 202
+    placed = order(900001, user_id)
+    with open(os.path.join(tmp_path, 'events.log'), 'wb') as journal_file:
+        journal_file.write(json.dumps({'seq': 1, 'type': ORDER_PLACED, 'user_id': user_id, 'order': placed.to_fields()}).encode() + b'\n')
+        journal_file.write(json.dumps({'seq': 2, 'type': BALANCE_DELTA, 'user_id': user_id, 'deltas': {'usd': 5.0}}).encode() + b'\n')
+        # Torn by the crash, neither projected nor kept
+        journal_file.write(b'{"seq": 3, "type": "balance_del')
+
+    async def scenario():
+        journal = journal_at(tmp_path, 'recovery')
+        await journal.start()
+        seq, next_order_id = journal.seq, journal.next_order_id
+        await journal.close()
+        return seq, next_order_id, await orders_of(user_id), await balances_of(user_id)
+
+    seq, next_order_id, orders, balances = run(scenario())
+    assert seq == 2
+    assert next_order_id == placed.id + 1
+    assert orders == [(placed.id, OPEN)]
+    assert balances == {'usd': 5.0}
+    events, _ = read_events(os.path.join(tmp_path, 'events.log'))
+    assert [event['seq'] for event in events] == [1, 2]
+
+
+def test_events_of_reads_one_users_events_after_a_position(run, tmp_path):
+    async def scenario():
+        journal = journal_at(tmp_path, 'events-of')
+        await journal.start()
+        for user_id in (1, 2, 1, 3, 1):
+            journal.append(BALANCE_DELTA, user_id, deltas={})
+        await journal.sync()
+        everything = await journal.events_of(1)
+        later = await journal.events_of(1, after_seq=3)
+        others = await journal.events_of(2, os.path.basename(journal.path))
+        await journal.close()
+        return everything, later, others
+
+    everything, later, others = run(scenario())
+    assert [event['seq'] for event in everything] == [1, 3, 5]
+    assert [event['seq'] for event in later] == [5]
+    assert [event['seq'] for event in others] == [2]
+
+
+def test_replay_rebuilds_the_resting_orders_of_a_user(run):
+    user_id = 203
+    events = [
+        {'type': ORDER_PLACED, 'order': order(1, user_id).to_fields()},
+        {'type': ORDER_PLACED, 'order': order(2, user_id).to_fields()},
+        {'type': ORDER_PLACED, 'order': order(3, user_id, STOP_LIMIT, price=108.0, stop_price=105.0).to_fields()},
+        {'type': ORDER_FILLED, 'order_id': 1},
+        {'type': ORDER_TRIGGERED, 'order_id': 3},
+        {'type': BALANCE_DELTA, 'deltas': {'usd': -99.0, 'coin': 1.0}},
+        {'type': BALANCE_DELTA, 'deltas': {'usd': -1.0}},
+    ]
+
+    async def scenario():
+        exchange = DemoExchange(user_id, ledgers=LedgerStore(EventJournal(path=None)))
+        deltas = await exchange.replay(events)
+        # Replaying the placement of a resting order does not rest it twice
+        await exchange.replay(events[1:2])
+        return exchange.matching_engines['coin'].resting_orders(user_id), deltas
+
+    resting, deltas = run(scenario())
+    assert [(resting_order.id, triggered) for resting_order, triggered in resting] == [(2, False), (3, True)]
+    assert deltas == {'usd': -100.0, 'coin': 1.0}
+
+
+def test_rotate_continues_in_a_new_file_and_keeps_the_old_one_until_discarded(run, tmp_path):
+    async def scenario():
+        journal = journal_at(tmp_path, 'rotation')
+        await journal.start()
+        journal.append(BALANCE_DELTA, 204, deltas={'usd': 1.0})
+        journal.append(BALANCE_DELTA, 205, deltas={'usd': 1.0})
+        await journal.sync()
+
+        name, user_ids = await journal.rotate()
+        journal.append(BALANCE_DELTA, 204, deltas={'usd': 2.0})
+        await journal.sync()
+        old_events = await journal.events_of(204, name)
+        new_events = await journal.events_of(204)
+        await journal.discard(name)
+        await journal.close()
+
+        # A restarted journal continues in the file the checkpoint names
+        restarted = journal_at(tmp_path, 'rotation')
+        await restarted.start()
+        path, seq = restarted.path, restarted.seq
+        await restarted.close()
+        return name, user_ids, journal.path, old_events, new_events, path, seq, await balances_of(204)
+
+    name, user_ids, path, old_events, new_events, restarted_path, seq, balances = run(scenario())
+    assert name == 'events.log' and os.path.basename(path) == 'events.2.log'
+    assert sorted(user_ids) == [204, 205]
+    assert [event['seq'] for event in old_events] == [1]
+    assert [event['seq'] for event in new_events] == [3]
+    assert not os.path.exists(os.path.join(tmp_path, name))
+    assert restarted_path == path and seq == 3
+    assert balances == {'usd': 3.0}
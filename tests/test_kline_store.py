@@ -0,0 +1,32 @@
+import json
+import os
+
+import numpy as np
+
+from app.data.kline_store import COLUMNS, MANIFEST, KlineStore
+
+
+def columns(length):
+    return {name: np.arange(length, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def test_a_save_replaces_the_previous_version_of_the_files(tmp_path):
+    store = KlineStore(str(tmp_path))
+    store.save('unlisted', columns(3))
+    store.save('unlisted', columns(5))
+
+    series = KlineStore(str(tmp_path)).get('unlisted')
+
+    assert len(series) == 5 and series.close.tolist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert len(os.listdir(tmp_path / 'unlisted')) == len(COLUMNS) + 1
+
+
+def test_files_that_do_not_match_the_manifest_are_not_loaded(tmp_path):
+    store = KlineStore(str(tmp_path))
+    store.save('unlisted', columns(3))
+    manifest_path = tmp_path / 'unlisted' / MANIFEST
+    manifest = json.loads(manifest_path.read_text())
+    manifest_path.write_text(json.dumps(dict(manifest, length=4)))
+
+    # Rebuilt from the database instead, which has no klines of the currency
+    assert KlineStore(str(tmp_path)).get('unlisted') is None
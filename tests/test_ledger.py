@@ -0,0 +1,89 @@
+import os
+
+from app.data.choices import BUY, LIMIT, SELL
+from app.data.db import get_async_session
+from app.data.models import Balance
+from app.playground.exchange import fill_deltas
+from app.playground.journal import BALANCE_DELTA, EventJournal
+from app.playground.ledger import BalanceLedger, LedgerEntry, LedgerStore
+from app.playground.orders import OrderRecord
+
+
+def order(direction=BUY, quantity=2.0, price=10.0, blocked_amount=None, user_id=1):
+    return OrderRecord(id=1, order_type=LIMIT, quantity=quantity, base_asset='usd', target_asset='coin',
+                       direction=direction, execution_price=price, blocked_amount=blocked_amount, user_id=user_id)
+
+
+def test_reserve_moves_free_funds_and_refuses_what_is_not_free():
+    ledger = BalanceLedger(1, EventJournal(path=None), {'usd': LedgerEntry(free=100.0)})
+
+    assert ledger.reserve('usd', 60.0)
+    assert not ledger.reserve('usd', 60.0)
+    assert ledger.get('usd').to_dict() == {'free': 40.0, 'reserved': 60.0}
+
+    ledger.release('usd', 60.0)
+    assert ledger.get('usd').to_dict() == {'free': 100.0, 'reserved': 0.0}
+
+
+def test_reserve_refuses_amounts_that_are_not_positive():
+    ledger = BalanceLedger(1, EventJournal(path=None), {'usd': LedgerEntry(free=100.0)})
+
+    assert not ledger.reserve('usd', -1000.0)
+    assert not ledger.reserve('usd', 0.0)
+    assert not ledger.reserve('usd', float('nan'))
+    assert ledger.get('usd').to_dict() == {'free': 100.0, 'reserved': 0.0}
+
+
+def test_settle_releases_the_reservation_and_journals_the_fill():
+    journal = EventJournal(path=None)
+    ledger = BalanceLedger(1, journal, {'usd': LedgerEntry(free=100.0)})
+    buy = order(blocked_amount=22.0)
+    ledger.reserve('usd', buy.blocked_amount)
+
+    deltas = fill_deltas(buy, 10.0, 0.1)
+    ledger.settle(buy, deltas)
+
+    assert ledger.get('usd').reserved == 0.0
+    assert ledger.balances() == {'usd': 78.0, 'coin': 2.0}
+    assert journal.seq == 1
+
+
+def test_covers_counts_the_reservation_of_the_order():
+    ledger = BalanceLedger(1, EventJournal(path=None), {'usd': LedgerEntry(free=5.0, reserved=22.0)})
+    buy = order(blocked_amount=22.0)
+
+    assert ledger.covers(buy, fill_deltas(buy, 10.0, 0.1))
+    assert not ledger.covers(buy, fill_deltas(buy, 20.0, 0.1))
+    assert not ledger.covers(order(direction=SELL), {'coin': -2.0, 'usd': 18.0})
+
+
+def test_restore_reserves_the_blocked_amounts_of_resting_orders():
+    store = LedgerStore(EventJournal(path=None))
+    ledger = store.restore(1, {'usd': 100.0, 'coin': 3.0},
+                           [order(blocked_amount=22.0), order(direction=SELL, blocked_amount=2.0)])
+
+    assert ledger.get('usd').to_dict() == {'free': 78.0, 'reserved': 22.0}
+    assert ledger.get('coin').to_dict() == {'free': 1.0, 'reserved': 2.0}
+    assert store.ledgers[1] is ledger
+
+
+def test_load_adds_the_unprojected_deltas_to_the_balances_table(run, tmp_path):
+    user_id = 101
+
+    async def load():
+        async with get_async_session() as session:
+            session.add(Balance(user_id=user_id, asset_name='usd', amount=100.0))
+            await session.commit()
+
+        journal = EventJournal(os.path.join(tmp_path, 'events.log'), checkpoint_name='ledger-load', projection_interval=3600)
+        await journal.start()
+        journal.append(BALANCE_DELTA, user_id, order_id=1, deltas={'usd': -25.0, 'coin': 2.0})
+        journal.append(BALANCE_DELTA, user_id + 1, order_id=2, deltas={'usd': -50.0})
+        await journal.sync()
+        try:
+            ledger = await LedgerStore(journal).load(user_id)
+        finally:
+            await journal.close()
+        return ledger.balances()
+
+    assert run(load()) == {'usd': 75.0, 'coin': 2.0}
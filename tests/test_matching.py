@@ -0,0 +1,136 @@
+from app.data.choices import BUY, LIMIT, MARKET, OCO, SELL, STOP_LIMIT
+from app.playground.matching import INITIAL_CAPACITY, MatchingEngine
+from app.playground.orders import OrderRecord
+
+
+def order(order_id, order_type=LIMIT, direction=BUY, price=100.0, stop_price=None, user_id=1, bounded_order_id=None):
+    return OrderRecord(id=order_id, order_type=order_type, quantity=1.0, base_asset='usd', target_asset='coin',
+                       direction=direction, execution_price=price, stop_price=stop_price, user_id=user_id,
+                       bounded_order_id=bounded_order_id)
+
+
+def fills(results, owner):
+    return [(filled.id, price) for filled, price in results[owner][0]]
+
+
+def test_limit_orders_fill_when_the_bar_crosses_their_price():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, direction=BUY, price=95.0))
+    engine.add(order(2, direction=SELL, price=108.0))
+    engine.add(order(3, direction=BUY, price=90.0))
+
+    results = engine.match(100.0, 94.0, 110.0, [1])
+
+    assert fills(results, 1) == [(1, 95.0), (2, 108.0)]
+    assert 1 not in engine and 2 not in engine and 3 in engine
+
+
+def test_limit_orders_fill_at_the_open_when_the_bar_opens_through_them():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, direction=BUY, price=105.0))
+    engine.add(order(2, direction=SELL, price=95.0))
+
+    results = engine.match(100.0, 98.0, 102.0, [1])
+
+    assert fills(results, 1) == [(1, 100.0), (2, 100.0)]
+
+
+def test_market_orders_fill_at_the_open_of_the_owners_next_bar():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, order_type=MARKET, price=None, user_id=1))
+    engine.add(order(2, order_type=MARKET, price=None, user_id=2))
+
+    results = engine.match(100.0, 90.0, 110.0, [1])
+
+    assert fills(results, 1) == [(1, 100.0)]
+    assert 2 not in results
+    assert [pending.id for pending in engine.orders_of(2)] == [2]
+
+
+def test_only_the_orders_of_the_given_owners_are_matched():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, user_id=1))
+    engine.add(order(2, user_id=2))
+
+    results = engine.match(100.0, 90.0, 110.0, [2])
+
+    assert list(results) == [2]
+    assert 1 in engine
+
+
+def test_stop_limit_orders_trigger_and_fill_on_a_later_bar():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, order_type=STOP_LIMIT, direction=BUY, price=108.0, stop_price=105.0))
+
+    results = engine.match(100.0, 99.0, 106.0, [1])
+    assert [triggered.id for triggered in results[1][2]] == [1]
+    assert results[1][0] == []
+    assert engine.resting_orders(1) == [(engine.orders[1], True)]
+
+    results = engine.match(110.0, 107.0, 112.0, [1])
+    assert fills(results, 1) == [(1, 108.0)]
+
+
+def test_triggered_stop_limit_orders_only_fill_at_their_limit():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, order_type=STOP_LIMIT, direction=BUY, price=108.0, stop_price=105.0))
+    engine.match(100.0, 99.0, 106.0, [1])
+
+    # Crosses the stop again but stays above the buy limit
+    results = engine.match(110.0, 109.0, 112.0, [1])
+    assert results[1] == ([], [], [])
+    assert 1 in engine
+
+    results = engine.match(109.0, 107.0, 110.0, [1])
+    assert fills(results, 1) == [(1, 108.0)]
+
+
+def test_a_filled_oco_leg_cancels_its_sibling():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, direction=SELL, price=110.0))
+    engine.add(order(2, order_type=OCO, direction=SELL, price=90.0, bounded_order_id=1))
+
+    results = engine.match(100.0, 95.0, 111.0, [1])
+
+    assert fills(results, 1) == [(1, 110.0)]
+    assert [cancelled.id for cancelled in results[1][1]] == [2]
+    assert len(engine) == 0
+
+
+def test_oco_orders_are_not_linked_to_orders_of_other_users():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, direction=SELL, price=110.0, user_id=1))
+    engine.add(order(2, order_type=OCO, direction=SELL, price=90.0, user_id=2, bounded_order_id=1))
+
+    results = engine.match(100.0, 95.0, 111.0, [1])
+
+    assert fills(results, 1) == [(1, 110.0)]
+    assert results[1][1] == [] and 2 not in results
+    assert 2 in engine
+
+
+def test_pop_orders_removes_every_order_of_one_owner():
+    engine = MatchingEngine('coin')
+    engine.add(order(1, user_id=1))
+    engine.add(order(2, order_type=STOP_LIMIT, price=108.0, stop_price=105.0, user_id=1))
+    engine.add(order(3, user_id=2))
+
+    popped = engine.pop_orders(1)
+
+    assert [(popped_order.id, triggered) for popped_order, triggered in popped] == [(1, False), (2, False)]
+    assert len(engine) == 1 and 3 in engine
+
+
+def test_removed_slots_are_reclaimed_without_losing_orders():
+    engine = MatchingEngine('coin')
+    count = 3 * INITIAL_CAPACITY
+    for order_id in range(count):
+        engine.add(order(order_id, price=float(order_id)))
+    for order_id in range(count):
+        if order_id % 3:
+            engine.remove(order_id)
+
+    assert engine.size < count
+    assert len(engine) == count // 3
+    results = engine.match(count, 0.0, count, [1])
+    assert sorted(fills(results, 1)) == [(order_id, float(order_id)) for order_id in range(0, count, 3)]
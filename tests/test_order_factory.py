@@ -0,0 +1,27 @@
+import pytest
+
+from app.data.choices import BUY, LIMIT, MARKET, STOP_LIMIT
+from app.playground.order_factory import OrderFactory
+
+
+def order_data(**fields):
+    return dict({'order_type': LIMIT, 'quantity': 1, 'base_asset': 'usd', 'target_asset': 'coin',
+                 'direction': BUY, 'execution_price': 100.0}, **fields)
+
+
+def test_valid_orders_are_built():
+    order, message = OrderFactory.create_order(order_data(order_type=STOP_LIMIT, stop_price=95.0))
+
+    assert message == {}
+    assert (order.order_type, order.execution_price, order.stop_price) == (STOP_LIMIT, 100.0, 95.0)
+
+
+@pytest.mark.parametrize('fields, message', [
+    ({'quantity': 0}, 'quantity must be positive'),
+    ({'execution_price': -1000.0}, 'execution_price must be positive'),
+    ({'order_type': MARKET, 'execution_price': 0.0}, 'execution_price must be positive'),
+    ({'execution_price': float('nan')}, 'execution_price must be positive'),
+    ({'order_type': STOP_LIMIT, 'stop_price': -5.0}, 'stop_price must be positive'),
+])
+def test_non_positive_quantities_and_prices_are_rejected(fields, message):
+    assert OrderFactory.create_order(order_data(**fields)) == (None, {'message': message})
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from app.playground.sharding import HashRing, ShardRegistry
+
+
+def test_a_joining_slot_only_takes_users_from_the_others():
+    before = HashRing([0, 1, 2])
+    after = HashRing([0, 1, 2, 3])
+
+    moved = [user_id for user_id in range(10000) if before.owner(user_id) != after.owner(user_id)]
+
+    assert all(after.owner(user_id) == 3 for user_id in moved)
+    assert 1500 < len(moved) < 3500
+
+
+def test_a_user_is_served_by_one_worker_until_it_hands_the_user_off(tmp_path):
+    first = ShardRegistry(str(tmp_path), handoff_timeout=0.2)
+    second = ShardRegistry(str(tmp_path), handoff_timeout=0.2)
+
+    assert first.lock_user(1)
+    assert first.lock_user(1)
+    assert not second.lock_user(1)
+    with pytest.raises(TimeoutError):
+        asyncio.run(second.acquire_user(1))
+
+    first.unlock_user(1)
+    asyncio.run(second.acquire_user(1))
+    assert not first.lock_user(1)
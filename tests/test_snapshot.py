@@ -0,0 +1,117 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from app.data.choices import BUY, LIMIT, SELL, STOP_LIMIT
+from app.data.db import get_async_session
+from app.data.models import Balance, User
+from app.playground.exchange import DemoExchange
+from app.playground.exchanges_manager import ExchangesManager
+from app.playground.journal import BALANCE_DELTA, ORDER_CANCELLED, EventJournal
+from app.playground.ledger import LedgerStore
+from app.playground.orders import OrderRecord
+from app.playground.snapshot import ExchangeSnapshot, read_snapshot, snapshot_path, write_snapshot
+
+
+def order(order_id, user_id, order_type=LIMIT, direction=BUY, price=90.0, stop_price=None):
+    return OrderRecord(id=order_id, order_type=order_type, quantity=1.0, base_asset='usd', target_asset='coin',
+                       direction=direction, execution_price=price, stop_price=stop_price,
+                       blocked_amount=price if direction == BUY else 1.0, user_id=user_id,
+                       creation_date=datetime(2024, 1, 1))
+
+
+def limit(price):
+    return OrderRecord(order_type=LIMIT, quantity=1.0, base_asset='usd', target_asset='coin', direction=BUY,
+                       execution_price=price, creation_date=datetime.now())
+
+
+def test_snapshots_round_trip_through_bytes_and_files(tmp_path):
+    snapshot = ExchangeSnapshot(7, 86400, 2.0, 0.05, {'coin': 3},
+                                [(order(1, 7), False), (order(2, 7, STOP_LIMIT, SELL, 95.0, 97.0), True)],
+                                {'usd': (10.0, 90.0), 'coin': (0.0, 1.0)}, 'events.log', 1234, 56)
+
+    write_snapshot(snapshot, tmp_path)
+    restored = read_snapshot(7, tmp_path)
+
+    assert (restored.user_id, restored.current_time, restored.multiplier, restored.commission) == (7, 86400, 2.0, 0.05)
+    assert restored.cursors == {'coin': 3}
+    assert [(restored_order.to_fields(), triggered) for restored_order, triggered in restored.orders] == \
+           [(restored_order.to_fields(), triggered) for restored_order, triggered in snapshot.orders]
+    assert restored.balances == snapshot.balances
+    assert (restored.journal, restored.offset, restored.seq) == ('events.log', 1234, 56)
+    assert not os.path.exists(f'{snapshot_path(7, tmp_path)}.tmp')
+    assert read_snapshot(8, tmp_path) is None
+
+
+def test_resume_applies_the_events_after_the_snapshot(run):
+    user_id = 301
+
+    async def scenario():
+        engines = {}
+        exchange = DemoExchange(user_id, matching_engines=engines, ledgers=LedgerStore(EventJournal(path=None)))
+        exchange.ledger = exchange.ledgers.restore(user_id, {'usd': 1000.0})
+        await exchange.replay([{'type': 'order_placed', 'order': order(1, user_id).to_fields()},
+                               {'type': 'order_placed', 'order': order(2, user_id, price=80.0).to_fields()}])
+        exchange.ledger = exchange.ledgers.restore(user_id, {'usd': 1000.0}, engines['coin'].orders_of(user_id))
+        exchange.cursors = {'coin': 5}
+
+        snapshot = ExchangeSnapshot.from_bytes(exchange.hibernate().to_bytes())
+        assert len(engines['coin']) == 0
+
+        events = [{'type': ORDER_CANCELLED, 'order_id': 2},
+                  {'type': BALANCE_DELTA, 'deltas': {'usd': -10.0}}]
+        resumed = await DemoExchange.resume(snapshot, events, matching_engines=engines,
+                                            ledgers=LedgerStore(EventJournal(path=None)))
+        return [resting.id for resting in engines['coin'].orders_of(user_id)], resumed.cursors, resumed.ledger
+
+    resting, cursors, ledger = run(scenario())
+    assert resting == [1]
+    assert cursors == {'coin': 5}
+    assert ledger.get('usd').to_dict() == {'free': 900.0, 'reserved': 90.0}
+
+
+def test_exchanges_resume_after_the_journal_moves_to_a_new_file(run, tmp_path):
+    user_ids = (302, 303, 304)
+
+    def manager():
+        exchanges_manager = ExchangesManager()
+        exchanges_manager.journal = EventJournal(os.path.join(tmp_path, 'journal', 'events.log'),
+                                                 checkpoint_name='snapshot-rotation')
+        exchanges_manager.ledgers = LedgerStore(exchanges_manager.journal)
+        exchanges_manager.snapshot_directory = os.path.join(tmp_path, 'snapshots')
+        return exchanges_manager
+
+    async def scenario():
+        async with get_async_session() as session:
+            session.add_all(Balance(user_id=user_id, asset_name='usd', amount=1000.0) for user_id in user_ids)
+            await session.commit()
+
+        exchanges_manager = manager()
+        for user_id, price in zip(user_ids, (50.0, 60.0, 70.0)):
+            exchange, _ = await exchanges_manager.get_exchange(User(id=user_id))
+            await exchange.place_order(User(id=user_id), limit(price))
+        # One hibernated user, and one whose snapshot is lost and who is restored from the tables
+        await exchanges_manager.hibernate(303)
+        await exchanges_manager.hibernate(304)
+        os.remove(snapshot_path(304, exchanges_manager.snapshot_directory))
+
+        old_path = exchanges_manager.journal.path
+        await exchanges_manager.compact_journal()
+        await exchanges_manager.shutdown()
+
+        restarted = manager()
+        resumed = {}
+        for user_id in user_ids:
+            exchange, _ = await restarted.get_exchange(User(id=user_id))
+            resumed[user_id] = ([resting.execution_price for resting in restarted.matching_engines['coin'].orders_of(user_id)],
+                                exchange.ledger.get('usd').reserved)
+        await restarted.shutdown()
+        return os.path.exists(old_path), os.path.basename(restarted.journal.path), resumed
+
+    old_file_exists, journal_name, resumed = run(scenario())
+    assert not old_file_exists
+    assert journal_name != 'events.log'
+    # Reserved with the default commission on top
+    assert resumed == {302: ([50.0], pytest.approx(55.0)), 303: ([60.0], pytest.approx(66.0)),
+                       304: ([70.0], pytest.approx(77.0))}